@@ -11,6 +11,14 @@ import os
 
 from django.core.asgi import get_asgi_application
 
-os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'scripts.settings')
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'my_django.settings')
 
 application = get_asgi_application()
+
+# With SEMANTIC_SEARCH_PRELOAD=1 and a server that loads the application before forking its workers
+# (e.g. `gunicorn --preload`), the embedding model is loaded once here and shared by the workers.
+# See `semantic_search/preload.py`.
+from semantic_search.serving import is_preload_mode
+if is_preload_mode():
+    from semantic_search.preload import preload
+    preload()
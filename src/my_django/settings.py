@@ -123,3 +123,29 @@ STATIC_URL = 'static/'
 # https://docs.djangoproject.com/en/5.0/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
+
+# Cache of the parsed results of `semantic_search` queries. Use a shared backend (e.g. Redis or 
+# FileBasedCache) so that all worker processes share the results.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'OPTIONS': {'MAX_ENTRIES': 10000},
+    }
+}
+
+# Semantic search serving. See `semantic_search/serving.py` for the defaults.
+SEMANTIC_SEARCH = {
+    'COLLECTIONS': ['test_set_5'],
+    'DEFAULT_COLLECTION': 'test_set_5',
+    'TOP_K': 1,
+    'EMBEDDING_BACKEND': 'torch',
+    'WARM_UP_ON_START': True,
+    # Admission control and CPU thread budget of each worker process. Without micro-batching, 
+    # MAX_CONCURRENCY counts retrievals; with BATCH_WINDOW_MS set, it counts batches of up to 
+    # MAX_BATCH_SIZE queries, and the queries waiting for a slot are collected into the next batch.
+    'MAX_CONCURRENCY': 2,
+    'MAX_QUEUE': 16,
+    'QUEUE_TIMEOUT_SECONDS': 2.0,
+    'WORKER_PROCESSES': 1,
+    'INTRA_OP_THREADS': None,
+}
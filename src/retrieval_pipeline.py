@@ -1,43 +1,159 @@
-from haystack import Pipeline
 from haystack_integrations.components.retrievers.chroma import ChromaEmbeddingRetriever
 from haystack.components.embedders import SentenceTransformersTextEmbedder
 from haystack_integrations.document_stores.chroma import ChromaDocumentStore
 import sys
+import time
 sys.path.append(r"/home/silvhua/custom_python")
 from silvhua import *
 from Custom_Logger import *
+from embedders import *
+from onnx_embedders import *
+from query_batcher import *
 
 class Retrieve_Docs:
 
     def __init__(
-            self, collection_name, document_store=None, top_k=1,
-            logger=None, logging_level=logging.INFO
+            self, collection_name, document_store=None, top_k=1, embedding_backend='torch',
+            model_path=default_onnx_path, persist_path='../data/processed/', query_cache_size=10000,
+            embedding_cache=None, batch_window_ms=None, max_batch_size=32, admit=None, n_threads=None,
+            text_embedder=None, logger=None, logging_level=logging.INFO
         ):
+        """
+        Parameters:
+        - collection_name (str): Chroma collection to query.
+        - document_store (ChromaDocumentStore, optional): Document store. Defaults to the collection
+            in `persist_path`.
+        - top_k (int, optional): Number of documents to retrieve.
+        - embedding_backend (str, optional): 'torch', 'onnx' or 'onnx-int8'. Use the backend the
+            collection was indexed with (see `create_indexing_pipeline`).
+        - model_path (str, optional): Folder of the model exported by `export_onnx_model`.
+        - persist_path (str, optional): Chroma persist path.
+        - query_cache_size (int, optional): Number of query embeddings kept in an in-memory LRU 
+            cache (see `Cached_Text_Embedder`). If 0 or None, every query is embedded.
+        - embedding_cache (Embedding_Cache, optional): Shared persistent cache behind the LRU cache.
+        - batch_window_ms (float, optional): If provided, queries that miss the caches are embedded 
+            by a `Query_Batcher` that groups concurrent queries arriving within this window.
+        - max_batch_size (int, optional): Maximum number of queries per batch of the `Query_Batcher`.
+        - admit (callable, optional): Context manager factory passed to the `Query_Batcher`, which 
+            enters it once per batch (see `Admission_Controller.admit` in `semantic_search.serving`).
+        - n_threads (int, optional): Intra-op threads of the ONNX backend. The torch backend uses the 
+            process-wide `torch.set_num_threads` setting.
+        - text_embedder (optional): Already loaded text embedder to use instead of creating one from 
+            `embedding_backend`, e.g. the model preloaded before forking worker processes.
+
+        The components are kept as `text_embedder` and `retriever` and `run` calls them directly 
+        rather than through a haystack `Pipeline`, so one warmed instance can serve concurrent requests.
+        """
+        check_embedding_backend(embedding_backend)
         self.logger = create_function_logger(__name__, parent_logger=logger, level=logging_level)
 
         self.logger.info(f'***Instantiating `Retrieve_Docs`***')
         if document_store is None:
             document_store = ChromaDocumentStore( # https://docs.haystack.deepset.ai/reference/integrations-chroma#chromadocumentstore
                 collection_name=collection_name, 
-                persist_path='../data/processed/'
+                persist_path=persist_path
                 )
+        self.collection_name = collection_name
+        self.document_store = document_store
+        self.top_k = top_k
+        self.is_warm = False
+        self.batches_queries = bool(batch_window_ms)
         # https://docs.haystack.deepset.ai/docs/chromaembeddingretriever
         retriever = ChromaEmbeddingRetriever(document_store=document_store, top_k=top_k)
-        self.retrieval_pipeline = Pipeline()
-        self.retrieval_pipeline.add_component("text_embedder", SentenceTransformersTextEmbedder(
-            # model="thenlper/gte-large"
-            ))
-        self.retrieval_pipeline.add_component("retriever_with_embeddings", retriever)
-        self.retrieval_pipeline.connect("text_embedder", "retriever_with_embeddings")
-
-    def run(self, query):
+        if text_embedder is not None:
+            pass
+        elif embedding_backend == 'torch':
+            text_embedder = SentenceTransformersTextEmbedder(
+                # model="thenlper/gte-large"
+                )
+        else:
+            text_embedder = Onnx_Text_Embedder(
+                model_path=model_path, quantized=(embedding_backend == 'onnx-int8'), n_threads=n_threads
+                )
+        if batch_window_ms:
+            text_embedder = Query_Batcher(
+                text_embedder, window_ms=batch_window_ms, max_batch_size=max_batch_size, admit=admit, 
+                logger=self.logger
+                )
+        if query_cache_size:
+            text_embedder = Cached_Text_Embedder(
+                text_embedder, max_entries=query_cache_size, embedding_cache=embedding_cache, logger=self.logger
+                )
+        self.text_embedder = text_embedder
+        self.retriever = retriever
+
+    def warm_up(self):
+        """
+        Load the embedding model and open the collection by running one query, so that the first 
+        request does not pay for it.
+
+        Returns:
+        Number of seconds the warm-up took.
+        """
+        start = time.perf_counter()
+        self.text_embedder.warm_up()
+        self.run('warm up')
+        self.is_warm = True
+        elapsed = time.perf_counter() - start
+        self.logger.info(f'Warmed up retriever for collection `{self.collection_name}` in {elapsed:.1f} s.')
+        return elapsed
+
+    def run(self, query, top_k=None):
         """
         Get the n_results nearest neighbor embeddings for provided query.
         The `score` attribute is the distance between embeddings. https://docs.trychroma.com/reference/Collection#query
+
+        Parameters:
+        - query (str): Query text.
+        - top_k (int, optional): Number of documents to retrieve. Defaults to the instance's `top_k`.
+
+        Returns:
+        Dictionary of the retrieved documents: 
+            {'retriever_with_embeddings': {'documents': [...]}}
         """
         self.logger.info(f'***Running retrieval pipeline***')
-        result = self.retrieval_pipeline.run({"text_embedder": {"text": query}})
-        return result
+        self.text_embedder.warm_up()
+        query_embedding = self.text_embedder.run(text=query)['embedding']
+        documents = self.retriever.run(
+            query_embedding=query_embedding, top_k=top_k if top_k else self.top_k
+            )['documents']
+        return {'retriever_with_embeddings': {'documents': documents}}
+
+    def run_batch(self, queries, top_k=None, batch_size=256):
+        """
+        Retrieve the nearest neighbors of several queries: the queries are embedded in batched 
+        forward passes and sent to Chroma as multi-query calls of `batch_size` queries.
+
+        Parameters:
+        - queries (list): Query texts.
+        - top_k (int, optional): Number of documents to retrieve per query. Defaults to the 
+            instance's `top_k`.
+        - batch_size (int, optional): Number of queries per embedding batch and Chroma call.
+
+        Returns:
+        List with one `run` output per query, in the order of `queries`.
+        """
+        self.logger.info(f'***Running batch retrieval of {len(queries)} queries***')
+        top_k = top_k if top_k else self.top_k
+        results = []
+        for index in range(0, len(queries), batch_size):
+            query_embeddings = embed_texts(self.text_embedder, queries[index:index+batch_size], batch_size=batch_size)
+            for documents in self.document_store.search_embeddings(query_embeddings, top_k=top_k):
+                results.append({'retriever_with_embeddings': {'documents': documents}})
+        return results
+
+def parse_results(results):
+    """
+    Convert the output of `Retrieve_Docs.run` to a list of unique metadata dictionaries with 
+    the score of each document.
+    """
+    parsed_results_list = []
+    for result in results['retriever_with_embeddings'].get('documents', []):
+        parsed_result = dict(result.meta)
+        parsed_result.pop('source_id', None)
+        parsed_result['score'] = result.score
+        parsed_results_list.append(parsed_result)
+    return get_unique_dicts(parsed_results_list, keys_to_ignore=['score'])
 
 def get_unique_dicts(my_list, keys_to_ignore=[]):
     """
@@ -76,13 +192,7 @@ if __name__ == "__main__":
             break
         results_list = retriever.run(query)
         logger.info(f'Results list: {results_list}')
-        parsed_results_list = []
-        for index, result in enumerate(results_list['retriever_with_embeddings'].get('documents', [])):
-            parsed_result = result.meta
-            parsed_result.pop('source_id')
-            parsed_result['score'] = result.score
-            parsed_results_list.append(parsed_result)
-        parsed_results_list = get_unique_dicts(parsed_results_list, keys_to_ignore=['score'])
+        parsed_results_list = parse_results(results_list)
         logger.info('\n'.join(parsed_results_list))
         query_number += 1
         
@@ -4,3 +4,8 @@ from django.apps import AppConfig
 class SemanticSearchConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'semantic_search'
+
+    def ready(self):
+        # Build one warmed retriever per configured collection for this process
+        from .serving import start_warm_up
+        start_warm_up()
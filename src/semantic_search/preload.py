@@ -0,0 +1,154 @@
+"""
+Preload-and-fork mode: load the embedding model once in the master process so that forked worker
+processes share its memory pages copy-on-write instead of each loading a copy.
+
+Enable it with the environment variable `SEMANTIC_SEARCH_PRELOAD=1` and a server that imports the
+application before forking, e.g.:
+
+    SEMANTIC_SEARCH_PRELOAD=1 gunicorn my_django.wsgi --preload --workers 4
+    SEMANTIC_SEARCH_PRELOAD=1 gunicorn my_django.asgi --preload --workers 4 -k uvicorn.workers.UvicornWorker
+
+Only state that is safe to inherit across `fork` is preloaded: the PyTorch model weights. The Chroma
+client (SQLite connections and background threads) and ONNX Runtime sessions (thread pools) are
+created in each worker after the fork.
+
+Measure the effect with `python -m semantic_search.preload <n_workers>` from the `src` folder.
+"""
+import gc
+import os
+import sys
+import json
+import threading
+import subprocess
+from . import serving
+from .serving import *
+
+def preload(logger=None):
+    """
+    Load the text embedder in the master process, register the post-fork warm-up of the workers,
+    and freeze the objects created so far so that the garbage collector of the workers does not
+    write to their pages.
+    """
+    logger = logger if logger else serving.logger
+    serving_settings = get_serving_settings()
+    if serving_settings['EMBEDDING_BACKEND'] == 'torch':
+        text_embedder = SentenceTransformersTextEmbedder()
+        text_embedder.warm_up()
+        serving.preloaded_text_embedders['torch'] = text_embedder
+        logger.info('Preloaded the torch text embedder in the master process.')
+    else:
+        logger.warning(
+            f'`{serving_settings["EMBEDDING_BACKEND"]}` backend: ONNX Runtime sessions are not fork-safe, '
+            f'so each worker loads its own model.'
+            )
+    os.register_at_fork(after_in_child=after_fork_in_child)
+    gc.collect()
+    gc.freeze()
+
+def after_fork_in_child():
+    """
+    Start each worker with fresh locks and warm up its retrievers (Chroma client and first query)
+    in the background.
+    """
+    serving.registry_lock = threading.Lock()
+    serving.collection_locks.clear()
+    if get_serving_settings()['WARM_UP_ON_START']:
+        threading.Thread(target=warm_up_retrievers, name='warm_up_retrievers', daemon=True).start()
+
+def read_memory_usage(pid):
+    """
+    Returns:
+    Dictionary with the RSS, PSS (shared pages divided among the processes sharing them) and
+    private memory of a process in MiB, from /proc/<pid>/smaps_rollup (Linux).
+    """
+    values = {}
+    with open(f'/proc/{pid}/smaps_rollup') as file:
+        for line in file:
+            fields = line.split()
+            if len(fields) == 3 and fields[2] == 'kB':
+                values[fields[0].rstrip(':')] = int(fields[1])
+    return {
+        'rss_mib': round(values['Rss'] / 1024, 1),
+        'pss_mib': round(values['Pss'] / 1024, 1),
+        'private_mib': round((values['Private_Clean'] + values['Private_Dirty']) / 1024, 1),
+    }
+
+def measure_worker_memory(n_workers=4, preload_models=True, query='muscle protein synthesis'):
+    """
+    Fork `n_workers` workers, with or without preloading the model in the master, let each answer
+    one query and measure the memory of every worker while all of them are alive.
+
+    Returns:
+    Dictionary with the memory of each worker and the totals.
+    """
+    if preload_models:
+        preload()
+    ready_read, ready_write = os.pipe()
+    release_read, release_write = os.pipe()
+    pids = []
+    for worker in range(n_workers):
+        pid = os.fork()
+        if pid == 0:
+            os.close(ready_read)
+            os.close(release_write)
+            status = 0
+            try:
+                get_retriever().run(query)
+                os.write(ready_write, b'1')
+            except Exception as error:
+                serving.logger.error(f'Worker {os.getpid()} failed: {error}')
+                os.write(ready_write, b'0')
+                status = 1
+            # Stay alive until the parent has measured every worker, so that pages remain shared
+            os.read(release_read, 1)
+            os._exit(status)
+        pids.append(pid)
+    os.close(ready_write)
+    os.close(release_read)
+    n_ready = 0
+    while n_ready < n_workers:
+        n_ready += len(os.read(ready_read, n_workers))
+    workers = [read_memory_usage(pid) for pid in pids]
+    os.close(release_write)
+    for pid in pids:
+        os.waitpid(pid, 0)
+    return {
+        'preload': preload_models, 'n_workers': n_workers, 'workers': workers,
+        'master': read_memory_usage(os.getpid()),
+        'total_pss_mib': round(sum(worker['pss_mib'] for worker in workers), 1),
+        'mean_rss_mib': round(sum(worker['rss_mib'] for worker in workers) / n_workers, 1),
+        'mean_private_mib': round(sum(worker['private_mib'] for worker in workers) / n_workers, 1),
+    }
+
+def benchmark_preload_memory(n_workers=4, logger=None):
+    """
+    Run `measure_worker_memory` with and without preloading, each in a fresh Python process.
+
+    Returns:
+    List of the two results.
+    """
+    logger = logger if logger else serving.logger
+    results = []
+    for mode in ('no-preload', 'preload'):
+        completed = subprocess.run(
+            [sys.executable, '-m', 'semantic_search.preload', str(n_workers), mode],
+            capture_output=True, text=True, check=True
+            )
+        result = json.loads(completed.stdout.strip().splitlines()[-1])
+        logger.info(
+            f'{mode}: {n_workers} workers, mean RSS {result["mean_rss_mib"]} MiB, mean private '
+            f'{result["mean_private_mib"]} MiB, total PSS {result["total_pss_mib"]} MiB.'
+            )
+        results.append(result)
+    return results
+
+if __name__ == "__main__":
+    import django
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'my_django.settings')
+    os.environ['SEMANTIC_SEARCH_PRELOAD'] = '1' # No warm-up thread in the measuring process
+    django.setup()
+    n_workers = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+    if len(sys.argv) > 2:
+        print(json.dumps(measure_worker_memory(n_workers, preload_models=(sys.argv[2] == 'preload'))))
+    else:
+        benchmark_preload_memory(n_workers)
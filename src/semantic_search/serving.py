@@ -0,0 +1,558 @@
+"""
+Process-wide registry of warmed `Retrieve_Docs` instances, one per collection, shared by all
+the requests served by a worker process.
+"""
+import os
+import sys
+import time
+import asyncio
+import threading
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from django.conf import settings
+from django.core.cache import caches
+from retrieval_pipeline import *
+from collection_versions import *
+
+default_serving_settings = {
+    'COLLECTIONS': ['test_set_5'], # Collections warmed up when the app starts
+    'DEFAULT_COLLECTION': 'test_set_5',
+    'TOP_K': 1,
+    'PERSIST_PATH': '../data/processed/',
+    'EMBEDDING_BACKEND': 'torch', # 'torch', 'onnx' or 'onnx-int8'
+    'MODEL_PATH': default_onnx_path,
+    'QUERY_CACHE_SIZE': 10000, # Query embeddings kept in memory per collection
+    'SHARED_QUERY_CACHE_PATH': None, # SQLite path of an `Embedding_Cache` shared by all workers
+    'BATCH_WINDOW_MS': None, # e.g. 5 to embed concurrent queries together; None disables micro-batching
+    'MAX_BATCH_SIZE': 32, # With micro-batching, each batch takes one MAX_CONCURRENCY slot
+    'RESULT_CACHE_ALIAS': 'default', # Django cache used for parsed results; None disables it
+    'RESULT_CACHE_TIMEOUT': 3600,
+    'MAX_BATCH_QUERIES': 1000, # Maximum number of queries per request to the batch endpoint
+    'EXECUTOR_WORKERS': 4, # Threads running embedding and Chroma queries for the async views
+    'VERSION_CHECK_SECONDS': 1.0, # Maximum reuse of a collection version; writes are seen at once via the stamp file
+    'MAX_CONCURRENCY': 2, # Retrievals running at once per worker process
+    'MAX_QUEUE': 16, # Retrievals waiting for a slot before new ones are shed with 503
+    'QUEUE_TIMEOUT_SECONDS': 2.0, # Maximum wait for a slot before shedding with 503
+    'WORKER_PROCESSES': 1, # Worker processes per host, used to split the CPU threads
+    'INTRA_OP_THREADS': None, # Inference threads per retrieval; default: CPUs / (WORKER_PROCESSES * MAX_CONCURRENCY)
+    'INTER_OP_THREADS': 1,
+    'WARM_UP_ON_START': True,
+    'WARM_UP_IN_BACKGROUND': True,
+}
+
+logger = create_function_logger('semantic_search.serving', None, level=logging.INFO)
+retrievers = {}
+retriever_status = {}
+registry_lock = threading.Lock()
+collection_locks = {}
+shared_query_cache = None
+collection_versions = None
+checked_versions = {}
+retrieval_executor = None
+admission_controller = None
+preloaded_text_embedders = {} # Text embedders loaded by `preload.preload` before forking, by backend
+
+class Overloaded(Exception):
+    """
+    Raised when a retrieval is shed by the `Admission_Controller`.
+    """
+
+class Admission_Controller:
+    def __init__(self, max_concurrency=2, max_queue=16, queue_timeout=2.0, n_wait_times=1000):
+        """
+        Limit the number of retrievals running at once in the process. Up to `max_queue` further 
+        retrievals wait for a slot, for at most `queue_timeout` seconds. Beyond that, `Overloaded` is 
+        raised at once so that the view can answer 503 instead of oversubscribing the CPUs. 
+        Retrievals queued on an executor by the async views count as waiting (see `Queued_Executor`).
+
+        Parameters:
+        - max_concurrency (int, optional): Retrievals running at once.
+        - max_queue (int, optional): Retrievals waiting for a slot.
+        - queue_timeout (float, optional): Maximum wait for a slot, in seconds.
+        - n_wait_times (int, optional): Number of recent wait times kept for the metrics.
+        """
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.semaphore = threading.BoundedSemaphore(max_concurrency)
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.waiting = 0
+        self.queued = 0
+        self.running = 0
+        self.n_admitted = 0
+        self.n_rejected = 0
+        self.n_timed_out = 0
+        self.wait_times = deque(maxlen=n_wait_times)
+
+    def enqueue(self):
+        """
+        Count a retrieval queued on an executor, before it starts. Raise `Overloaded` if the 
+        retrievals running, waiting for a slot and queued already fill `max_concurrency + max_queue`.
+        """
+        with self.lock:
+            if self.running + self.waiting + self.queued >= self.max_concurrency + self.max_queue:
+                self.n_rejected += 1
+                raise Overloaded(f'{self.waiting + self.queued} retrievals already waiting.')
+            self.queued += 1
+
+    def dequeue(self):
+        """
+        Stop counting a retrieval counted by `enqueue` that will not run, e.g. because submitting 
+        it failed.
+        """
+        with self.lock:
+            self.queued -= 1
+
+    def take_queued(self):
+        """
+        Helper function called with `self.lock` held: stop counting the retrieval of the current 
+        thread as queued, in the same step as it is counted as waiting or running, so that the 
+        total never drops in between.
+        """
+        if getattr(self.local, 'queued', False):
+            self.local.queued = False
+            self.queued -= 1
+
+    @contextmanager
+    def run_queued(self):
+        """
+        Entered by the executor thread of a retrieval counted by `enqueue`. The retrieval stays 
+        counted as queued until `admit` counts it as waiting or running, or until it finishes 
+        without being admitted (e.g. a result cache hit).
+        """
+        self.local.queued = True
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.take_queued()
+
+    @contextmanager
+    def admit(self):
+        start = time.perf_counter()
+        acquired = self.semaphore.acquire(blocking=False)
+        if not acquired:
+            with self.lock:
+                is_queued = getattr(self.local, 'queued', False)
+                if self.waiting + self.queued - is_queued >= self.max_queue:
+                    self.take_queued()
+                    self.n_rejected += 1
+                    raise Overloaded(f'{self.waiting + self.queued} retrievals already waiting.')
+                self.take_queued()
+                self.waiting += 1
+            try:
+                acquired = self.semaphore.acquire(timeout=self.queue_timeout)
+            finally:
+                with self.lock:
+                    self.waiting -= 1
+            if not acquired:
+                with self.lock:
+                    self.n_timed_out += 1
+                raise Overloaded(f'No retrieval slot within {self.queue_timeout} s.')
+        with self.lock:
+            self.take_queued()
+            self.running += 1
+            self.n_admitted += 1
+            self.wait_times.append(time.perf_counter() - start)
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.running -= 1
+            self.semaphore.release()
+
+    def stats(self):
+        with self.lock:
+            wait_times = list(self.wait_times)
+            return {
+                'queue_depth': self.waiting + self.queued, 'running': self.running, 'admitted': self.n_admitted,
+                'rejected': self.n_rejected, 'timed_out': self.n_timed_out,
+                'wait_ms_p50': round(float(np.percentile(wait_times, 50)) * 1000, 2) if wait_times else None,
+                'wait_ms_p99': round(float(np.percentile(wait_times, 99)) * 1000, 2) if wait_times else None,
+                'wait_ms_max': round(max(wait_times) * 1000, 2) if wait_times else None,
+            }
+
+class Queued_Executor:
+    def __init__(self, executor, admission_controller):
+        """
+        Executor that counts the tasks waiting in the queue of `executor` in the admission 
+        controller, from submission until they are admitted, so that a burst of requests is shed 
+        with `Overloaded` instead of piling up in the unbounded queue of the thread pool.
+        """
+        self.executor = executor
+        self.admission_controller = admission_controller
+
+    def submit(self, function, *args, **kwargs):
+        self.admission_controller.enqueue()
+        try:
+            future = self.executor.submit(self.run, function, *args, **kwargs)
+        except Exception:
+            self.admission_controller.dequeue()
+            raise
+        # A task cancelled before it starts never reaches `run`, so it leaves the queue here
+        future.add_done_callback(self.dequeue_cancelled)
+        return future
+
+    def dequeue_cancelled(self, future):
+        if future.cancelled():
+            self.admission_controller.dequeue()
+
+    def run(self, function, *args, **kwargs):
+        with self.admission_controller.run_queued():
+            return function(*args, **kwargs)
+
+def get_admission_controller():
+    global admission_controller
+    with registry_lock:
+        if admission_controller is None:
+            serving_settings = get_serving_settings()
+            admission_controller = Admission_Controller(
+                max_concurrency=serving_settings['MAX_CONCURRENCY'], max_queue=serving_settings['MAX_QUEUE'],
+                queue_timeout=serving_settings['QUEUE_TIMEOUT_SECONDS']
+                )
+    return admission_controller
+
+def get_intra_op_threads():
+    serving_settings = get_serving_settings()
+    if serving_settings['INTRA_OP_THREADS']:
+        return serving_settings['INTRA_OP_THREADS']
+    return max(1, (os.cpu_count() or 1) // (serving_settings['WORKER_PROCESSES'] * serving_settings['MAX_CONCURRENCY']))
+
+def configure_threads():
+    """
+    Apply the thread budget of the `SEMANTIC_SEARCH` setting to torch in this process, before the 
+    model is loaded. The ONNX backend gets the same budget through `Retrieve_Docs(n_threads=...)`.
+    """
+    intra_op_threads = get_intra_op_threads()
+    inter_op_threads = get_serving_settings()['INTER_OP_THREADS']
+    try:
+        import torch
+    except ImportError:
+        return
+    torch.set_num_threads(intra_op_threads)
+    try:
+        torch.set_num_interop_threads(inter_op_threads)
+    except RuntimeError:
+        # Can only be set once, before any inter-op parallel work has started
+        pass
+    logger.info(f'Torch threads: {intra_op_threads} intra-op, {inter_op_threads} inter-op.')
+
+class Single_Flight:
+    def __init__(self):
+        """
+        Coalesce identical in-flight computations: callers that submit a key which is already being 
+        computed get the same future instead of starting another computation.
+        """
+        self.lock = threading.Lock()
+        self.in_flight = {}
+        self.n_calls = 0
+        self.n_coalesced = 0
+
+    def submit(self, key, executor, function, *args, **kwargs):
+        """
+        Returns:
+        concurrent.futures.Future of `function(*args, **kwargs)`, shared by every caller of `key` 
+        until it completes.
+        """
+        with self.lock:
+            future = self.in_flight.get(key)
+            if future is not None:
+                self.n_coalesced += 1
+                return future
+            future = executor.submit(function, *args, **kwargs)
+            self.in_flight[key] = future
+            self.n_calls += 1
+        future.add_done_callback(lambda done_future: self.forget(key, done_future))
+        return future
+
+    def forget(self, key, future):
+        with self.lock:
+            if self.in_flight.get(key) is future:
+                del self.in_flight[key]
+
+    def stats(self):
+        with self.lock:
+            return {'in_flight': len(self.in_flight), 'calls': self.n_calls, 'coalesced': self.n_coalesced}
+
+single_flight = Single_Flight()
+
+def get_serving_settings():
+    """
+    Return the `SEMANTIC_SEARCH` Django setting merged over the defaults.
+    """
+    return {**default_serving_settings, **getattr(settings, 'SEMANTIC_SEARCH', {})}
+
+def get_shared_query_cache():
+    global shared_query_cache
+    path = get_serving_settings()['SHARED_QUERY_CACHE_PATH']
+    with registry_lock:
+        if path and shared_query_cache is None:
+            shared_query_cache = Embedding_Cache(path, logger=logger)
+    return shared_query_cache
+
+def get_retriever(collection_name=None):
+    """
+    Return the warmed retriever of a collection, building and warming it on first use. Concurrent
+    callers for the same collection wait for a single build.
+    """
+    serving_settings = get_serving_settings()
+    collection_name = collection_name if collection_name else serving_settings['DEFAULT_COLLECTION']
+    retriever = retrievers.get(collection_name)
+    if retriever is not None:
+        return retriever
+    with registry_lock:
+        collection_lock = collection_locks.setdefault(collection_name, threading.Lock())
+    with collection_lock:
+        retriever = retrievers.get(collection_name)
+        if retriever is None:
+            retriever_status[collection_name] = {'warm': False}
+            try:
+                retriever = Retrieve_Docs(
+                    collection_name, top_k=serving_settings['TOP_K'],
+                    embedding_backend=serving_settings['EMBEDDING_BACKEND'],
+                    model_path=serving_settings['MODEL_PATH'],
+                    persist_path=serving_settings['PERSIST_PATH'],
+                    query_cache_size=serving_settings['QUERY_CACHE_SIZE'],
+                    embedding_cache=get_shared_query_cache(),
+                    batch_window_ms=serving_settings['BATCH_WINDOW_MS'],
+                    max_batch_size=serving_settings['MAX_BATCH_SIZE'], admit=get_admission_controller().admit,
+                    n_threads=get_intra_op_threads(),
+                    text_embedder=preloaded_text_embedders.get(serving_settings['EMBEDDING_BACKEND']),
+                    logger=logger
+                    )
+                warm_up_seconds = retriever.warm_up()
+            except Exception as error:
+                retriever_status[collection_name] = {'warm': False, 'error': str(error)}
+                raise
+            retrievers[collection_name] = retriever
+            retriever_status[collection_name] = {
+                'warm': True, 'warmed_at': time.time(), 'warm_up_seconds': round(warm_up_seconds, 2)
+                }
+    return retriever
+
+def get_cached_collection_version(collection_name):
+    """
+    Return the version of a collection kept in memory by `get_collection_version`, or None if it 
+    must be re-read from the database: the stamp file changed, the version is older than 
+    `VERSION_CHECK_SECONDS`, or it was never read. Costs one `stat` and no database read, so the 
+    async views can call it on the event loop.
+    """
+    checked_version = checked_versions.get(collection_name)
+    if collection_versions is None or checked_version is None:
+        return None
+    if (
+        checked_version[2] == collection_versions.get_stamp()
+        and time.monotonic() - checked_version[1] < get_serving_settings()['VERSION_CHECK_SECONDS']
+        ):
+        return checked_version[0]
+    return None
+
+def get_collection_version(collection_name):
+    """
+    Return the version of a collection from the `Collection_Versions` database next to the Chroma 
+    persist path. The version is kept in memory and re-read when the stamp file of the database 
+    changed (one `stat` per call), so results cached before a write are not served after it. It is 
+    also re-read at least every `VERSION_CHECK_SECONDS`, in case a stamp change is missed.
+    """
+    global collection_versions
+    version = get_cached_collection_version(collection_name)
+    if version is not None:
+        return version
+    if collection_versions is None:
+        with registry_lock:
+            if collection_versions is None:
+                collection_versions = Collection_Versions(
+                    get_versions_path(get_serving_settings()['PERSIST_PATH']), logger=logger
+                    )
+    # The stamp is read before the version, so that a bump in between only causes an extra read
+    stamp = collection_versions.get_stamp()
+    version = collection_versions.get(collection_name)
+    checked_versions[collection_name] = (version, time.monotonic(), stamp)
+    return version
+
+def create_result_cache_key(collection_name, version, query, top_k):
+    query_hash = hash_text(normalize_query(query))
+    return f'semantic_search:results:{collection_name}:v{version}:k{top_k}:{query_hash}'
+
+def get_results(query, collection_name=None, top_k=None):
+    """
+    Return the parsed, deduplicated results of a query, from the Django result cache when the 
+    same (collection, collection version, top_k, normalized query) was already answered.
+
+    Returns:
+    List of result dictionaries as returned by `parse_results`.
+    """
+    serving_settings = get_serving_settings()
+    collection_name = collection_name if collection_name else serving_settings['DEFAULT_COLLECTION']
+    top_k = top_k if top_k else serving_settings['TOP_K']
+    cache_alias = serving_settings['RESULT_CACHE_ALIAS']
+    if cache_alias:
+        key = create_result_cache_key(collection_name, get_collection_version(collection_name), query, top_k)
+        results = caches[cache_alias].get(key)
+        if results is not None:
+            return results
+    retriever = get_retriever(collection_name)
+    if retriever.batches_queries:
+        # The `Query_Batcher` takes one slot per batch: holding one per query here would cap the 
+        # batches at MAX_CONCURRENCY queries
+        results = parse_results(retriever.run(query, top_k=top_k))
+    else:
+        with get_admission_controller().admit():
+            results = parse_results(retriever.run(query, top_k=top_k))
+    if cache_alias:
+        caches[cache_alias].set(key, results, timeout=serving_settings['RESULT_CACHE_TIMEOUT'])
+    return results
+
+def get_retrieval_executor():
+    """
+    Return the bounded thread pool that runs retrieval for the async views, so that embedding 
+    and Chroma queries never block the event loop and at most `EXECUTOR_WORKERS` run at once. 
+    Submitting raises `Overloaded` when the admission controller is full.
+    """
+    global retrieval_executor
+    controller = get_admission_controller()
+    with registry_lock:
+        if retrieval_executor is None:
+            retrieval_executor = Queued_Executor(
+                ThreadPoolExecutor(max_workers=get_serving_settings()['EXECUTOR_WORKERS'], thread_name_prefix='retrieval'),
+                controller
+                )
+    return retrieval_executor
+
+async def get_results_async(query, collection_name=None, top_k=None):
+    """
+    Async version of `get_results`. Cache hits are answered on the event loop. Misses run on 
+    the retrieval executor, and identical concurrent queries share one computation.
+    """
+    serving_settings = get_serving_settings()
+    collection_name = collection_name if collection_name else serving_settings['DEFAULT_COLLECTION']
+    top_k = top_k if top_k else serving_settings['TOP_K']
+    version = get_cached_collection_version(collection_name)
+    if version is None:
+        # SQLite read in the default executor, not queued behind retrievals on the retrieval executor
+        version = await asyncio.to_thread(get_collection_version, collection_name)
+    key = create_result_cache_key(collection_name, version, query, top_k)
+    cache_alias = serving_settings['RESULT_CACHE_ALIAS']
+    if cache_alias:
+        results = await caches[cache_alias].aget(key)
+        if results is not None:
+            return results
+    # Identical queries join the in-flight computation; new ones are shed when the queue is full
+    future = single_flight.submit(key, get_retrieval_executor(), get_results, query, collection_name, top_k)
+    # The future is shared by the coalesced callers, so a caller that disconnects must not cancel it
+    return await asyncio.shield(asyncio.wrap_future(future))
+
+def get_batch_results(queries, collection_name=None, top_k=None):
+    """
+    Batch version of `get_results`: cached queries are read with one `get_many` call and the 
+    others are answered together by `Retrieve_Docs.run_batch`.
+
+    Returns:
+    List of result lists in the order of `queries`.
+    """
+    serving_settings = get_serving_settings()
+    collection_name = collection_name if collection_name else serving_settings['DEFAULT_COLLECTION']
+    top_k = top_k if top_k else serving_settings['TOP_K']
+    cache_alias = serving_settings['RESULT_CACHE_ALIAS']
+    cached_results = {}
+    if cache_alias:
+        version = get_collection_version(collection_name)
+        keys = {query: create_result_cache_key(collection_name, version, query, top_k) for query in queries}
+        cached_by_key = caches[cache_alias].get_many(list(set(keys.values())))
+        cached_results = {query: cached_by_key[key] for query, key in keys.items() if key in cached_by_key}
+    missing = [query for query in dict.fromkeys(queries) if query not in cached_results]
+    if missing:
+        retriever = get_retriever(collection_name)
+        with get_admission_controller().admit():
+            new_results = {
+                query: parse_results(results) for query, results in 
+                zip(missing, retriever.run_batch(missing, top_k=top_k))
+                }
+        if cache_alias:
+            caches[cache_alias].set_many(
+                {keys[query]: results for query, results in new_results.items()},
+                timeout=serving_settings['RESULT_CACHE_TIMEOUT']
+                )
+        cached_results.update(new_results)
+    return [cached_results[query] for query in queries]
+
+def warm_up_retrievers(collection_names=None):
+    """
+    Build and warm the retrievers of `collection_names`, by default the `COLLECTIONS` setting.
+    Errors are logged so that one missing collection does not prevent the others from warming.
+    """
+    collection_names = collection_names if collection_names else get_serving_settings()['COLLECTIONS']
+    for collection_name in collection_names:
+        try:
+            get_retriever(collection_name)
+        except Exception as error:
+            exc_type, exc_obj, tb = sys.exc_info()
+            f = tb.tb_frame
+            lineno = tb.tb_lineno
+            filename = f.f_code.co_filename
+            message = f'An error occurred on line {lineno} in {filename}: {error}.'
+            logger.error(f'Could not warm up collection `{collection_name}`. {message}')
+
+def is_preload_mode():
+    """
+    True when the WSGI/ASGI module preloads the models in the master process before the workers 
+    are forked (environment variable `SEMANTIC_SEARCH_PRELOAD=1`). See `semantic_search/preload.py`.
+    """
+    return os.environ.get('SEMANTIC_SEARCH_PRELOAD', '').lower() in ('1', 'true', 'yes')
+
+def is_serving_process():
+    """
+    Return False for management commands that do not serve requests (e.g. `migrate`) and for
+    the file-watching parent process of `runserver`, so they do not load the model.
+    """
+    if not os.path.basename(sys.argv[0]).startswith('manage'):
+        return True
+    if len(sys.argv) < 2 or sys.argv[1] != 'runserver':
+        return False
+    return '--noreload' in sys.argv or os.environ.get('RUN_MAIN') == 'true'
+
+def start_warm_up():
+    """
+    Called from `SemanticSearchConfig.ready`.
+    """
+    serving_settings = get_serving_settings()
+    if not is_serving_process():
+        return
+    configure_threads()
+    if not serving_settings['WARM_UP_ON_START'] or is_preload_mode():
+        # In preload mode, no thread may run in the master before forking: workers warm up after the fork
+        return
+    for collection_name in serving_settings['COLLECTIONS']:
+        retriever_status.setdefault(collection_name, {'warm': False})
+    if serving_settings['WARM_UP_IN_BACKGROUND']:
+        threading.Thread(target=warm_up_retrievers, name='warm_up_retrievers', daemon=True).start()
+    else:
+        warm_up_retrievers()
+
+def get_health():
+    """
+    Returns:
+    Tuple of (True if every configured collection is warm, status of each collection).
+    """
+    status = {
+        collection_name: retriever_status.get(collection_name, {'warm': False})
+        for collection_name in get_serving_settings()['COLLECTIONS']
+        }
+    status.update({
+        collection_name: collection_status for collection_name, collection_status in retriever_status.items()
+        if collection_name not in status
+        })
+    for collection_name, retriever in list(retrievers.items()):
+        if hasattr(retriever.text_embedder, 'stats'):
+            status[collection_name] = {**status[collection_name], 'query_cache': retriever.text_embedder.stats()}
+    return all(collection_status['warm'] for collection_status in status.values()), status
+
+def get_metrics():
+    """
+    Returns:
+    Serving metrics of this process, reported by the health endpoint.
+    """
+    return {'single_flight': single_flight.stats(), 'admission': get_admission_controller().stats()}
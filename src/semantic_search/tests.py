@@ -1,3 +1,110 @@
-from django.test import TestCase
+import asyncio
+import threading
+from unittest import mock
+from django.test import SimpleTestCase, override_settings
+from django.urls import reverse
+from . import serving
+
+max_concurrency = 1
+max_queue = 2
+
+class Blocking_Retriever:
+    """
+    Stand-in for `Retrieve_Docs` whose queries block until `release` is set, so that concurrent
+    requests pile up behind the admission controller.
+    """
+    batches_queries = False
+
+    def __init__(self):
+        self.release = threading.Event()
+        self.lock = threading.Lock()
+        self.n_runs = 0
+
+    def run(self, query, top_k=None):
+        self.release.wait(timeout=10)
+        with self.lock:
+            self.n_runs += 1
+        return {'retriever_with_embeddings': {'documents': []}}
+
+@override_settings(SEMANTIC_SEARCH={
+    'MAX_CONCURRENCY': max_concurrency, 'MAX_QUEUE': max_queue, 'QUEUE_TIMEOUT_SECONDS': 10.0,
+    'EXECUTOR_WORKERS': 2, 'RESULT_CACHE_ALIAS': None, 'WARM_UP_ON_START': False,
+    })
+class Admission_Control_Test(SimpleTestCase):
+    def setUp(self):
+        self.saved_globals = (serving.admission_controller, serving.retrieval_executor)
+        serving.admission_controller = None
+        serving.retrieval_executor = None
+        self.retriever = Blocking_Retriever()
+        for name, value in (('get_retriever', self.retriever), ('get_cached_collection_version', 0)):
+            patcher = mock.patch.object(serving, name, return_value=value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.retriever.release.set()
+        if serving.retrieval_executor is not None:
+            serving.retrieval_executor.executor.shutdown(wait=True)
+        serving.admission_controller, serving.retrieval_executor = self.saved_globals
+
+    async def fire_misses(self, request, n_requests):
+        """
+        Send `n_requests` distinct queries at once and release the retriever once all of them
+        were either queued or shed.
+        """
+        asyncio.get_running_loop().call_later(0.5, self.retriever.release.set)
+        return await asyncio.gather(
+            *[request(f'muscle protein synthesis {index}') for index in range(n_requests)],
+            return_exceptions=True
+            )
+
+    async def test_burst_of_misses_is_shed(self):
+        n_requests = max_concurrency + max_queue + 3
+        results = await self.fire_misses(serving.get_results_async, n_requests)
+        n_shed = len([result for result in results if isinstance(result, serving.Overloaded)])
+        self.assertEqual(n_shed, n_requests - (max_concurrency + max_queue))
+        self.assertEqual(self.retriever.n_runs, max_concurrency + max_queue)
+        stats = serving.get_admission_controller().stats()
+        self.assertEqual((stats['rejected'], stats['queue_depth'], stats['running']), (n_shed, 0, 0))
+
+    async def test_overloaded_async_view_answers_503(self):
+        n_requests = max_concurrency + max_queue + 3
+        responses = await self.fire_misses(
+            lambda query: self.async_client.get(reverse('semantic_search:retrieve_async', args=[query])),
+            n_requests
+            )
+        status_codes = sorted(response.status_code for response in responses)
+        self.assertEqual(status_codes, [200] * (max_concurrency + max_queue) + [503] * 3)
+        for response in responses:
+            if response.status_code == 503:
+                self.assertEqual(response['Retry-After'], '1')
+
+    async def test_cancelled_caller_does_not_cancel_coalesced_callers(self):
+        # Two distinct queries take both executor workers, so the coalesced query waits in the queue
+        blockers = [asyncio.create_task(serving.get_results_async(f'blocker {index}')) for index in range(2)]
+        await asyncio.sleep(0.1)
+        query = 'muscle protein synthesis'
+        first = asyncio.create_task(serving.get_results_async(query))
+        second = asyncio.create_task(serving.get_results_async(query))
+        await asyncio.sleep(0.1)
+        first.cancel()
+        await asyncio.sleep(0.1)
+        self.retriever.release.set()
+        self.assertEqual(await second, [])
+        with self.assertRaises(asyncio.CancelledError):
+            await first
+        await asyncio.gather(*blockers)
+        self.assertEqual(self.retriever.n_runs, 3)
+
+    async def test_cancelled_queued_retrieval_leaves_the_queue(self):
+        blockers = [asyncio.create_task(serving.get_results_async(f'blocker {index}')) for index in range(2)]
+        await asyncio.sleep(0.1)
+        future = serving.get_retrieval_executor().submit(self.retriever.run, 'muscle protein synthesis')
+        self.assertEqual(serving.get_admission_controller().stats()['queue_depth'], 2)
+        self.assertTrue(future.cancel())
+        self.assertEqual(serving.get_admission_controller().stats()['queue_depth'], 1)
+        self.retriever.release.set()
+        await asyncio.gather(*blockers)
+        stats = serving.get_admission_controller().stats()
+        self.assertEqual((stats['queue_depth'], stats['running']), (0, 0))
 
-# Create your tests here.
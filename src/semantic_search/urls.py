@@ -5,6 +5,9 @@ from . import views
 app_name = 'semantic_search'
 urlpatterns = [
     path("retrieve/<str:query>/", views.retrieve, name="retrieve"),
+    path("retrieve_async/<str:query>/", views.retrieve_async, name="retrieve_async"),
+    path("retrieve_batch", views.retrieve_batch, name="retrieve_batch"),
     path("index", views.index, name="index"),
+    path("health", views.health, name="health"),
     path('test', views.test, name='test'),
 ]
\ No newline at end of file
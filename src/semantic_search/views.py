@@ -1,30 +1,43 @@
 from django.shortcuts import get_object_or_404, render
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST
 import sys
+import json
 sys.path.append(r"/home/silvhua/custom_python")
 from django.http import HttpResponse
 from django.http import Http404
+from django.http import JsonResponse
 from django.template import loader
 from retrieval_pipeline import *
+from .serving import (
+    Overloaded, get_retriever, get_results, get_results_async, get_batch_results, get_health, get_metrics, 
+    get_serving_settings
+    )
+
+def overloaded_response(error, as_json=False):
+    """
+    503 response for retrievals shed by the admission controller.
+    """
+    if as_json:
+        response = JsonResponse({'error': f'Server busy: {error}'}, status=503)
+    else:
+        response = HttpResponse('Server busy, please retry shortly.', status=503)
+    response['Retry-After'] = '1'
+    return response
 
 # Create your views here.
 def retrieve(request, query, collection_name='test_set_5'):
     logger = create_function_logger(__name__, parent_logger=None, level=logging.INFO)
-    retriever = Retrieve_Docs(collection_name, top_k=1, logger=logger)
     results_dict = {
         'query': query
     }
     try:
-        results_list = retriever.run(query)
-        logger.info(f'Results list: {results_list}')
-        parsed_results_list = []
-        for index, result in enumerate(results_list['retriever_with_embeddings'].get('documents', [])):
-            parsed_result = result.meta
-            parsed_result.pop('source_id')
-            parsed_result['score'] = result.score
-            parsed_results_list.append(parsed_result)
-        parsed_results_list = get_unique_dicts(parsed_results_list, keys_to_ignore=['score'])
+        parsed_results_list = get_results(query, collection_name)
         results_dict['results'] = parsed_results_list
         logger.info(parsed_results_list)
+    except Overloaded as error:
+        logger.warning(f'Shed retrieve request: {error}')
+        return overloaded_response(error)
     except Exception as error:
         exc_type, exc_obj, tb = sys.exc_info()
         f = tb.tb_frame
@@ -36,6 +49,83 @@ def retrieve(request, query, collection_name='test_set_5'):
     # return HttpResponse(parsed_results_list)
     # return HttpResponse(f'Hello from `retrieve` function')
 
+async def retrieve_async(request, query, collection_name='test_set_5'):
+    """
+    Async version of `retrieve` for ASGI servers. Embedding and the Chroma query run on the 
+    bounded retrieval executor, and identical concurrent queries share one computation.
+    """
+    logger = create_function_logger(__name__, parent_logger=None, level=logging.INFO)
+    results_dict = {
+        'query': query
+    }
+    try:
+        parsed_results_list = await get_results_async(query, collection_name)
+        results_dict['results'] = parsed_results_list
+        logger.info(parsed_results_list)
+    except Overloaded as error:
+        logger.warning(f'Shed retrieve request: {error}')
+        return overloaded_response(error)
+    except Exception as error:
+        exc_type, exc_obj, tb = sys.exc_info()
+        f = tb.tb_frame
+        lineno = tb.tb_lineno
+        filename = f.f_code.co_filename
+        message = f'An error occurred on line {lineno} in {filename}: {error}.'
+        logger.error(message)
+    return render(request, 'semantic_search/retrieve.html', results_dict)
+
+@csrf_exempt
+@require_POST
+def retrieve_batch(request):
+    """
+    Bulk search endpoint for batch jobs. 
+    
+    Request body (JSON): {"queries": ["...", ...], "collection_name": "test_set_5", "top_k": 5}
+    `collection_name` and `top_k` are optional.
+
+    Returns:
+    JSON {"results": [{"query": "...", "results": [...]}, ...]} in the order of the queries.
+    """
+    logger = create_function_logger(__name__, parent_logger=None, level=logging.INFO)
+    try:
+        body = json.loads(request.body)
+        queries = body['queries']
+        if not isinstance(queries, list) or not all(isinstance(query, str) for query in queries):
+            raise ValueError('`queries` must be a list of strings.')
+        top_k = int(body['top_k']) if body.get('top_k') else None
+    except (ValueError, KeyError, TypeError) as error:
+        return JsonResponse({'error': f'Invalid request: {error}'}, status=400)
+    max_batch_queries = get_serving_settings()['MAX_BATCH_QUERIES']
+    if len(queries) > max_batch_queries:
+        return JsonResponse({'error': f'At most {max_batch_queries} queries per request.'}, status=400)
+    try:
+        results = get_batch_results(queries, body.get('collection_name'), top_k=top_k)
+    except Overloaded as error:
+        logger.warning(f'Shed retrieve_batch request: {error}')
+        return overloaded_response(error, as_json=True)
+    except Exception as error:
+        exc_type, exc_obj, tb = sys.exc_info()
+        f = tb.tb_frame
+        lineno = tb.tb_lineno
+        filename = f.f_code.co_filename
+        message = f'An error occurred on line {lineno} in {filename}: {error}.'
+        logger.error(message)
+        return JsonResponse({'error': 'Retrieval failed.'}, status=500)
+    return JsonResponse({
+        'results': [{'query': query, 'results': query_results} for query, query_results in zip(queries, results)]
+        })
+
+def health(request):
+    """
+    Report whether the retriever of every configured collection is loaded and warm. 
+    Returns status 503 while warming up.
+    """
+    is_warm, status = get_health()
+    return JsonResponse(
+        {'status': 'ok' if is_warm else 'warming', 'collections': status, 'metrics': get_metrics()}, 
+        status=200 if is_warm else 503
+        )
+
 def index(request):
     return HttpResponse("Hello, world. You're at the semantic search index.")
 
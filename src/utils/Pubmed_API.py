@@ -2,19 +2,48 @@ import sys
 import os
 import pandas as pd
 import re
+import time
 import requests
 import sys
 import os
 import requests
 from Custom_Logger import *
+from fetch_engine import *
+from pubmed_cache import *
+from pubmed_parser import *
 import numpy as np
+from concurrent.futures import ProcessPoolExecutor
 api_key = os.getenv('api_ncbi') # Pubmed API key
 
 class Pubmed_API:
-    def __init__(self, api_key=os.getenv('api_ncbi'), logger=None, logging_level=logging.INFO):
+    def __init__(
+            self, api_key=os.getenv('api_ncbi'), efetch_batch_size=200, max_workers=3,
+            base_url=eutils_url, timeout=(10, 60), max_retries=5, backoff_factor=1,
+            record_cache=None, search_cache=None, parser='regex', parse_workers=None, logger=None, logging_level=logging.INFO
+            ):
         """
         Parameters:
         - api_key (str): NCBI API key
+        - efetch_batch_size (int, optional): Number of PMIDs to request per efetch call. 
+            If None or 0, each PMID is requested separately.
+        - max_workers (int, optional): Maximum number of efetch requests in flight at once. 
+            Requests from all instances sharing an API key are kept under the NCBI rate limit
+            (3 requests/second, or 10 with an API key) by a shared token bucket.
+        - base_url (str, optional): E-utilities base URL. Point this at a local stand-in server
+            (see `fetch_engine.start_stand_in_server`) to test without calling NCBI.
+        - timeout (float or tuple, optional): Connect and read timeouts in seconds for each request.
+        - max_retries (int, optional): Number of times to retry a request after a connection error, 
+            timeout, 429 or 5xx response.
+        - backoff_factor (float, optional): Retries wait `backoff_factor * 2**attempt` seconds, 
+            or the number of seconds in the `Retry-After` header if the server sends one.
+        - record_cache (Record_Cache, optional): Persistent cache of record strings keyed by PMID. 
+            Cached PMIDs are not requested again until they expire.
+        - search_cache (Search_Cache, optional): Persistent cache of esearch responses keyed by 
+            the normalized search term and parameters.
+        - parser (str, optional): Default extractor used by `.extract_pubmed_details_df()`: 
+            'regex' or 'xml' (streaming XML parser, see `pubmed_parser.iter_pubmed_articles`).
+        - parse_workers (int, optional): Default number of worker processes used by 
+            `.extract_pubmed_details_df()`. If None or 1, records are parsed in this process.
         ---
         # Example usage
 
@@ -38,6 +67,17 @@ class Pubmed_API:
 
         """
         self.api_key = api_key
+        self.efetch_batch_size = efetch_batch_size
+        self.base_url = base_url
+        self.fetch_engine = Fetch_Engine(token_bucket=get_token_bucket(api_key), max_workers=max_workers)
+        self.session = create_session(pool_maxsize=max_workers)
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.record_cache = record_cache
+        self.search_cache = search_cache
+        self.parser = parser
+        self.parse_workers = parse_workers
         self.logger = create_function_logger('Pubmed_API', logger, level=logging_level)
         self.iteration = 0
         self.responses_dict = {}
@@ -48,7 +88,7 @@ class Pubmed_API:
     def search_article(self, query, query_tag=None, publication=None, reldate=None, retmax=None,
         systematic_only=False, review_only=False, period_filter=None,
         additional_search_params=None, ids_only=False, 
-        verbose=True
+        verbose=True, bypass_cache=False
         ):
         """
         Search for article title in PubMed database.
@@ -61,11 +101,14 @@ class Pubmed_API:
         - retmax (int, optional): Maximum number of results to return. 
             If None, default is 20. API returns a maximum of 9999 results. To get more results for Pubmed,
             need to use the command line: https://www.ncbi.nlm.nih.gov/books/NBK179288/
+            or use `.harvest_articles()` to page through the results with the Entrez history server.
         - systematic_only (bool, optional): If True, filter for only systematic review articles.
         - review_only (bool, optional): If True, filter for only systematic review or review articles.
         - additional_search_params (dict, optional): Additional search parameters to pass to the esearch API.
         - period_filter (1, 5, or 10, optional): Filter for articles published in the past 1, 5, or 10 years.
             Note: To filter by other periods, use `reldate` parameter as that is how the API works.
+        - bypass_cache (bool, optional): If True, call esearch even if `self.search_cache` has an 
+            unexpired response for this search. The new response is still stored in the cache.
             
         Returns:
 
@@ -75,11 +118,57 @@ class Pubmed_API:
 
         Pubmed dataset on hugging face: https://huggingface.co/datasets/pubmed
         """
-        base_url = f'https://eutils.ncbi.nlm.nih.gov/entrez/eutils/esearch.fcgi'
-        if self.api_key:
-            base_url += f'&api_key={self.api_key}'
         response = {}
         results = pd.DataFrame()
+        params = self.build_search_params(
+            query, query_tag=query_tag, publication=publication, reldate=reldate, retmax=retmax,
+            systematic_only=systematic_only, review_only=review_only, period_filter=period_filter,
+            additional_search_params=additional_search_params
+            )
+        messages = []
+        try:
+            self.iteration += 1
+            response_dict = None
+            if self.search_cache and not bypass_cache:
+                response_dict = self.search_cache.get(params)
+            if response_dict is None:
+                response = self.send_request('esearch.fcgi', params)
+                response_dict = response.json()
+                if self.search_cache and is_successful_search(response.status_code, response_dict):
+                    self.search_cache.put(params, response_dict)
+            id_list = response_dict['esearchresult']['idlist']
+            messages.append(f'{len(id_list)} PMIDs found.')
+            if verbose==True:
+                messages.append(f'{id_list}')
+            self.PMIDs_dict[self.iteration] = id_list
+            self.responses_dict[self.iteration] = response_dict
+            if ids_only==False:
+                results = self.get_article_data_by_title()
+            else:
+                results = id_list
+            self.logger.info('\n'.join(messages))
+        except Exception as error:
+            error_messages = []
+            exc_type, exc_obj, tb = sys.exc_info()
+            file = tb.tb_frame
+            lineno = tb.tb_lineno
+            filename = file.f_code.co_filename
+            message = f'\tAn error occurred on line {lineno} in {filename}: {error}'
+            error_messages.append(message)
+            self.logger.error('\n'.join(error_messages))
+        return results
+
+    def build_search_params(self, query, query_tag=None, publication=None, reldate=None, retmax=None,
+        systematic_only=False, review_only=False, period_filter=None,
+        additional_search_params=None
+        ):
+        """
+        Helper function called by `.search_article()` and `.harvest_articles()` to build the esearch 
+        parameters. See `.search_article()` for a description of the parameters.
+
+        Returns:
+        Dictionary of esearch parameters.
+        """
         search_term = f'{re.sub(r"not", "", query)}'  # Remove 'not' since it will be treated as a boolean
         if query_tag:
             search_term += f'{query_tag}'
@@ -104,38 +193,108 @@ class Pubmed_API:
         if additional_search_params:
             params.update(additional_search_params)
         self.logger.info(f'Search term: {search_term}')
+        return params
+
+    def harvest_articles(self, query, page_size=500, max_records=None, **search_kwargs):
+        """
+        Search the PubMed database and yield the article data one page at a time.
+
+        The esearch results are stored on the Entrez history server (`usehistory=y`), and each page 
+        is fetched with efetch using the returned `WebEnv`/`query_key` and `retstart`, so the full 
+        list of PMIDs is never held in `self.PMIDs_dict`. This is the way to harvest result sets 
+        larger than the 9,999 PMIDs esearch returns: https://www.ncbi.nlm.nih.gov/books/NBK25498/#chapter3.Application_3_Retrieving_large
+
+        Parameters:
+        - query (str): Pubmed search query.
+        - page_size (int, optional): Number of records to fetch per efetch call (max 10,000).
+        - max_records (int, optional): Maximum number of records to harvest. If None, all results are harvested.
+        - **search_kwargs: Additional keyword arguments accepted by `.search_article()`, 
+            e.g. `systematic_only`, `period_filter`, `reldate`.
+
+        Yields:
+        DataFrame of the Pubmed article details for each page, in the order of the search results.
+
+        # Example usage
+
+        api = Pubmed_API()
+        for df in api.harvest_articles(query, page_size=500):
+            save_to_json(df.to_dict(orient='records'), ...)
+        """
+        search_kwargs.pop('retmax', None)
+        params = self.build_search_params(query, **search_kwargs)
+        params.update({'usehistory': 'y', 'retmax': 0})
+        self.iteration += 1
+        iteration = self.iteration
         messages = []
+        messages.append(f'***Running `harvest_articles` with iteration {iteration}***')
         try:
-            self.iteration += 1
-            response = requests.get(base_url, params=params)
-            response_dict = response.json()
-            id_list = response_dict['esearchresult']['idlist']
-            messages.append(f'{len(id_list)} PMIDs found.')
-            if verbose==True:
-                messages.append(f'{id_list}')
-            self.PMIDs_dict[self.iteration] = id_list
-            self.responses_dict[self.iteration] = response_dict
-            if ids_only==False:
-                results = self.get_article_data_by_title()
-            else:
-                results = id_list
-            self.logger.info('\n'.join(messages))
+            response_dict = self.send_request('esearch.fcgi', params).json()
+            self.responses_dict[iteration] = response_dict
+            esearch_result = response_dict['esearchresult']
+            count = int(esearch_result['count'])
+            if max_records:
+                count = min(count, max_records)
+            history_params = {
+                'db': 'pubmed',
+                'WebEnv': esearch_result['webenv'],
+                'query_key': esearch_result['querykey'],
+                'retmode': 'xml',
+            }
+            messages.append(f'{esearch_result["count"]} PMIDs found. Harvesting {count} in pages of {page_size}.')
         except Exception as error:
-            error_messages = []
             exc_type, exc_obj, tb = sys.exc_info()
             file = tb.tb_frame
             lineno = tb.tb_lineno
             filename = file.f_code.co_filename
-            message = f'\tAn error occurred on line {lineno} in {filename}: {error}'
-            error_messages.append(message)
-            self.logger.error('\n'.join(error_messages))
-        return results
+            messages.append(f'\tAn error occurred on line {lineno} in {filename}: {error}')
+            self.logger.error('\n'.join(messages))
+            return
+        self.logger.info('\n'.join(messages))
 
-    def get_article_data_by_title(self, iteration=None, orient='records'):
+        def fetch_page(retstart):
+            return retstart, self.retrieve_history_page(
+                history_params, retstart, min(page_size, count - retstart)
+                )
+
+        harvested = 0
+        for retstart, record_strings in self.fetch_engine.map(fetch_page, range(0, count, page_size)):
+            if not record_strings:
+                continue
+            harvested += len(record_strings)
+            self.logger.info(f'Page at retstart {retstart}: {len(record_strings)} records ({harvested}/{count}).')
+            yield self.extract_pubmed_details_df(record_strings=record_strings)
+
+    def retrieve_history_page(self, history_params, retstart, retmax):
+        """
+        Helper function called by `.harvest_articles()` to fetch one page of records from the 
+        Entrez history server.
+
+        Returns:
+        List of record strings, one per article. Empty if the page could not be retrieved.
+        """
+        try:
+            params = dict(history_params, retstart=retstart, retmax=retmax)
+            response = self.send_request('efetch.fcgi', params, method='post')
+            record_strings = split_pubmed_article_set(response.content.decode('utf-8'))
+            if self.record_cache:
+                self.merge_cached_records([], {}, record_strings)
+            return record_strings
+        except Exception as error:
+            exc_type, exc_obj, tb = sys.exc_info()
+            file = tb.tb_frame
+            lineno = tb.tb_lineno
+            filename = file.f_code.co_filename
+            self.logger.error(
+                f'\tAn error occurred on line {lineno} in {filename}: {error}\n'
+                f'Page at retstart {retstart} not retrieved.'
+                )
+            return []
+
+    def get_article_data_by_title(self, iteration=None, orient='records', batch_size=None):
         result_df = pd.DataFrame()
         try:
             iteration = self.iteration if iteration == None else iteration
-            record_strings_list = self.batch_retrieve_citation(iteration)
+            record_strings_list = self.batch_retrieve_citation(iteration, batch_size=batch_size)
             self.record_strings_dict[iteration] = record_strings_list
             result_df = self.extract_pubmed_details_df(iteration)
             self.results_dict[iteration] = result_df.to_dict(orient=orient)
@@ -151,24 +310,65 @@ class Pubmed_API:
             self.logger.error('\n'.join(error_messages))
         return result_df
 
-    def batch_retrieve_citation(self, iteration):
+    def batch_retrieve_citation(self, iteration, batch_size=None):
+        """
+        Retrieve the records for the PMIDs of the given iteration.
+
+        Parameters:
+        - iteration (int): Iteration whose PMIDs to retrieve.
+        - batch_size (int, optional): Number of PMIDs per efetch call. 
+            If None, `self.efetch_batch_size` is used. If 0, each PMID is requested separately.
+
+        Returns:
+        List of record strings, one per article.
+        """
         result_list = []
         messages = []
         messages.append(f'***Running `batch_retrieve_citation` with iteration {iteration}***')
+        batch_size = self.efetch_batch_size if batch_size is None else batch_size
+        current_index, current_id = 0, None
+        cached_records = {}
         try:
             id_list = self.PMIDs_dict.get(iteration)
-            if id_list:
+            if id_list and self.record_cache:
+                cached_records = self.record_cache.get_many(id_list)
+                messages.append(f'{len(cached_records)} of {len(id_list)} PMIDs found in the record cache.')
+                id_list = [id for id in id_list if str(id) not in cached_records]
+            if id_list and batch_size:
+                messages.append(f'Extracting {len(id_list)} PMIDs from iteration {iteration} in batches of {batch_size}.')
+                batches = [id_list[index:index+batch_size] for index in range(0, len(id_list), batch_size)]
+                responses = self.fetch_engine.map(
+                    lambda batch: self.try_retrieve(self.retrieve_citations, batch, messages), batches
+                    )
+                for index, (batch, content) in enumerate(zip(batches, responses)):
+                    current_index, current_id = index*batch_size+1, batch[0]
+                    if content is None:
+                        messages.append(f'Batch starting at article {current_index} [{current_id}] not found.')
+                        continue
+                    record_strings = split_pubmed_article_set(content.decode('utf-8'))
+                    if len(record_strings) != len(batch):
+                        messages.append(
+                            f'Batch starting at article {current_index} [{current_id}]: '
+                            f'{len(record_strings)} records returned for {len(batch)} PMIDs.'
+                            )
+                    result_list.extend(record_strings)
+                    self.logger.debug(f'Fetched batch {index+1} of {len(batches)}.')
+                messages.append("Processing complete.")
+            elif id_list:
                 messages.append(f'Extracting {len(id_list)} PMIDs from iteration {iteration}.')
-                for index, id in enumerate(id_list):
-                    result_list.append(self.retrieve_citation(id).decode('utf-8'))
+                responses = self.fetch_engine.map(
+                    lambda id: self.try_retrieve(self.retrieve_citation, id, messages), id_list
+                    )
+                for index, (id, content) in enumerate(zip(id_list, responses)):
                     current_index, current_id = index+1, id
-                    # Show progress 
-                    indicator = '.'
+                    if content is None:
+                        messages.append(f'Article {current_index} [{current_id}] not found.')
+                        continue
+                    result_list.append(content.decode('utf-8'))
                     if current_index % 10 == 0:
-                        indicator+='|'
-                    print(indicator, end='\n' if current_index%2==100 else '')
+                        self.logger.debug(f'Fetched {current_index} of {len(id_list)} articles.')
                 messages.append("Processing complete.")
-            else:
+            elif not cached_records:
                 self.logger.warning(f'No results found.')
         except Exception as error:
             messages.append(f'Response: \n{self.responses_dict.get(iteration)}')
@@ -178,30 +378,142 @@ class Pubmed_API:
             filename = file.f_code.co_filename
             messages.append(f'\tAn error occurred on line {lineno} in {filename}: {error}')
             messages.append(f'Article {current_index} [{current_id}] not found.')
+        if self.record_cache and self.PMIDs_dict.get(iteration):
+            result_list = self.merge_cached_records(self.PMIDs_dict.get(iteration), cached_records, result_list)
         self.logger.info('\n'.join(messages))
         return result_list
 
-    def retrieve_citation(self, article_id):
-        base_url = f'https://eutils.ncbi.nlm.nih.gov/entrez/eutils/efetch.fcgi'
+    def merge_cached_records(self, id_list, cached_records, fetched_records):
+        """
+        Helper function called by `.batch_retrieve_citation()` to store the fetched records in the 
+        record cache and combine them with the cached records in the order of `id_list`.
+
+        Returns:
+        List of record strings.
+        """
+        fetched_dict = {}
+        for record_string in fetched_records:
+            pmid = pmid_regex.search(record_string)
+            if pmid:
+                fetched_dict[pmid.group(1)] = record_string
+        if fetched_dict:
+            self.record_cache.put_many(fetched_dict)
+        result_list = []
+        for id in id_list:
+            id = str(id)
+            record_string = cached_records.get(id, fetched_dict.pop(id, None))
+            if record_string is not None:
+                result_list.append(record_string)
+        # Records returned under a different PMID than requested, e.g. merged citations
+        result_list.extend(fetched_dict.values())
+        return result_list
+
+    def try_retrieve(self, function, item, messages):
+        """
+        Helper function called by `.batch_retrieve_citation()` so that a request that still fails 
+        after its retries is logged instead of aborting the remaining requests.
+
+        Returns:
+        The response content, or None if the request failed.
+        """
+        try:
+            return function(item)
+        except Exception as error:
+            messages.append(f'\tRequest failed after {self.max_retries} retries: {error}')
+            return None
+
+    def send_request(self, endpoint, params, method='get'):
+        """
+        Send a request to an E-utilities endpoint once the shared token bucket allows it.
+        Connection errors, timeouts, 429 and 5xx responses are retried with exponential backoff, 
+        honouring the `Retry-After` header. Each retry waits for its own token.
+
+        Parameters:
+        - endpoint (str): E-utilities endpoint, e.g. 'esearch.fcgi'.
+        - params (dict): Request parameters. The API key is added if available.
+        - method (str, optional): 'get' or 'post'. POST parameters are sent in the request body.
+
+        Returns:
+        requests.Response
+        """
+        params = dict(params)
         if self.api_key:
-            base_url += f'&api_key={self.api_key}'
+            params['api_key'] = self.api_key
+        url = f'{self.base_url}{endpoint}'
+        for attempt in range(self.max_retries + 1):
+            self.fetch_engine.acquire()
+            try:
+                if method == 'post':
+                    response = self.session.post(url, data=params, timeout=self.timeout)
+                else:
+                    response = self.session.get(url, params=params, timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout) as error:
+                if attempt == self.max_retries:
+                    raise
+                wait = self.backoff_factor * 2**attempt
+                self.logger.warning(f'{endpoint} request failed ({error}). Retrying in {wait} seconds.')
+                time.sleep(wait)
+                continue
+            if (response.status_code in retry_status_codes) and (attempt < self.max_retries):
+                wait = get_retry_after(response, default=self.backoff_factor * 2**attempt)
+                self.logger.warning(f'{endpoint} returned status {response.status_code}. Retrying in {wait} seconds.')
+                time.sleep(wait)
+                continue
+            response.raise_for_status()
+            return response
+
+    def retrieve_citation(self, article_id):
         params = {
             'db': 'pubmed',
             'id': article_id
         }
-        response = requests.get(base_url, params=params)
+        response = self.send_request('efetch.fcgi', params)
         return response.content
 
-    def extract_pubmed_details_df(self, iteration=None):
+    def retrieve_citations(self, id_list):
+        """
+        Retrieve the records for a list of PMIDs with a single efetch call.
+        The IDs are sent in the body of a POST request, as recommended for more than ~200 IDs:
+        https://www.ncbi.nlm.nih.gov/books/NBK25499/#chapter4.EFetch
+
+        Returns:
+        The `PubmedArticleSet` XML response content.
+        """
+        data = {
+            'db': 'pubmed',
+            'id': ','.join(map(str, id_list)),
+            'retmode': 'xml'
+        }
+        response = self.send_request('efetch.fcgi', data, method='post')
+        return response.content
+
+    def extract_pubmed_details_df(self, iteration=None, record_strings=None, parser=None, n_jobs=None):
         """
         Extract the Pubmed article details for the given list of record strings for the given iteration.
 
+        Parameters:
+        - iteration (int, optional): Iteration whose record strings to parse. Defaults to the latest iteration.
+        - record_strings (list, optional): Record strings to parse instead of those stored in 
+            `self.record_strings_dict`.
+        - parser (str, optional): 'regex' or 'xml'. If None, `self.parser` is used.
+        - n_jobs (int, optional): Number of worker processes. The record strings are split into 
+            contiguous shards that are parsed in parallel and concatenated in their original order.
+            If None, `self.parse_workers` is used.
+
         Returns:
         DataFrame of the Pubmed article details.
         """
         df = pd.DataFrame()
         self.logger.info('***Running `.extract_pubmed_details_df`***')
-        record_strings = pd.Series(self.record_strings_dict.get(iteration if iteration else self.iteration))
+        if record_strings is None:
+            record_strings = self.record_strings_dict.get(iteration if iteration else self.iteration)
+        parser = parser if parser else self.parser
+        n_jobs = n_jobs if n_jobs else self.parse_workers
+        if n_jobs and n_jobs > 1 and record_strings is not None and len(record_strings) > n_jobs:
+            return self.extract_pubmed_details_parallel(record_strings, parser, n_jobs)
+        if parser == 'xml':
+            return extract_pubmed_details_xml(record_strings, logger=self.logger)
+        record_strings = pd.Series(record_strings)
         regex_dict = {
             'article_title': r'<ArticleTitle>(.*?)</ArticleTitle>',
             'pmid': r'<PMID.*?>(.*?)</PMID>',
@@ -268,6 +580,23 @@ class Pubmed_API:
         df = df[columns].replace({np.nan: None})
         return df
 
+    def extract_pubmed_details_parallel(self, record_strings, parser, n_jobs, shards_per_job=4):
+        """
+        Helper function called by `.extract_pubmed_details_df()` to parse shards of the record 
+        strings on a process pool. Each job gets several smaller shards so that uneven shards 
+        do not leave workers idle.
+
+        Returns:
+        DataFrame of the Pubmed article details in the order of `record_strings`.
+        """
+        record_strings = list(record_strings)
+        shard_size = -(-len(record_strings) // (n_jobs * shards_per_job))
+        shards = [record_strings[index:index+shard_size] for index in range(0, len(record_strings), shard_size)]
+        self.logger.info(f'Parsing {len(record_strings)} records in {len(shards)} shards on {n_jobs} processes.')
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            df_list = list(executor.map(parse_record_shard, shards, [parser] * len(shards)))
+        return pd.concat(df_list, ignore_index=True)
+
     def df_extractall(self, 
             series, regex, parent_regex=None, nested_regex=None, sep=[' ', ' / '], 
             join_strings=False, logger=None
@@ -455,6 +784,28 @@ class Pubmed_API:
         }
 
 #################
+shard_parser = None
+
+def parse_record_shard(record_strings, parser='regex'):
+    """
+    Parse one shard of record strings in a worker process of `Pubmed_API.extract_pubmed_details_parallel`.
+    The `Pubmed_API` instance used for parsing is created once per worker process.
+    """
+    global shard_parser
+    if shard_parser is None:
+        shard_parser = Pubmed_API(max_workers=1, logging_level=logging.WARNING)
+    return shard_parser.extract_pubmed_details_df(record_strings=record_strings, parser=parser, n_jobs=1)
+
+def split_pubmed_article_set(xml_string):
+    """
+    Split an efetch `PubmedArticleSet` XML string into a list of record strings, one per 
+    `PubmedArticle` (or `PubmedBookArticle`), in the order they appear in the response.
+    """
+    return [match.group(0) for match in article_regex.finditer(xml_string)]
+
+article_regex = re.compile(r'<(PubmedArticle|PubmedBookArticle)>.*?</\1>', re.DOTALL)
+pmid_regex = re.compile(r'<PMID[^>]*>(\d+)</PMID>')
+
 def concat_columns(df, columns, new_column, sep='; ', drop_columns=False,
     logger=None
     ):
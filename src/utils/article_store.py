@@ -0,0 +1,201 @@
+import os
+import sys
+import json
+from Custom_Logger import *
+from pubmed_parser import pubmed_columns, list_columns
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+def check_pyarrow():
+    if pa is None:
+        raise ImportError('pyarrow is required to read or write Parquet article files: `pip install pyarrow`')
+
+def get_article_schema():
+    """
+    Arrow schema of the article files: one string column per article detail and native list
+    columns for `authors`, `mesh_headings`, `keywords`, `major_topics` and `publication_type`.
+    """
+    check_pyarrow()
+    return pa.schema([
+        (column, pa.list_(pa.string()) if column in list_columns else pa.string())
+        for column in pubmed_columns
+        ])
+
+def clean_article_row(row):
+    """
+    Helper function called by `Article_Parquet_Writer.write_rows` to coerce a row of
+    `Pubmed_API.extract_pubmed_details_df` to the article schema.
+    """
+    cleaned_row = {}
+    for column in pubmed_columns:
+        value = row.get(column)
+        if value is None or value != value:  # None or NaN
+            cleaned_row[column] = None
+        elif column in list_columns:
+            cleaned_row[column] = [str(item) for item in value] if isinstance(value, (list, tuple)) else [str(value)]
+        else:
+            cleaned_row[column] = str(value)
+    return cleaned_row
+
+class Article_Parquet_Writer:
+    def __init__(self, path, row_group_size=10000, compression='zstd'):
+        """
+        Write article dictionaries to a Parquet file in batches, so that the harvester never holds
+        more than one batch in memory.
+
+        # Example usage
+
+        with Article_Parquet_Writer('../data/articles.parquet') as writer:
+            for df in api.harvest_articles(query):
+                writer.write_rows(df.to_dict(orient='records'))
+        """
+        check_pyarrow()
+        self.path = path
+        self.row_group_size = row_group_size
+        self.schema = get_article_schema()
+        self.writer = pq.ParquetWriter(path, self.schema, compression=compression)
+        self.n_rows = 0
+
+    def write_rows(self, rows):
+        if not rows:
+            return
+        table = pa.Table.from_pylist([clean_article_row(row) for row in rows], schema=self.schema)
+        self.writer.write_table(table, row_group_size=self.row_group_size)
+        self.n_rows += len(rows)
+
+    def close(self):
+        self.writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+def write_articles_parquet(row_batches, path, row_group_size=10000):
+    """
+    Write batches of article dictionaries to a Parquet file.
+
+    Parameters:
+    - row_batches (iterable): Lists of article dictionaries, e.g. from `Pubmed_API.harvest_articles`.
+    - path (str): Output path.
+
+    Returns:
+    Number of articles written.
+    """
+    with Article_Parquet_Writer(path, row_group_size=row_group_size) as writer:
+        for rows in row_batches:
+            writer.write_rows(rows)
+    return writer.n_rows
+
+def harvest_to_parquet(api, query, path, page_size=500, max_records=None, logger=None, **search_kwargs):
+    """
+    Harvest the results of a PubMed search straight to a Parquet article file.
+    See `Pubmed_API.harvest_articles` for the parameters.
+
+    Returns:
+    Number of articles written.
+    """
+    logger = create_function_logger('harvest_to_parquet', logger)
+    row_batches = (
+        df.to_dict(orient='records')
+        for df in api.harvest_articles(query, page_size=page_size, max_records=max_records, **search_kwargs)
+        )
+    n_rows = write_articles_parquet(row_batches, path)
+    logger.info(f'Wrote {n_rows} articles to {path}.')
+    return n_rows
+
+def count_parquet_rows(path):
+    """
+    Return the number of articles in a Parquet article file from its footer, without reading any data.
+    """
+    check_pyarrow()
+    return pq.ParquetFile(path).metadata.num_rows
+
+def iter_parquet_batches(path, columns=None, batch_size=10000):
+    """
+    Read a Parquet article file in record batches through a memory map, loading only `columns`.
+
+    Yields:
+    Lists of article dictionaries. List columns are returned as Python lists.
+    """
+    check_pyarrow()
+    parquet_file = pq.ParquetFile(path, memory_map=True)
+    if columns:
+        available_columns = set(parquet_file.schema_arrow.names)
+        columns = [column for column in dict.fromkeys(columns) if column in available_columns]
+    for record_batch in parquet_file.iter_batches(batch_size=batch_size, columns=columns):
+        yield record_batch.to_pylist()
+
+# Article store written by `bulk_ingest`: article shards at the top of the folder, and the PMIDs 
+# of `DeleteCitation` elements in a reserved subfolder so that they are never read as articles
+deleted_folder_name = 'deleted'
+deleted_suffix = '_deleted'
+shard_extensions = ('.json', '.parquet')
+
+def get_deleted_path(store_path, file_name):
+    """
+    Path of the tombstone shard listing the PMIDs deleted by the PubMed file `file_name`.
+    """
+    return os.path.join(store_path, deleted_folder_name, f'{file_name}{deleted_suffix}.json')
+
+def list_article_shards(store_path):
+    """
+    Return the sorted paths of the article shards of a store. Subfolders, including the tombstone 
+    folder, are skipped, as are `*_deleted.json` tombstones left at the top of older stores.
+    """
+    return sorted(
+        os.path.join(store_path, name) for name in os.listdir(store_path)
+        if name.endswith(shard_extensions) and not name.endswith(f'{deleted_suffix}.json')
+        and os.path.isfile(os.path.join(store_path, name))
+        )
+
+def iter_articles(store_path, columns=None, batch_size=10000):
+    """
+    Yield the articles of every shard of a store in batches, in shard order. Tombstones are not 
+    read; use `read_deleted_pmids` for them.
+
+    Parameters:
+    - store_path (str): Folder written by `bulk_ingest.ingest_files`.
+    - columns (list, optional): Columns to read from Parquet shards.
+    - batch_size (int, optional): Number of articles per batch.
+
+    Yields:
+    Lists of article dictionaries.
+    """
+    for shard_path in list_article_shards(store_path):
+        if shard_path.endswith('.parquet'):
+            yield from iter_parquet_batches(shard_path, columns=columns, batch_size=batch_size)
+        else:
+            with open(shard_path) as file:
+                rows = json.load(file)
+            for index in range(0, len(rows), batch_size):
+                yield rows[index:index+batch_size]
+
+def read_deleted_pmids(store_path):
+    """
+    Returns:
+    List of the PMIDs in the tombstone shards of a store, e.g. for `Index_Docs.run_incremental`.
+    """
+    deleted_path = os.path.join(store_path, deleted_folder_name)
+    if not os.path.isdir(deleted_path):
+        return []
+    deleted_pmids = []
+    for name in sorted(os.listdir(deleted_path)):
+        if name.endswith(f'{deleted_suffix}.json'):
+            with open(os.path.join(deleted_path, name)) as file:
+                deleted_pmids.extend(json.load(file))
+    return deleted_pmids
+
+if __name__ == "__main__":
+    from Pubmed_API import Pubmed_API
+    logger = create_function_logger(__name__, parent_logger=None, level=logging.INFO)
+    logger.info(f'System arguments: {sys.argv[1:]}')
+    query = sys.argv[1]
+    path = sys.argv[2]
+    max_records = int(sys.argv[3]) if len(sys.argv) > 3 else None
+    harvest_to_parquet(Pubmed_API(logger=logger), query, path, max_records=max_records, logger=logger)
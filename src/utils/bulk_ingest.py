@@ -0,0 +1,163 @@
+import os
+import sys
+import glob
+import gzip
+import json
+import time
+from concurrent.futures import ProcessPoolExecutor
+from Custom_Logger import *
+from pubmed_parser import *
+from article_store import *
+
+def open_pubmed_file(path):
+    """
+    Open a PubMed baseline/update XML file, decompressing it if it is gzip'd.
+    """
+    return gzip.open(path, 'rb') if path.endswith('.gz') else open(path, 'rb')
+
+def write_shard(rows, output_path, shard_name, output_format='json'):
+    if output_format == 'parquet':
+        shard_path = os.path.join(output_path, f'{shard_name}.parquet')
+        write_articles_parquet([rows], shard_path)
+        return shard_path
+    shard_path = os.path.join(output_path, f'{shard_name}.json')
+    with open(shard_path, 'w') as file:
+        json.dump(rows, file)
+    return shard_path
+
+def ingest_file(path, output_path, shard_size=10000, output_format='json', logger=None):
+    """
+    Stream-parse one PubMed baseline/update file and write its articles to JSON or Parquet shards 
+    of at most `shard_size` articles, with the same schema as `Pubmed_API.extract_pubmed_details_df`. 
+    The shards can be indexed with `Index_Docs(shard_filename, output_path, ...)`.
+
+    PMIDs listed in the `DeleteCitation` element of update files are written to 
+    `deleted/<file name>_deleted.json`, outside the article shards (see `iter_articles` and 
+    `read_deleted_pmids`).
+
+    Parameters:
+    - path (str): Path of the `.xml` or `.xml.gz` file.
+    - output_path (str): Folder to write the shards to.
+    - shard_size (int, optional): Maximum number of articles per shard.
+    - output_format (str, optional): 'json' or 'parquet'.
+
+    Returns:
+    Dictionary with the number of articles, the shard paths and the number of deleted PMIDs.
+    """
+    logger = create_function_logger('ingest_file', logger)
+    os.makedirs(output_path, exist_ok=True)
+    file_name = os.path.basename(path).split('.')[0]
+    start = time.perf_counter()
+    shard_paths = []
+    deleted_pmids = []
+    rows = []
+    n_articles = 0
+    with open_pubmed_file(path) as source:
+        for row in iter_pubmed_articles(source, deleted_pmids=deleted_pmids):
+            rows.append(row)
+            n_articles += 1
+            if len(rows) >= shard_size:
+                shard_paths.append(write_shard(rows, output_path, f'{file_name}_{len(shard_paths):04d}', output_format))
+                rows = []
+    if rows:
+        shard_paths.append(write_shard(rows, output_path, f'{file_name}_{len(shard_paths):04d}', output_format))
+    if deleted_pmids:
+        deleted_path = get_deleted_path(output_path, file_name)
+        os.makedirs(os.path.dirname(deleted_path), exist_ok=True)
+        with open(deleted_path, 'w') as file:
+            json.dump(deleted_pmids, file)
+    elapsed = time.perf_counter() - start
+    logger.info(f'{path}: {n_articles} articles in {len(shard_paths)} shards ({elapsed:.1f} seconds).')
+    return {
+        'path': path, 'articles': n_articles, 'shards': shard_paths,
+        'deleted': len(deleted_pmids), 'seconds': elapsed
+        }
+
+def ingest_file_worker(arguments):
+    path, output_path, shard_size, output_format = arguments
+    return ingest_file(path, output_path, shard_size=shard_size, output_format=output_format)
+
+def ingest_files(paths, output_path, n_jobs=None, shard_size=10000, output_format='json', logger=None):
+    """
+    Ingest several PubMed baseline/update files in parallel, one file per worker process.
+    Update files should be ingested after the baseline so that later versions of an article
+    are indexed last.
+
+    Parameters:
+    - paths (list or str): File paths, or a glob pattern such as 'pubmed24n*.xml.gz'.
+    - output_path (str): Folder to write the shards to.
+    - n_jobs (int, optional): Number of worker processes. Defaults to the number of CPUs.
+    - shard_size (int, optional): Maximum number of articles per shard.
+    - output_format (str, optional): 'json' or 'parquet'.
+
+    Returns:
+    List of the results of `ingest_file` for each file, in the order of `paths`.
+    """
+    logger = create_function_logger('ingest_files', logger)
+    paths = sorted(glob.glob(paths)) if isinstance(paths, str) else list(paths)
+    n_jobs = n_jobs if n_jobs else os.cpu_count()
+    logger.info(f'Ingesting {len(paths)} files on {n_jobs} processes.')
+    start = time.perf_counter()
+    arguments = [(path, output_path, shard_size, output_format) for path in paths]
+    if n_jobs == 1:
+        results = [ingest_file_worker(argument) for argument in arguments]
+    else:
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            results = list(executor.map(ingest_file_worker, arguments))
+    elapsed = time.perf_counter() - start
+    n_articles = sum(result['articles'] for result in results)
+    logger.info(f'Ingested {n_articles} articles in {elapsed:.1f} seconds ({n_articles / elapsed:.0f} articles/sec).')
+    return results
+
+#################
+def write_synthetic_baseline(path, n_articles=30000, start_pmid=1):
+    """
+    Write a gzip'd `PubmedArticleSet` file of synthetic articles in the baseline file format.
+    """
+    with gzip.open(path, 'wt', encoding='utf-8') as file:
+        file.write('<?xml version="1.0" ?>\n<!DOCTYPE PubmedArticleSet PUBLIC "-//NLM//DTD PubMedArticle, 1st January 2024//EN" "https://dtd.nlm.nih.gov/ncbi/pubmed/out/pubmed_240101.dtd">\n<PubmedArticleSet>\n')
+        for pmid in range(start_pmid, start_pmid + n_articles):
+            file.write(make_synthetic_record(pmid))
+            file.write('\n')
+        file.write('</PubmedArticleSet>\n')
+    return path
+
+def benchmark_bulk_ingest(
+        folder, n_files=4, n_articles=30000, n_jobs_list=[1, 2, 4], shard_size=10000, logger=None
+        ):
+    """
+    Generate `n_files` synthetic baseline files in `folder` and time their ingestion with
+    each number of worker processes in `n_jobs_list`.
+
+    Returns:
+    Dictionary mapping the number of worker processes to the ingest rate in articles/sec.
+    """
+    logger = create_function_logger('benchmark_bulk_ingest', logger)
+    os.makedirs(folder, exist_ok=True)
+    paths = [
+        write_synthetic_baseline(
+            os.path.join(folder, f'synthetic{index:04d}.xml.gz'), n_articles=n_articles,
+            start_pmid=index * n_articles + 1
+            )
+        for index in range(n_files)
+        ]
+    results = {}
+    for n_jobs in n_jobs_list:
+        start = time.perf_counter()
+        ingest_files(paths, os.path.join(folder, f'shards_{n_jobs}'), n_jobs=n_jobs, shard_size=shard_size, logger=logger)
+        results[n_jobs] = round(n_files * n_articles / (time.perf_counter() - start))
+    logger.info(f'Bulk ingest articles/sec by number of processes: {results}')
+    return results
+
+if __name__ == "__main__":
+    logger = create_function_logger(__name__, parent_logger=None, level=logging.INFO)
+    logger.info(f'System arguments: {sys.argv[1:]}')
+    input_pattern = sys.argv[1]
+    output_path = sys.argv[2]
+    n_jobs = int(sys.argv[3]) if len(sys.argv) > 3 else None
+    shard_size = int(sys.argv[4]) if len(sys.argv) > 4 else 10000
+    output_format = sys.argv[5] if len(sys.argv) > 5 else 'json'
+    ingest_files(
+        input_pattern, output_path, n_jobs=n_jobs, shard_size=shard_size,
+        output_format=output_format, logger=logger
+        )
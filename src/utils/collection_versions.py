@@ -0,0 +1,107 @@
+import os
+import time
+import threading
+from typing import List
+from haystack import component, Document
+from Custom_Logger import *
+from pubmed_cache import connect_cache_db
+
+def get_versions_path(persist_path='../data/processed/'):
+    return os.path.join(persist_path, 'collection_versions.sqlite3')
+
+class Collection_Versions:
+    def __init__(self, db_path=get_versions_path(), logger=None, logging_level=logging.INFO):
+        """
+        Version counter of each Chroma collection, bumped whenever the indexing pipeline writes to
+        or deletes from the collection. Caches of query results include the version in their keys,
+        so results computed before a write are never served after it.
+
+        Every bump also replaces a stamp file next to the database, so that readers can tell with 
+        one `stat` call whether any version changed since they last read it (see `get_stamp`).
+
+        Parameters:
+        - db_path (str, optional): Path to the SQLite database, next to the Chroma persist path.
+        """
+        self.logger = create_function_logger('Collection_Versions', logger, level=logging_level)
+        self.db_path = db_path
+        self.stamp_path = f'{db_path}.stamp'
+        self.lock = threading.Lock()
+        self.connection = connect_cache_db(db_path)
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS collection_versions (
+                collection_name TEXT PRIMARY KEY,
+                version INTEGER NOT NULL,
+                updated_at REAL NOT NULL
+            )
+        """)
+
+    def get(self, collection_name):
+        """
+        Returns:
+        Current version of the collection, 0 if it was never bumped.
+        """
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT version FROM collection_versions WHERE collection_name = ?', (collection_name,)
+                ).fetchone()
+        return row[0] if row else 0
+
+    def get_stamp(self):
+        """
+        Returns:
+        (inode, modification time in ns) of the stamp file, None if no version was ever bumped. 
+        The stamp file is replaced on every bump, so the value changes even within one clock tick.
+        """
+        try:
+            stat = os.stat(self.stamp_path)
+        except FileNotFoundError:
+            return None
+        return (stat.st_ino, stat.st_mtime_ns)
+
+    def touch_stamp(self, collection_name, version):
+        temporary_path = f'{self.stamp_path}.{os.getpid()}.{threading.get_ident()}'
+        with open(temporary_path, 'w') as file:
+            file.write(f'{collection_name} {version}\n')
+        os.replace(temporary_path, self.stamp_path)
+
+    def bump(self, collection_name):
+        """
+        Returns:
+        New version of the collection.
+        """
+        with self.lock:
+            self.connection.execute(
+                """INSERT INTO collection_versions (collection_name, version, updated_at) VALUES (?, 1, ?)
+                ON CONFLICT(collection_name) DO UPDATE SET version = version + 1, updated_at = excluded.updated_at""",
+                (collection_name, time.time())
+                )
+            version = self.connection.execute(
+                'SELECT version FROM collection_versions WHERE collection_name = ?', (collection_name,)
+                ).fetchone()[0]
+            self.touch_stamp(collection_name, version)
+        self.logger.debug(f'Collection `{collection_name}` is now at version {version}.')
+        return version
+
+@component
+class Versioned_Document_Writer:
+    def __init__(self, writer, collection_versions, collection_name):
+        """
+        Wrap a `DocumentWriter` so that the version of the collection is bumped after every write.
+
+        Parameters:
+        - writer (DocumentWriter): Writer of the collection.
+        - collection_versions (Collection_Versions): Version counters.
+        - collection_name (str): Name of the collection the writer writes to.
+        """
+        self.writer = writer
+        self.collection_versions = collection_versions
+        self.collection_name = collection_name
+
+    def bump_version(self):
+        return self.collection_versions.bump(self.collection_name)
+
+    @component.output_types(documents_written=int)
+    def run(self, documents: List[Document]):
+        result = self.writer.run(documents=documents)
+        self.bump_version()
+        return result
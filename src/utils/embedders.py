@@ -0,0 +1,513 @@
+import os
+import sys
+import time
+import hashlib
+import threading
+import unicodedata
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from typing import List
+import numpy as np
+from haystack import component, Document
+from Custom_Logger import *
+from pubmed_cache import connect_cache_db, default_cache_path
+
+def prepare_texts_to_embed(
+        documents, meta_fields_to_embed=None, embedding_separator='\n', prefix='', suffix=''
+        ):
+    """
+    Build the text that `SentenceTransformersDocumentEmbedder` embeds for each document: the
+    values of `meta_fields_to_embed` and the content joined by `embedding_separator`.
+    """
+    texts = []
+    for document in documents:
+        meta_values_to_embed = [
+            str(document.meta[key]) for key in (meta_fields_to_embed or [])
+            if key in document.meta and document.meta[key]
+            ]
+        texts.append(prefix + embedding_separator.join(meta_values_to_embed + [document.content or '']) + suffix)
+    return texts
+
+def hash_text(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+class Embedding_Cache:
+    def __init__(
+            self, db_path=f'{default_cache_path}embeddings.sqlite3', max_entries=5_000_000,
+            logger=None, logging_level=logging.INFO
+            ):
+        """
+        Persistent cache of embeddings keyed by (model id, SHA-256 of the embedded text), shared by
+        every indexing run and collection that uses the same model.
+
+        Parameters:
+        - db_path (str, optional): Path to the SQLite database.
+        - max_entries (int, optional): Maximum number of embeddings. The least recently used
+            embeddings are evicted beyond this. If None, the cache is unbounded.
+        """
+        self.logger = create_function_logger('Embedding_Cache', logger, level=logging_level)
+        self.db_path = db_path
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.connection = connect_cache_db(db_path)
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS embeddings (
+                model_id TEXT NOT NULL,
+                text_hash TEXT NOT NULL,
+                vector BLOB NOT NULL,
+                accessed_at REAL NOT NULL,
+                PRIMARY KEY (model_id, text_hash)
+            );
+            CREATE INDEX IF NOT EXISTS embeddings_accessed_at ON embeddings (accessed_at);
+        """)
+        # Row count kept up to date by `put_many` and `evict`, so that writes do not scan the table
+        self.n_entries = self.connection.execute('SELECT COUNT(*) FROM embeddings').fetchone()[0]
+
+    def get_many(self, model_id, text_hashes):
+        """
+        Returns:
+        Dictionary mapping each cached text hash to its embedding (list of floats).
+        """
+        text_hashes = list(set(text_hashes))
+        results = {}
+        now = time.time()
+        with self.lock:
+            for index in range(0, len(text_hashes), 500):
+                chunk = text_hashes[index:index+500]
+                rows = self.connection.execute(
+                    f"""SELECT text_hash, vector FROM embeddings
+                    WHERE model_id = ? AND text_hash IN ({','.join('?' * len(chunk))})""",
+                    [model_id] + chunk
+                    ).fetchall()
+                for text_hash, vector in rows:
+                    results[text_hash] = np.frombuffer(vector, dtype=np.float32).tolist()
+                self.connection.executemany(
+                    'UPDATE embeddings SET accessed_at = ? WHERE model_id = ? AND text_hash = ?',
+                    [(now, model_id, text_hash) for text_hash, vector in rows]
+                    )
+        return results
+
+    def put_many(self, model_id, embeddings):
+        """
+        Parameters:
+        - model_id (str): Model id, including any setting that changes the vectors.
+        - embeddings (dict): Dictionary mapping text hashes to embeddings.
+        """
+        now = time.time()
+        rows = [
+            (np.asarray(embedding, dtype=np.float32).tobytes(), now, model_id, text_hash)
+            for text_hash, embedding in embeddings.items()
+            ]
+        with self.lock:
+            self.connection.execute('BEGIN')
+            n_inserted = self.connection.executemany(
+                'INSERT OR IGNORE INTO embeddings (vector, accessed_at, model_id, text_hash) VALUES (?, ?, ?, ?)',
+                rows
+                ).rowcount
+            if n_inserted < len(rows):
+                self.connection.executemany(
+                    'UPDATE embeddings SET vector = ?, accessed_at = ? WHERE model_id = ? AND text_hash = ?',
+                    rows
+                    )
+            self.connection.execute('COMMIT')
+            self.n_entries += n_inserted
+        if self.max_entries and self.n_entries > self.max_entries:
+            self.evict()
+
+    def evict(self):
+        """
+        Delete the least recently used embeddings until there are at most 90% of `max_entries`.
+        The table is only counted here, once the running count is over `max_entries`, to account 
+        for rows written by other processes.
+        """
+        with self.lock:
+            self.n_entries = self.connection.execute('SELECT COUNT(*) FROM embeddings').fetchone()[0]
+            if self.n_entries <= self.max_entries:
+                return
+            n_evicted = self.n_entries - int(self.max_entries * 0.9)
+            self.connection.execute(
+                """DELETE FROM embeddings WHERE rowid IN (
+                    SELECT rowid FROM embeddings ORDER BY accessed_at LIMIT ?
+                )""", (n_evicted,)
+                )
+            self.n_entries -= n_evicted
+        self.logger.info(f'Embedding cache: evicted {n_evicted} embeddings.')
+
+@component
+class Cached_Document_Embedder:
+    def __init__(self, embedder, embedding_cache, model_id=None, logger=None):
+        """
+        Wrap a document embedder so that chunks whose embedded text was already embedded with the
+        same model are read from `embedding_cache` instead of being embedded again. The wrapped
+        embedder's model is only loaded if some chunks are missing from the cache.
+
+        Parameters:
+        - embedder (SentenceTransformersDocumentEmbedder): Embedder used for cache misses.
+        - embedding_cache (Embedding_Cache): Persistent embedding cache.
+        - model_id (str, optional): Cache namespace. Defaults to the embedder's model and
+            normalization setting.
+        """
+        self.logger = create_function_logger('Cached_Document_Embedder', logger)
+        self.embedder = embedder
+        self.embedding_cache = embedding_cache
+        self.model_id = model_id if model_id else (
+            f'{embedder.model}|normalize={getattr(embedder, "normalize_embeddings", False)}'
+            )
+
+    def warm_up(self):
+        # The wrapped embedder is warmed up in `run` only when there are cache misses
+        pass
+
+    @component.output_types(documents=List[Document])
+    def run(self, documents: List[Document]):
+        texts = prepare_texts_to_embed(
+            documents, meta_fields_to_embed=self.embedder.meta_fields_to_embed,
+            embedding_separator=self.embedder.embedding_separator,
+            prefix=self.embedder.prefix, suffix=self.embedder.suffix
+            )
+        text_hashes = [hash_text(text) for text in texts]
+        embeddings = self.embedding_cache.get_many(self.model_id, text_hashes)
+        missing = [index for index, text_hash in enumerate(text_hashes) if text_hash not in embeddings]
+        self.logger.info(f'Embedding cache: {len(documents) - len(missing)} hits, {len(missing)} misses.')
+        if missing:
+            self.embedder.warm_up()
+            embedded_documents = self.embedder.run(
+                documents=[Document(content=documents[index].content, meta=documents[index].meta) for index in missing]
+                )['documents']
+            new_embeddings = {
+                text_hashes[index]: document.embedding for index, document in zip(missing, embedded_documents)
+                }
+            self.embedding_cache.put_many(self.model_id, new_embeddings)
+            embeddings.update(new_embeddings)
+        for document, text_hash in zip(documents, text_hashes):
+            document.embedding = embeddings[text_hash]
+        return {'documents': documents}
+
+def normalize_query(query, lowercase=False):
+    """
+    Normalize a query for embedding and caching: Unicode NFC, surrounding whitespace stripped and 
+    inner whitespace collapsed. Lowercasing is optional because it can change the embedding of 
+    cased models.
+    """
+    query = ' '.join(unicodedata.normalize('NFC', query).split())
+    return query.lower() if lowercase else query
+
+document_embedders = {}
+document_embedders_lock = threading.Lock()
+
+def get_document_embedder(embedder):
+    """
+    Helper function called by `embed_texts`: a `SentenceTransformersDocumentEmbedder` with the 
+    settings of a `SentenceTransformersTextEmbedder`, copied through the public `to_dict` and 
+    `from_dict`. One document embedder is created per text embedder, with the text embedder's 
+    `batch_size`. haystack shares the loaded model between embedders with the same model settings, 
+    so the model is not loaded twice.
+    """
+    from haystack.components.embedders import SentenceTransformersDocumentEmbedder
+    key = id(embedder)
+    with document_embedders_lock:
+        if key not in document_embedders:
+            init_parameters = dict(embedder.to_dict()['init_parameters'], progress_bar=False)
+            document_embedder = SentenceTransformersDocumentEmbedder.from_dict({
+                'type': f'{SentenceTransformersDocumentEmbedder.__module__}.{SentenceTransformersDocumentEmbedder.__name__}',
+                'init_parameters': init_parameters,
+                })
+            # The text embedder is kept so that its id is not reused by another embedder
+            document_embedders[key] = (embedder, document_embedder)
+        document_embedder = document_embedders[key][1]
+    document_embedder.warm_up()
+    return document_embedder
+
+def embed_texts(embedder, texts, batch_size=32):
+    """
+    Embed several query texts with a text embedder in batched forward passes instead of one 
+    `run` call per text. Supports `SentenceTransformersTextEmbedder`, through the `run` method of 
+    a `SentenceTransformersDocumentEmbedder` with the same settings, and the embedders of this 
+    project that implement `embed_batch`.
+
+    Parameters:
+    - batch_size (int, optional): Texts per forward pass for embedders with `embed_batch`. 
+        `SentenceTransformersTextEmbedder` uses its own `batch_size`.
+
+    Returns:
+    List of embeddings in the order of `texts`.
+    """
+    if hasattr(embedder, 'embed_batch'):
+        return embedder.embed_batch(texts, batch_size=batch_size)
+    documents = get_document_embedder(embedder).run(
+        documents=[Document(content=text) for text in texts]
+        )['documents']
+    return [document.embedding for document in documents]
+
+@component
+class Cached_Text_Embedder:
+    def __init__(
+            self, embedder, max_entries=10000, embedding_cache=None, model_id=None, lowercase=False, 
+            logger=None
+            ):
+        """
+        Wrap a text embedder with an in-memory LRU cache of query embeddings keyed by model id and 
+        normalized query text, optionally backed by a shared `Embedding_Cache` so that every worker 
+        process on the host benefits from the queries embedded by the others.
+
+        Parameters:
+        - embedder (SentenceTransformersTextEmbedder or Onnx_Text_Embedder): Embedder used for misses.
+        - max_entries (int, optional): Maximum number of embeddings kept in memory.
+        - embedding_cache (Embedding_Cache, optional): Shared persistent cache checked after the 
+            in-memory cache. Keys are the same as for `Cached_Document_Embedder`.
+        - model_id (str, optional): Cache namespace. Defaults to the embedder's model and 
+            normalization setting.
+        - lowercase (bool, optional): Lowercase queries before embedding them.
+        """
+        self.logger = create_function_logger('Cached_Text_Embedder', logger)
+        self.embedder = embedder
+        self.max_entries = max_entries
+        self.embedding_cache = embedding_cache
+        self.model_id = model_id if model_id else (
+            f'{embedder.model}|normalize={getattr(embedder, "normalize_embeddings", False)}'
+            )
+        self.lowercase = lowercase
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+
+    def warm_up(self):
+        self.embedder.warm_up()
+
+    def stats(self):
+        with self.lock:
+            n_lookups = self.hits + self.shared_hits + self.misses
+            return {
+                'entries': len(self.cache), 'hits': self.hits, 'shared_hits': self.shared_hits,
+                'misses': self.misses, 
+                'hit_rate': round((self.hits + self.shared_hits) / n_lookups, 4) if n_lookups else None,
+            }
+
+    def get_cached(self, text_hash):
+        with self.lock:
+            embedding = self.cache.get(text_hash)
+            if embedding is not None:
+                self.cache.move_to_end(text_hash)
+                self.hits += 1
+            return embedding
+
+    def put_cached(self, text_hash, embedding):
+        with self.lock:
+            self.cache[text_hash] = embedding
+            self.cache.move_to_end(text_hash)
+            while len(self.cache) > self.max_entries:
+                self.cache.popitem(last=False)
+
+    def embed_batch(self, texts, batch_size=32):
+        """
+        Embed several queries, looking each one up in the caches and embedding the misses 
+        together with `embed_texts`.
+        """
+        texts = [normalize_query(text, lowercase=self.lowercase) for text in texts]
+        text_hashes = [
+            hash_text(getattr(self.embedder, 'prefix', '') + text + getattr(self.embedder, 'suffix', ''))
+            for text in texts
+            ]
+        embeddings = {}
+        for text_hash in set(text_hashes):
+            embedding = self.get_cached(text_hash)
+            if embedding is not None:
+                embeddings[text_hash] = embedding
+        missing = [text_hash for text_hash in dict.fromkeys(text_hashes) if text_hash not in embeddings]
+        if missing and self.embedding_cache is not None:
+            shared_embeddings = self.embedding_cache.get_many(self.model_id, missing)
+            embeddings.update(shared_embeddings)
+            with self.lock:
+                self.shared_hits += len(shared_embeddings)
+            missing = [text_hash for text_hash in missing if text_hash not in shared_embeddings]
+        if missing:
+            text_by_hash = dict(zip(text_hashes, texts))
+            new_embeddings = dict(zip(
+                missing, embed_texts(self.embedder, [text_by_hash[text_hash] for text_hash in missing], batch_size)
+                ))
+            with self.lock:
+                self.misses += len(missing)
+            if self.embedding_cache is not None:
+                self.embedding_cache.put_many(self.model_id, new_embeddings)
+            embeddings.update(new_embeddings)
+        for text_hash in dict.fromkeys(text_hashes):
+            self.put_cached(text_hash, embeddings[text_hash])
+        return [embeddings[text_hash] for text_hash in text_hashes]
+
+    @component.output_types(embedding=List[float])
+    def run(self, text: str):
+        text = normalize_query(text, lowercase=self.lowercase)
+        text_hash = hash_text(
+            getattr(self.embedder, 'prefix', '') + text + getattr(self.embedder, 'suffix', '')
+            )
+        embedding = self.get_cached(text_hash)
+        if embedding is not None:
+            return {'embedding': embedding}
+        if self.embedding_cache is not None:
+            embedding = self.embedding_cache.get_many(self.model_id, [text_hash]).get(text_hash)
+        if embedding is not None:
+            with self.lock:
+                self.shared_hits += 1
+        else:
+            embedding = self.embedder.run(text=text)['embedding']
+            with self.lock:
+                self.misses += 1
+            if self.embedding_cache is not None:
+                self.embedding_cache.put_many(self.model_id, {text_hash: embedding})
+        self.put_cached(text_hash, embedding)
+        return {'embedding': embedding}
+
+default_embedding_model = 'sentence-transformers/all-mpnet-base-v2'
+worker_model = None
+
+def init_embedding_worker(model, threads_per_worker):
+    """
+    Initializer of the `Pooled_Document_Embedder` worker processes: set the intra-op thread count
+    and load the model once per process.
+    """
+    global worker_model
+    import torch
+    from sentence_transformers import SentenceTransformer
+    torch.set_num_threads(threads_per_worker)
+    worker_model = SentenceTransformer(model, device='cpu')
+
+def embed_chunk_worker(arguments):
+    texts, batch_size, normalize_embeddings = arguments
+    embeddings = worker_model.encode(
+        texts, batch_size=batch_size, normalize_embeddings=normalize_embeddings,
+        convert_to_numpy=True, show_progress_bar=False
+        )
+    return embeddings.astype(np.float32)
+
+@component
+class Pooled_Document_Embedder:
+    def __init__(
+            self, model=default_embedding_model, n_workers=None, threads_per_worker=None,
+            chunk_size=64, batch_size=32, normalize_embeddings=False, meta_fields_to_embed=None,
+            embedding_separator='\n', prefix='', suffix='', logger=None
+            ):
+        """
+        CPU document embedder that spreads chunks of documents across a pool of worker processes.
+        Each worker loads the SentenceTransformer model once and uses `threads_per_worker` intra-op
+        threads. Embeddings are returned in the order of the input documents. The text embedded for
+        each document is the same as with `SentenceTransformersDocumentEmbedder`.
+
+        Parameters:
+        - model (str, optional): SentenceTransformer model name or path.
+        - n_workers (int, optional): Number of worker processes. Defaults to the number of CPUs.
+        - threads_per_worker (int, optional): Intra-op threads per worker. Defaults to the number
+            of CPUs divided by `n_workers`.
+        - chunk_size (int, optional): Number of documents sent to a worker per task.
+        - batch_size (int, optional): Encoding batch size within a worker.
+        - normalize_embeddings (bool, optional): Normalize the embeddings to unit length.
+        - meta_fields_to_embed (list, optional): Metadata fields embedded together with the content.
+        """
+        self.logger = create_function_logger('Pooled_Document_Embedder', logger)
+        self.model = model
+        self.n_workers = n_workers if n_workers else os.cpu_count()
+        self.threads_per_worker = threads_per_worker if threads_per_worker else max(1, os.cpu_count() // self.n_workers)
+        self.chunk_size = chunk_size
+        self.batch_size = batch_size
+        self.normalize_embeddings = normalize_embeddings
+        self.meta_fields_to_embed = meta_fields_to_embed or []
+        self.embedding_separator = embedding_separator
+        self.prefix = prefix
+        self.suffix = suffix
+        self.executor = None
+
+    def warm_up(self):
+        """
+        Start the worker processes. Workers are spawned rather than forked so that they do not
+        inherit the thread pools of the parent process.
+        """
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(
+                max_workers=self.n_workers, mp_context=multiprocessing.get_context('spawn'),
+                initializer=init_embedding_worker, initargs=(self.model, self.threads_per_worker)
+                )
+            self.logger.info(
+                f'Started {self.n_workers} embedding workers with {self.threads_per_worker} threads each.'
+                )
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+    @component.output_types(documents=List[Document])
+    def run(self, documents: List[Document]):
+        self.warm_up()
+        texts = prepare_texts_to_embed(
+            documents, meta_fields_to_embed=self.meta_fields_to_embed,
+            embedding_separator=self.embedding_separator, prefix=self.prefix, suffix=self.suffix
+            )
+        chunks = [
+            (texts[index:index+self.chunk_size], self.batch_size, self.normalize_embeddings)
+            for index in range(0, len(texts), self.chunk_size)
+            ]
+        document_index = 0
+        for embeddings in self.executor.map(embed_chunk_worker, chunks):
+            for embedding in embeddings:
+                documents[document_index].embedding = embedding.tolist()
+                document_index += 1
+        return {'documents': documents}
+
+def make_benchmark_documents(n_documents, n_sentences=4, random_state=0):
+    """
+    Return Documents of `n_sentences` random sentences of words drawn from a fixed vocabulary.
+    """
+    random_generator = np.random.default_rng(random_state)
+    vocabulary = (
+        'patients treatment study trial results effect muscle protein training dose cohort risk '
+        'analysis outcome exercise clinical randomized increase reduced significant group model'
+        ).split()
+    documents = []
+    for index in range(n_documents):
+        sentences = [
+            ' '.join(random_generator.choice(vocabulary, size=12)).capitalize() + '.'
+            for sentence in range(n_sentences)
+            ]
+        documents.append(Document(content=' '.join(sentences), meta={'pmid': str(index)}))
+    return documents
+
+def benchmark_embedding_pool(
+        n_documents=2000, max_workers=None, model=default_embedding_model, chunk_size=64, logger=None
+        ):
+    """
+    Measure the throughput of `Pooled_Document_Embedder` with 1 to `max_workers` worker processes,
+    each using an equal share of the CPUs. Model loading is excluded from the timings.
+
+    Returns:
+    List of dictionaries with the number of workers, threads per worker, docs/sec and speedup.
+    """
+    logger = create_function_logger('benchmark_embedding_pool', logger)
+    max_workers = max_workers if max_workers else os.cpu_count()
+    documents = make_benchmark_documents(n_documents)
+    results = []
+    for n_workers in range(1, max_workers + 1):
+        embedder = Pooled_Document_Embedder(model=model, n_workers=n_workers, chunk_size=chunk_size, logger=logger)
+        embedder.warm_up()
+        # Embed one chunk per worker so that every worker has loaded the model before timing
+        embedder.run(documents=[Document(content=document.content) for document in documents[:n_workers * chunk_size]])
+        start = time.perf_counter()
+        embedder.run(documents=[Document(content=document.content) for document in documents])
+        elapsed = time.perf_counter() - start
+        embedder.close()
+        docs_per_sec = n_documents / elapsed
+        results.append({
+            'n_workers': n_workers, 'threads_per_worker': embedder.threads_per_worker,
+            'docs_per_sec': round(docs_per_sec, 1),
+            'speedup': round(docs_per_sec / results[0]['docs_per_sec'], 2) if results else 1.0,
+            })
+        logger.info(f'Embedding pool benchmark: {results[-1]}')
+    return results
+
+if __name__ == "__main__":
+    logger = create_function_logger(__name__, parent_logger=None, level=logging.INFO)
+    logger.info(f'System arguments: {sys.argv[1:]}')
+    n_documents = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    max_workers = int(sys.argv[2]) if len(sys.argv) > 2 else None
+    benchmark_embedding_pool(n_documents=n_documents, max_workers=max_workers, logger=logger)
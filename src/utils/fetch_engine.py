@@ -0,0 +1,279 @@
+import sys
+import math
+import time
+import json
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+from Custom_Logger import *
+
+eutils_url = 'https://eutils.ncbi.nlm.nih.gov/entrez/eutils/'
+
+class Token_Bucket:
+    def __init__(self, rate, capacity=1, max_per_second=None):
+        """
+        Thread-safe token bucket used to keep requests under the E-utilities rate limit.
+
+        Parameters:
+        - rate (float): Number of tokens added per second. Set it slightly below the server's limit:
+            requests are sent when tokens are granted, but jitter in sending and network latency 
+            can bunch their arrivals at the server.
+        - capacity (int, optional): Maximum number of tokens that can accumulate. The default of 1
+            spaces requests evenly.
+        - max_per_second (int, optional): If provided, tokens are also held back so that no sliding 
+            1-second window contains more than `max_per_second` grants.
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self.max_per_second = max_per_second
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.grants = deque()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Block until a token is available, then consume it.
+        """
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                while self.grants and self.grants[0] <= now - 1:
+                    self.grants.popleft()
+                if self.max_per_second and len(self.grants) >= self.max_per_second:
+                    wait = self.grants[0] + 1 - now
+                elif self.tokens >= 1:
+                    self.tokens -= 1
+                    if self.max_per_second:
+                        self.grants.append(now)
+                    return
+                else:
+                    wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+token_buckets = {}
+token_buckets_lock = threading.Lock()
+
+def get_token_bucket(api_key=None, rate=None):
+    """
+    Return the token bucket shared by every request made with the given API key.
+
+    NCBI allows 3 requests per second without an API key and 10 requests per second with one:
+    https://www.ncbi.nlm.nih.gov/books/NBK25497/#chapter2.Usage_Guidelines_and_Requiremen
+    By default, tokens are granted at 2.8 or 9.5 per second, with at most 3 or 10 grants in any 
+    sliding 1-second window, leaving a margin for jitter in when the requests reach NCBI.
+    """
+    max_per_second = 10 if api_key else 3
+    if rate is None:
+        rate = 9.5 if api_key else 2.8
+    with token_buckets_lock:
+        key = (api_key, rate)
+        if key not in token_buckets:
+            token_buckets[key] = Token_Bucket(rate, max_per_second=min(max_per_second, math.ceil(rate)))
+        return token_buckets[key]
+
+class Fetch_Engine:
+    def __init__(self, token_bucket=None, max_workers=3):
+        """
+        Keep several requests in flight on a thread pool while a shared token bucket enforces
+        the request rate.
+
+        Parameters:
+        - token_bucket (Token_Bucket, optional): Bucket shared with other engines using the same
+            API key. If None, the bucket for requests without an API key is used.
+        - max_workers (int, optional): Maximum number of requests in flight.
+        """
+        self.token_bucket = token_bucket if token_bucket else get_token_bucket()
+        self.max_workers = max_workers
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='Fetch_Engine')
+
+    def acquire(self):
+        self.token_bucket.acquire()
+
+    def map(self, function, items, max_pending=None):
+        """
+        Call `function` on each item concurrently and yield the results in the order of `items`.
+        `function` is responsible for calling `.acquire()` before each request it sends.
+
+        Parameters:
+        - function (callable): Function to call on each item.
+        - items (iterable): Items to process. Consumed lazily.
+        - max_pending (int, optional): Maximum number of submitted calls whose results have not been
+            yielded yet. Limits memory when the consumer is slower than the fetches.
+            Defaults to twice `max_workers`.
+        """
+        if self.max_workers <= 1:
+            for item in items:
+                yield function(item)
+            return
+        max_pending = max_pending if max_pending else self.max_workers * 2
+        pending = deque()
+        try:
+            for item in items:
+                pending.append(self.executor.submit(function, item))
+                if len(pending) >= max_pending:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            for future in pending:
+                future.cancel()
+
+retry_status_codes = (429, 500, 502, 503, 504)
+
+def create_session(pool_maxsize=10):
+    """
+    Create a keep-alive session whose connection pool holds `pool_maxsize` connections per host,
+    so that concurrent requests reuse TCP/TLS connections instead of opening a new one each time.
+    Retries are handled by the caller so that each retry goes through the token bucket.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_maxsize)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+def get_retry_after(response, default):
+    """
+    Return the number of seconds to wait according to the `Retry-After` header of the response,
+    which can be either a number of seconds or an HTTP date. Returns `default` if the header is 
+    missing or invalid.
+    """
+    retry_after = response.headers.get('Retry-After')
+    if not retry_after:
+        return default
+    try:
+        return max(0, float(retry_after))
+    except ValueError:
+        pass
+    try:
+        return max(0, (parsedate_to_datetime(retry_after) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return default
+
+#################
+class Stand_In_Handler(BaseHTTPRequestHandler):
+    """
+    Minimal stand-in for the esearch and efetch endpoints, used to measure throughput locally.
+    """
+    latency = 0.1
+    count = 100000
+    request_times = []
+
+    def do_GET(self):
+        self.respond(parse_qs(urlparse(self.path).query))
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        self.respond(parse_qs(self.rfile.read(length).decode('utf-8')))
+
+    def respond(self, params):
+        self.request_times.append(time.monotonic())
+        time.sleep(self.latency)
+        path = urlparse(self.path).path
+        if path.endswith('esearch.fcgi') and params.get('usehistory') == ['y']:
+            body = json.dumps({'esearchresult': {
+                'count': str(self.count), 'retmax': '0', 'idlist': [],
+                'webenv': 'stand_in', 'querykey': '1'
+                }})
+            content_type = 'application/json'
+        elif path.endswith('esearch.fcgi'):
+            retmax = int(params.get('retmax', ['20'])[0])
+            body = json.dumps({'esearchresult': {
+                'count': str(retmax), 'idlist': [str(index + 1) for index in range(retmax)]
+                }})
+            content_type = 'application/json'
+        else:
+            if 'WebEnv' in params:
+                retstart = int(params.get('retstart', ['0'])[0])
+                retmax = int(params.get('retmax', ['20'])[0])
+                ids = [str(index + 1) for index in range(retstart, min(retstart + retmax, self.count))]
+            else:
+                ids = ','.join(params.get('id', [''])).split(',')
+            articles = ''.join([
+                f'<PubmedArticle><MedlineCitation><PMID Version="1">{id}</PMID><Article>'
+                f'<ArticleTitle>Article {id}</ArticleTitle><Abstract><AbstractText>Abstract {id}'
+                f'</AbstractText></Abstract></Article></MedlineCitation></PubmedArticle>'
+                for id in ids if id
+                ])
+            body = f'<?xml version="1.0" ?><PubmedArticleSet>{articles}</PubmedArticleSet>'
+            content_type = 'text/xml'
+        content = body.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass
+
+def start_stand_in_server(latency=0.1, port=0):
+    """
+    Start a local stand-in E-utilities server on a background thread.
+
+    Returns:
+    Tuple of the server and the base URL to pass to `Pubmed_API(base_url=...)`.
+    """
+    handler = type('Handler', (Stand_In_Handler,), {'latency': latency, 'request_times': []})
+    server = ThreadingHTTPServer(('127.0.0.1', port), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server, f'http://127.0.0.1:{server.server_address[1]}/'
+
+def benchmark_fetch_engine(
+        n_pmids=2000, batch_size=100, rate=2.8, max_workers=3, latency=0.5, logger=None
+        ):
+    """
+    Fetch `n_pmids` stand-in records through `Pubmed_API` and compare the achieved request
+    rate with the token bucket rate.
+
+    Returns:
+    Dictionary of benchmark results.
+    """
+    from Pubmed_API import Pubmed_API
+    logger = create_function_logger('benchmark_fetch_engine', logger)
+    server, base_url = start_stand_in_server(latency=latency)
+    try:
+        api = Pubmed_API(
+            api_key=None, base_url=base_url, efetch_batch_size=batch_size,
+            max_workers=max_workers, logger=logger
+            )
+        api.fetch_engine.token_bucket = Token_Bucket(rate, max_per_second=math.ceil(rate))
+        api.search_article('benchmark', retmax=n_pmids, ids_only=True, verbose=False)
+        start = time.monotonic()
+        records = api.batch_retrieve_citation(api.iteration)
+        elapsed = time.monotonic() - start
+        request_times = server.RequestHandlerClass.request_times[1:]
+        results = {
+            'records': len(records),
+            'requests': len(request_times),
+            'elapsed_seconds': round(elapsed, 3),
+            'requests_per_second': round(len(request_times) / elapsed, 3) if elapsed else None,
+            'rate': rate,
+            'rate_limit': math.ceil(rate),
+            'max_requests_in_any_second': max([
+                len([t for t in request_times if start_time <= t < start_time + 1])
+                for start_time in request_times
+                ]) if request_times else 0,
+        }
+    finally:
+        server.shutdown()
+    logger.info(f'Fetch engine benchmark: {results}')
+    return results
+
+if __name__ == "__main__":
+    logger = create_function_logger(__name__, parent_logger=None, level=logging.INFO)
+    logger.info(f'System arguments: {sys.argv[1:]}')
+    n_pmids = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    max_workers = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    rate = float(sys.argv[3]) if len(sys.argv) > 3 else 3
+    benchmark_fetch_engine(n_pmids=n_pmids, rate=rate, max_workers=max_workers, logger=logger)
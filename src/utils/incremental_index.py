@@ -0,0 +1,204 @@
+import json
+import time
+import hashlib
+import threading
+from Custom_Logger import *
+from pubmed_cache import connect_cache_db
+
+retracted_publication_type = 'Retracted Publication'
+
+def document_fingerprint(document):
+    """
+    Return a fingerprint of the content and metadata of a haystack Document. Any change to the
+    text or metadata that is indexed changes the fingerprint.
+    """
+    payload = json.dumps({'content': document.content, 'meta': document.meta}, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+def get_retracted_pmids(dictionary_list):
+    """
+    Return the PMIDs of the articles whose publication types include 'Retracted Publication'.
+    """
+    retracted_pmids = []
+    for dictionary in dictionary_list:
+        publication_types = dictionary.get('publication_type') or []
+        if isinstance(publication_types, str):
+            publication_types = publication_types.split(', ')
+        if retracted_publication_type in publication_types:
+            retracted_pmids.append(str(dictionary.get('pmid')))
+    return retracted_pmids
+
+class Fingerprint_Store:
+    def __init__(self, db_path, logger=None, logging_level=logging.INFO):
+        """
+        Persistent record of the fingerprint of every PMID indexed in a collection, used to send
+        only new or modified articles through the indexing pipeline.
+
+        Parameters:
+        - db_path (str): Path to the SQLite database, e.g. '../data/processed/fingerprints_test_set_5.sqlite3'.
+        """
+        self.logger = create_function_logger('Fingerprint_Store', logger, level=logging_level)
+        self.db_path = db_path
+        self.lock = threading.Lock()
+        self.connection = connect_cache_db(db_path)
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS fingerprints (
+                pmid TEXT PRIMARY KEY,
+                fingerprint TEXT NOT NULL,
+                indexed_at REAL NOT NULL
+            )
+        """)
+
+    def get_all(self):
+        """
+        Return a dictionary mapping every indexed PMID to its fingerprint.
+        """
+        with self.lock:
+            return dict(self.connection.execute('SELECT pmid, fingerprint FROM fingerprints').fetchall())
+
+    def upsert_many(self, fingerprints):
+        """
+        Parameters:
+        - fingerprints (dict): Dictionary mapping PMIDs to fingerprints.
+        """
+        now = time.time()
+        with self.lock:
+            self.connection.execute('BEGIN')
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO fingerprints (pmid, fingerprint, indexed_at) VALUES (?, ?, ?)',
+                [(str(pmid), fingerprint, now) for pmid, fingerprint in fingerprints.items()]
+                )
+            self.connection.execute('COMMIT')
+
+    def delete_many(self, pmids):
+        with self.lock:
+            self.connection.execute('BEGIN')
+            self.connection.executemany('DELETE FROM fingerprints WHERE pmid = ?', [(str(pmid),) for pmid in pmids])
+            self.connection.execute('COMMIT')
+
+class Incremental_Planner:
+    def __init__(self, fingerprint_store, full_snapshot=False, deleted_pmids=None, logger=None):
+        """
+        Compare the documents to index with the fingerprints of the documents already indexed, one 
+        batch at a time, so that the input is read once and only one batch of Documents is held 
+        in memory.
+
+        Parameters:
+        - fingerprint_store (Fingerprint_Store): Fingerprints of the indexed documents.
+        - full_snapshot (bool, optional): If True, the documents are the whole corpus, so indexed PMIDs
+            that are missing from them are removed.
+        - deleted_pmids (list, optional): PMIDs to remove, e.g. from the `DeleteCitation` of update files.
+        """
+        self.logger = create_function_logger('Incremental_Planner', logger)
+        self.indexed = fingerprint_store.get_all()
+        self.full_snapshot = full_snapshot
+        self.removed_pmids = set(str(pmid) for pmid in (deleted_pmids or []))
+        self.seen_pmids = set()
+        self.planned = {} # Fingerprint of each PMID sent to the pipeline during this run
+        self.changed_pmids = set()
+        self.n_new = 0
+        self.n_unchanged = 0
+
+    def plan_batch(self, documents, retracted_pmids=()):
+        """
+        Parameters:
+        - documents (List[Document]): Documents to index. Their metadata must include `pmid`.
+        - retracted_pmids (set, optional): PMIDs of retracted articles, which are removed instead 
+            of indexed.
+
+        Returns:
+        Dictionary with:
+        - 'documents': Documents of the batch that are new or modified.
+        - 'fingerprints': Dictionary mapping the PMIDs of those documents to their new fingerprint.
+        - 'stale_pmids': PMIDs whose existing chunks must be deleted before the documents are written.
+        """
+        documents_to_index, fingerprints, stale_pmids = [], {}, set()
+        positions = {}
+        for document in documents:
+            pmid = str(document.meta['pmid'])
+            self.seen_pmids.add(pmid)
+            if pmid in self.removed_pmids or pmid in retracted_pmids:
+                self.removed_pmids.add(pmid)
+                continue
+            fingerprint = document_fingerprint(document)
+            if pmid in positions:
+                # Later version of an article of the same batch
+                documents_to_index[positions[pmid]] = document
+                fingerprints[pmid] = fingerprint
+                self.planned[pmid] = fingerprint
+                continue
+            previous_fingerprint = self.planned.get(pmid, self.indexed.get(pmid))
+            if previous_fingerprint == fingerprint:
+                self.n_unchanged += 1
+                continue
+            if previous_fingerprint is not None:
+                # Modified since the last run, or since an earlier batch of this run
+                stale_pmids.add(pmid)
+                self.changed_pmids.add(pmid)
+            else:
+                self.n_new += 1
+            positions[pmid] = len(documents_to_index)
+            documents_to_index.append(document)
+            fingerprints[pmid] = fingerprint
+            self.planned[pmid] = fingerprint
+        return {'documents': documents_to_index, 'fingerprints': fingerprints, 'stale_pmids': sorted(stale_pmids)}
+
+    def finish(self):
+        """
+        Returns:
+        Dictionary with the counts of new, modified and unchanged PMIDs and 'removed_pmids': the 
+        indexed PMIDs whose chunks and fingerprints must be deleted.
+        """
+        removed_pmids = set(self.removed_pmids)
+        if self.full_snapshot:
+            removed_pmids |= set(self.indexed) - self.seen_pmids
+        removed_pmids &= set(self.indexed) | set(self.planned)
+        self.logger.info(
+            f'Incremental update: {self.n_new} new, {len(self.changed_pmids)} modified, {self.n_unchanged} unchanged, '
+            f'{len(removed_pmids)} removed PMIDs.'
+            )
+        return {
+            'n_new': self.n_new, 'n_modified': len(self.changed_pmids), 'n_unchanged': self.n_unchanged,
+            'removed_pmids': sorted(removed_pmids),
+        }
+
+def plan_incremental_update(
+        documents, fingerprint_store, full_snapshot=False, deleted_pmids=None, retracted_pmids=None,
+        logger=None
+        ):
+    """
+    Plan the incremental update of a list of documents held in memory with `Incremental_Planner`.
+
+    Returns:
+    Dictionary with:
+    - 'documents': Documents that are new or modified and need to go through the pipeline.
+    - 'fingerprints': Dictionary mapping the PMIDs of those documents to their new fingerprint.
+    - 'stale_pmids': PMIDs whose existing chunks must be deleted (modified or removed).
+    - 'removed_pmids': PMIDs to remove from the fingerprint store.
+    """
+    planner = Incremental_Planner(
+        fingerprint_store, full_snapshot=full_snapshot, deleted_pmids=deleted_pmids, logger=logger
+        )
+    plan = planner.plan_batch(documents, retracted_pmids=set(str(pmid) for pmid in (retracted_pmids or [])))
+    summary = planner.finish()
+    plan['stale_pmids'] = sorted(set(plan['stale_pmids']) | set(summary['removed_pmids']))
+    plan['removed_pmids'] = summary['removed_pmids']
+    return plan
+
+def delete_pmid_chunks(document_store, pmids, batch_size=500):
+    """
+    Delete every chunk whose `pmid` metadata is in `pmids` from the document store.
+
+    Returns:
+    Number of chunks deleted.
+    """
+    n_deleted = 0
+    pmids = list(pmids)
+    for index in range(0, len(pmids), batch_size):
+        documents = document_store.filter_documents(
+            filters={'field': 'meta.pmid', 'operator': 'in', 'value': pmids[index:index+batch_size]}
+            )
+        if documents:
+            document_store.delete_documents([document.id for document in documents])
+            n_deleted += len(documents)
+    return n_deleted
@@ -6,10 +6,20 @@ from haystack.document_stores.types import DuplicatePolicy
 
 from haystack import Document
 from haystack_integrations.document_stores.chroma import ChromaDocumentStore
+import os
 import sys
+import time
+import queue
+import threading
+from itertools import chain
 sys.path.append(r"/home/silvhua/custom_python")
 from silvhua import *
 from Custom_Logger import *
+from incremental_index import *
+from embedders import *
+from onnx_embedders import *
+from collection_versions import *
+from article_store import *
 
 def replace_none_with_empty(input_list):
     return [{key: '' if value is None else value for key, value in dictionary.items()} for dictionary in input_list]
@@ -41,17 +51,272 @@ def list_dict_value_to_string(input_list, list_keys, separator=', ', suffix='str
         new_list.append(dictionary)
     return new_list
 
-def create_indexing_pipeline(document_store, metadata_fields_to_embed=None):
+def dicts_to_documents(
+        dictionary_list, content_key='abstract', meta_keys=['article_title', 'journal'], list_keys=[]
+        ):
+    """
+    Convert article dictionaries to haystack Documents one dictionary at a time, without the 
+    intermediate copies of the whole list made by `replace_none_with_empty` and 
+    `list_dict_value_to_string`. The output is the same: None values become empty strings 
+    and the values of `list_keys` are joined with ', '.
+
+    Args:
+        - dictionary_list (Iterable[Dict[str, Any]]): Article dictionaries, e.g. rows of 
+            `Pubmed_API.extract_pubmed_details_df`.
+        - content_key (str, optional): Key of the document content.
+        - meta_keys (List[str], optional): Keys to keep as document metadata.
+        - list_keys (List[str], optional): Keys whose list values are converted to strings.
+
+    Returns:
+        List[Document]
+    """
+    documents = []
+    for dictionary in dictionary_list:
+        values = {}
+        for key in [content_key] + list(meta_keys):
+            value = dictionary.get(key)
+            value = '' if value is None else value
+            if key in list_keys:
+                value = ', '.join(map(str, value)) if isinstance(value, list) else str(value)
+            values[key] = value
+        documents.append(Document(content=values[content_key], meta={key: values[key] for key in meta_keys}))
+    return documents
+
+def iter_document_batches(
+        article_batches, content_key='abstract', meta_keys=['article_title', 'journal'],
+        list_keys=[], batch_size=100
+        ):
+    """
+    Convert batches of article dictionaries to batches of exactly `batch_size` haystack Documents
+    (except for the last batch), whatever the size of the incoming batches.
+    """
+    buffer = []
+    for article_batch in article_batches:
+        buffer.extend(dicts_to_documents(
+            article_batch, content_key=content_key, meta_keys=meta_keys, list_keys=list_keys
+            ))
+        while len(buffer) >= batch_size:
+            yield buffer[:batch_size]
+            buffer = buffer[batch_size:]
+    if buffer:
+        yield buffer
+
+def index_document_batches(
+        document_batches, indexing_pipeline, first_component_name='cleaner', n_total=None, logger=None
+        ):
+    """
+    Run the indexing pipeline on each batch of Documents. Batches are pulled from the upstream
+    generators only when the previous batch has been embedded and written, so at most one batch
+    of Documents, chunks and embeddings is held in memory at a time.
+
+    Parameters:
+    - document_batches (Iterable[List[Document]]): Batches of Documents.
+    - indexing_pipeline (Pipeline): Pipeline from `create_indexing_pipeline`.
+    - n_total (int, optional): Total number of Documents, if known, for progress reporting.
+
+    Returns:
+    Number of Documents indexed.
+    """
+    logger = create_function_logger('index_document_batches', logger)
+    n_documents = 0
+    start = time.perf_counter()
+    for batch_number, document_batch in enumerate(document_batches):
+        indexing_pipeline.run({first_component_name: {"documents": document_batch}})
+        n_documents += len(document_batch)
+        elapsed = time.perf_counter() - start
+        progress = f'{n_documents}/{n_total}' if n_total else f'{n_documents}'
+        logger.info(
+            f'Batch {batch_number + 1}: indexed {progress} documents '
+            f'({n_documents / elapsed:.1f} docs/sec).'
+            )
+    return n_documents
+
+stage_done = object()
+
+def put_until_stopped(stage_queue, item, stop_event):
+    """
+    Put `item` on a bounded queue, giving up if another stage has failed.
+    """
+    while not stop_event.is_set():
+        try:
+            stage_queue.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+def get_until_stopped(stage_queue, stop_event):
+    """
+    Get the next item from a queue, or `stage_done` if another stage has failed.
+    """
+    while not stop_event.is_set():
+        try:
+            return stage_queue.get(timeout=0.1)
+        except queue.Empty:
+            continue
+    return stage_done
+
+def run_overlapped_pipeline(
+        document_batches, indexing_pipeline, write_batch_size=1000, queue_size=2, n_total=None, logger=None
+        ):
+    """
+    Run the components of a pipeline from `create_indexing_pipeline` as three overlapped stages 
+    connected by bounded queues: 
+    - a thread cleans and splits batch N+1,
+    - the calling thread embeds batch N,
+    - a thread writes the chunks of batch N-1 to the document store in bulk batches of 
+        `write_batch_size` chunks.
+    An error in any stage stops the others and is raised.
+
+    Parameters:
+    - document_batches (Iterable[List[Document]]): Batches of Documents, e.g. from 
+        `Index_Docs.iter_document_batches`.
+    - indexing_pipeline (Pipeline): Pipeline from `create_indexing_pipeline`.
+    - write_batch_size (int, optional): Number of chunks per `DocumentWriter` call.
+    - queue_size (int, optional): Maximum number of batches waiting between two stages.
+    - n_total (int, optional): Total number of Documents, if known, for progress reporting.
+
+    Returns:
+    Dictionary with the number of documents and chunks, the elapsed time, and the busy time of 
+    each stage. Busy times adding up to more than the elapsed time show the overlap.
+    """
+    logger = create_function_logger('run_overlapped_pipeline', logger)
+    cleaner = indexing_pipeline.get_component('cleaner')
+    splitter = indexing_pipeline.get_component('splitter')
+    embedder = indexing_pipeline.get_component('embedder')
+    writer = indexing_pipeline.get_component('writer')
+    for pipeline_component in (cleaner, splitter, embedder, writer):
+        if hasattr(pipeline_component, 'warm_up'):
+            pipeline_component.warm_up()
+
+    split_queue = queue.Queue(maxsize=queue_size)
+    write_queue = queue.Queue(maxsize=queue_size)
+    stop_event = threading.Event()
+    errors = []
+    stats = {'n_documents': 0, 'n_chunks': 0, 'busy': {'preprocess': 0., 'embed': 0., 'write': 0.}}
+
+    def preprocess():
+        try:
+            for document_batch in document_batches:
+                start = time.perf_counter()
+                chunks = splitter.run(documents=cleaner.run(documents=document_batch)['documents'])['documents']
+                stats['busy']['preprocess'] += time.perf_counter() - start
+                stats['n_documents'] += len(document_batch)
+                if not put_until_stopped(split_queue, chunks, stop_event):
+                    return
+        except Exception as error:
+            errors.append(error)
+            stop_event.set()
+        finally:
+            put_until_stopped(split_queue, stage_done, stop_event)
+
+    def write_chunks(chunks):
+        start = time.perf_counter()
+        writer.run(documents=chunks)
+        stats['busy']['write'] += time.perf_counter() - start
+        stats['n_chunks'] += len(chunks)
+
+    def write():
+        buffer = []
+        try:
+            while True:
+                chunks = get_until_stopped(write_queue, stop_event)
+                if chunks is stage_done:
+                    break
+                buffer.extend(chunks)
+                while len(buffer) >= write_batch_size:
+                    write_chunks(buffer[:write_batch_size])
+                    buffer = buffer[write_batch_size:]
+            if buffer and not stop_event.is_set():
+                write_chunks(buffer)
+        except Exception as error:
+            errors.append(error)
+            stop_event.set()
+
+    threads = [
+        threading.Thread(target=preprocess, name='preprocess', daemon=True),
+        threading.Thread(target=write, name='write', daemon=True)
+        ]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    try:
+        while True:
+            chunks = get_until_stopped(split_queue, stop_event)
+            if chunks is stage_done:
+                break
+            embed_start = time.perf_counter()
+            embedded_chunks = embedder.run(documents=chunks)['documents'] if chunks else []
+            stats['busy']['embed'] += time.perf_counter() - embed_start
+            put_until_stopped(write_queue, embedded_chunks, stop_event)
+            elapsed = time.perf_counter() - start
+            progress = f'{stats["n_documents"]}/{n_total}' if n_total else f'{stats["n_documents"]}'
+            logger.info(
+                f'Preprocessed {progress} documents, embedded {len(embedded_chunks)} chunks, '
+                f'wrote {stats["n_chunks"]} chunks ({stats["n_documents"] / elapsed:.1f} docs/sec).'
+                )
+    except Exception as error:
+        errors.append(error)
+        stop_event.set()
+    finally:
+        put_until_stopped(write_queue, stage_done, stop_event)
+        for thread in threads:
+            thread.join()
+    if errors:
+        raise errors[0]
+    stats['elapsed'] = time.perf_counter() - start
+    logger.info(
+        f'Indexed {stats["n_documents"]} documents as {stats["n_chunks"]} chunks in {stats["elapsed"]:.1f} s. '
+        f'Busy time per stage: ' + ', '.join(f'{stage} {busy:.1f} s' for stage, busy in stats['busy'].items())
+        )
+    return stats
+
+def create_indexing_pipeline(
+        document_store, metadata_fields_to_embed=None, embedding_cache=None, embedding_workers=None,
+        embedding_backend='torch', model_path=default_onnx_path, collection_versions=None, 
+        collection_name=None
+        ):
     """
     Sample notebook: https://colab.research.google.com/github/deepset-ai/haystack-tutorials/blob/main/tutorials/39_Embedding_Metadata_for_Improved_Retrieval.ipynb#scrollTo=nAE4fVvsALXm
+
+    Parameters:
+    - document_store (ChromaDocumentStore): Document store to write to.
+    - metadata_fields_to_embed (list, optional): Metadata fields embedded together with the content.
+    - embedding_cache (Embedding_Cache, optional): If provided, chunks that were already embedded 
+        with the same model in any previous run or collection are read from the cache.
+    - embedding_workers (int, optional): If more than 1, embed with a `Pooled_Document_Embedder` 
+        of this many worker processes instead of a single process. Only used with the 'torch' backend.
+    - embedding_backend (str, optional): 'torch' for SentenceTransformers, or 'onnx' / 'onnx-int8' 
+        for the model exported to `model_path` by `onnx_embedders.export_onnx_model`. 
+        Collections must be queried with the backend they were indexed with.
+    - model_path (str, optional): Folder of the exported ONNX model.
+    - collection_versions (Collection_Versions, optional): If provided with `collection_name`, the 
+        version of the collection is bumped after every write so that cached query results are 
+        invalidated.
+    - collection_name (str, optional): Name of the collection the document store writes to.
     """
+    check_embedding_backend(embedding_backend)
     document_cleaner = DocumentCleaner()
     document_splitter = DocumentSplitter(split_by="sentence", split_length=2)
-    document_embedder = SentenceTransformersDocumentEmbedder(
-        # model="thenlper/gte-large", 
-        meta_fields_to_embed=metadata_fields_to_embed
-    )
+    if embedding_backend != 'torch':
+        document_embedder = Onnx_Document_Embedder(
+            model_path=model_path, quantized=(embedding_backend == 'onnx-int8'),
+            meta_fields_to_embed=metadata_fields_to_embed
+            )
+    elif embedding_workers and embedding_workers > 1:
+        document_embedder = Pooled_Document_Embedder(
+            n_workers=embedding_workers, meta_fields_to_embed=metadata_fields_to_embed
+            )
+    else:
+        document_embedder = SentenceTransformersDocumentEmbedder(
+            # model="thenlper/gte-large", 
+            meta_fields_to_embed=metadata_fields_to_embed
+        )
+    if embedding_cache:
+        document_embedder = Cached_Document_Embedder(document_embedder, embedding_cache)
     document_writer = DocumentWriter(document_store=document_store, policy=DuplicatePolicy.OVERWRITE)
+    if collection_versions and collection_name:
+        document_writer = Versioned_Document_Writer(document_writer, collection_versions, collection_name)
 
     indexing_pipeline = Pipeline()
     indexing_pipeline.add_component("cleaner", document_cleaner)
@@ -70,24 +335,218 @@ class Index_Docs():
     def __init__(
             self, json_filename, json_filepath, content_key='abstract', meta_keys=[
                 'article_title', 'journal', 
-                ], list_keys=[], logger=None, logging_level=logging.INFO
+                ], list_keys=[], read_batch_size=10000, logger=None, logging_level=logging.INFO
             ):
+        """
+        Documents are built lazily, one batch at a time, by `iter_document_batches` so that memory 
+        depends on the batch size rather than on the number of articles in the file.
+
+        Parameters:
+        - json_filename (str): Name of the article file: a JSON array of article dictionaries, 
+            or a `.parquet` file written by `article_store` (see `Article_Parquet_Writer`).
+        - json_filepath (str): Folder of the article file.
+        - content_key (str, optional): Key of the document content.
+        - meta_keys (list, optional): Keys to keep as document metadata.
+        - list_keys (list, optional): Keys whose list values are joined into strings.
+        - read_batch_size (int, optional): Number of rows per record batch when reading a Parquet file.
+            Only `content_key`, `meta_keys` and the columns needed to detect retractions are read.
+        """
         self.logger = create_function_logger(__name__, parent_logger=logger, level=logging_level)
-        dictionary_list = load_json(json_filename, json_filepath)
-        dictionary_list = replace_none_with_empty(dictionary_list)
-        if list_keys:
-            dictionary_list = list_dict_value_to_string(dictionary_list, list_keys, suffix=None)
-        raw_docs = []
         self.logger.info(f'***Instantiating `Index_Docs`***')
-        for dictionary in dictionary_list:
-            doc = Document(content=dictionary[content_key], meta={key: dictionary[key] for key in meta_keys})
-            raw_docs.append(doc)
-        self.raw_docs = raw_docs
-        self.logger.info(f'Initialized Index_Docs with {len(raw_docs)} documents')
+        self.json_filename = json_filename
+        self.json_filepath = json_filepath
+        self.content_key = content_key
+        self.meta_keys = meta_keys
+        self.list_keys = list_keys
+        self.read_batch_size = read_batch_size
+        self.is_parquet = json_filename.endswith('.parquet')
+        self._n_documents = count_parquet_rows(self.path) if self.is_parquet else None
+        self._json_articles = None
+        self._retracted_pmids = None
+        self.logger.info(
+            f'Initialized Index_Docs for {self.path}' + 
+            (f' with {self._n_documents} documents' if self._n_documents is not None else '')
+            )
+
+    @property
+    def path(self):
+        return os.path.join(self.json_filepath, self.json_filename)
+
+    @property
+    def n_documents(self):
+        """
+        Number of articles in the input file: read from the Parquet footer, or counted when the JSON 
+        file is loaded. The loaded JSON articles are kept for the next `iter_article_batches` call, 
+        so that the file is only loaded once per run.
+        """
+        if self._n_documents is None:
+            self._json_articles = load_json(self.json_filename, self.json_filepath)
+            self._n_documents = len(self._json_articles)
+        return self._n_documents
+
+    def iter_article_batches(self, columns=None):
+        """
+        Yield the article dictionaries of the input file in batches of `read_batch_size`.
+
+        Parameters:
+        - columns (list, optional): Columns to read from a Parquet file. Defaults to the 
+            content key, the metadata keys and the columns needed to detect retractions.
+        """
+        if self.is_parquet:
+            columns = columns if columns else [self.content_key] + list(self.meta_keys) + ['pmid', 'publication_type']
+            yield from iter_parquet_batches(self.path, columns=columns, batch_size=self.read_batch_size)
+        else:
+            if self._json_articles is not None:
+                dictionary_list = self._json_articles
+                self._json_articles = None
+            else:
+                dictionary_list = load_json(self.json_filename, self.json_filepath)
+            self._n_documents = len(dictionary_list)
+            for index in range(0, len(dictionary_list), self.read_batch_size):
+                yield dictionary_list[index:index+self.read_batch_size]
+
+    def iter_document_batches(self, batch_size=100):
+        """
+        Yield the Documents of the input file in batches of `batch_size`.
+        """
+        return iter_document_batches(
+            self.iter_article_batches(), content_key=self.content_key, meta_keys=self.meta_keys,
+            list_keys=self.list_keys, batch_size=batch_size
+            )
+
+    @property
+    def raw_docs(self):
+        """
+        All the Documents of the input file. This materializes the whole file; prefer 
+        `iter_document_batches` for large files.
+        """
+        return list(chain.from_iterable(self.iter_document_batches(batch_size=self.read_batch_size)))
+
+    @property
+    def retracted_pmids(self):
+        if self._retracted_pmids is None:
+            self._retracted_pmids = []
+            for rows in self.iter_article_batches(columns=['pmid', 'publication_type']):
+                self._retracted_pmids.extend(get_retracted_pmids(rows))
+        return self._retracted_pmids
     
-    def run_pipeline(self, indexing_pipeline, first_component_name='cleaner'):
+    def run_pipeline(self, indexing_pipeline, first_component_name='cleaner', batch_size=100):
+        """
+        Run the indexing pipeline on the Documents of the input file, one batch at a time.
+
+        Parameters:
+        - indexing_pipeline (Pipeline): Pipeline from `create_indexing_pipeline`.
+        - batch_size (int, optional): Number of Documents sent through the pipeline per run.
+
+        Returns:
+        Number of Documents indexed.
+        """
         self.logger.info(f'***Running indexing pipeline***')
-        indexing_pipeline.run({first_component_name: {"documents": self.raw_docs}})
+        return index_document_batches(
+            self.iter_document_batches(batch_size=batch_size), indexing_pipeline,
+            first_component_name=first_component_name, n_total=self.n_documents, logger=self.logger
+            )
+
+    def run_overlapped(
+            self, indexing_pipeline, batch_size=100, write_batch_size=1000, queue_size=2
+            ):
+        """
+        Index the Documents of the input file with `run_overlapped_pipeline`, so that cleaning and 
+        splitting, embedding and writing of consecutive batches run at the same time.
+
+        Parameters:
+        - indexing_pipeline (Pipeline): Pipeline from `create_indexing_pipeline`.
+        - batch_size (int, optional): Number of Documents per batch.
+        - write_batch_size (int, optional): Number of chunks per `DocumentWriter` call.
+        - queue_size (int, optional): Maximum number of batches waiting between two stages.
+
+        Returns:
+        The statistics returned by `run_overlapped_pipeline`.
+        """
+        self.logger.info(f'***Running overlapped indexing pipeline***')
+        return run_overlapped_pipeline(
+            self.iter_document_batches(batch_size=batch_size), indexing_pipeline,
+            write_batch_size=write_batch_size, queue_size=queue_size, n_total=self.n_documents,
+            logger=self.logger
+            )
+
+    def run_incremental(
+            self, indexing_pipeline, document_store, fingerprint_store, first_component_name='cleaner',
+            full_snapshot=False, deleted_pmids=None, batch_size=100
+            ):
+        """
+        Index only the documents that are new or modified since the last run, and delete the chunks 
+        of modified, deleted and retracted PMIDs from the document store. The documents' metadata 
+        must include `pmid`.
+
+        The input file is read once: retractions are collected from the article batches as the 
+        Documents are planned, and the new or modified Documents are written in batches of 
+        `batch_size`. The old chunks of modified PMIDs are deleted just before their batch is written, 
+        and fingerprints are stored once the batch is written.
+
+        Parameters:
+        - indexing_pipeline (Pipeline): Pipeline from `create_indexing_pipeline`.
+        - document_store (ChromaDocumentStore): Document store the pipeline writes to.
+        - fingerprint_store (Fingerprint_Store): Fingerprints of the documents indexed in the collection.
+        - full_snapshot (bool, optional): If True, the input file is the whole corpus, so indexed 
+            PMIDs missing from it are deleted.
+        - deleted_pmids (list, optional): PMIDs to delete, e.g. from `read_deleted_pmids` of a `bulk_ingest` store.
+        - batch_size (int, optional): Number of Documents sent through the pipeline per run.
+
+        Returns:
+        The summary returned by `Incremental_Planner.finish`.
+        """
+        self.logger.info(f'***Running incremental indexing pipeline***')
+        planner = Incremental_Planner(
+            fingerprint_store, full_snapshot=full_snapshot, deleted_pmids=deleted_pmids, logger=self.logger
+            )
+        writer = indexing_pipeline.get_component('writer')
+        retracted_pmids = set()
+
+        def delete_chunks(pmids):
+            n_deleted = delete_pmid_chunks(document_store, pmids)
+            if hasattr(writer, 'bump_version'):
+                writer.bump_version()
+            self.logger.info(f'Deleted {n_deleted} chunks of {len(pmids)} modified or removed PMIDs.')
+
+        def iter_scanned_article_batches():
+            for rows in self.iter_article_batches():
+                retracted_pmids.update(get_retracted_pmids(rows))
+                yield rows
+
+        def iter_planned_batches():
+            documents, fingerprints, stale_pmids = [], {}, set()
+            document_batches = iter_document_batches(
+                iter_scanned_article_batches(), content_key=self.content_key, meta_keys=self.meta_keys,
+                list_keys=self.list_keys, batch_size=batch_size
+                )
+            for document_batch in chain(document_batches, [None]):
+                if document_batch is not None:
+                    plan = planner.plan_batch(document_batch, retracted_pmids=retracted_pmids)
+                    if set(plan['fingerprints']) & set(fingerprints):
+                        # Keep only the later version of a PMID that is still waiting to be written
+                        documents = [document for document in documents if str(document.meta['pmid']) not in plan['fingerprints']]
+                    documents.extend(plan['documents'])
+                    fingerprints.update(plan['fingerprints'])
+                    stale_pmids.update(plan['stale_pmids'])
+                if documents and (document_batch is None or len(documents) >= batch_size):
+                    if stale_pmids:
+                        delete_chunks(sorted(stale_pmids))
+                    yield documents
+                    # Resumed once the batch is embedded and written
+                    fingerprint_store.upsert_many(fingerprints)
+                    documents, fingerprints, stale_pmids = [], {}, set()
+
+        index_document_batches(
+            iter_planned_batches(), indexing_pipeline, first_component_name=first_component_name,
+            logger=self.logger
+            )
+        summary = planner.finish()
+        if summary['removed_pmids']:
+            delete_chunks(summary['removed_pmids'])
+            fingerprint_store.delete_many(summary['removed_pmids'])
+        self._retracted_pmids = sorted(retracted_pmids)
+        return summary
 
 if __name__ == "__main__":
     logger = create_function_logger(__name__, parent_logger=None, level=logging.INFO)
@@ -95,6 +554,9 @@ if __name__ == "__main__":
     filename = sys.argv[1] if len(sys.argv) > 1 else 'pubmed_results_2024-04-06_235718.json'
     collection_name = sys.argv[2] if len(sys.argv) > 2 else 'test_set_5'
     filepath = sys.argv[3] if len(sys.argv) > 3 else '/home/silvhua/repositories/pubmed-search/data/'
+    mode = sys.argv[4] if len(sys.argv) > 4 else 'full' # 'full', 'incremental' or 'overlapped'
+    batch_size = int(sys.argv[5]) if len(sys.argv) > 5 else 100
+    embedding_workers = int(sys.argv[6]) if len(sys.argv) > 6 else None
     document_store = ChromaDocumentStore( # https://docs.haystack.deepset.ai/reference/integrations-chroma#chromadocumentstore
         collection_name=collection_name, 
         persist_path='../data/processed/'
@@ -115,7 +577,19 @@ if __name__ == "__main__":
         filename, filepath, meta_keys=metadata_fields, list_keys=['authors'],
         )
     indexing_pipeline = create_indexing_pipeline(
-        document_store, metadata_fields_to_embed=metadata_fields_to_embed
+        document_store, metadata_fields_to_embed=metadata_fields_to_embed,
+        embedding_cache=Embedding_Cache(), embedding_workers=embedding_workers,
+        collection_versions=Collection_Versions(get_versions_path('../data/processed/')),
+        collection_name=collection_name
         )
-    indexer.run_pipeline(indexing_pipeline, first_component_name='cleaner')
+    if mode == 'incremental':
+        fingerprint_store = Fingerprint_Store(f'../data/processed/fingerprints_{collection_name}.sqlite3')
+        indexer.run_incremental(
+            indexing_pipeline, document_store, fingerprint_store, first_component_name='cleaner',
+            batch_size=batch_size
+            )
+    elif mode == 'overlapped':
+        indexer.run_overlapped(indexing_pipeline, batch_size=batch_size)
+    else:
+        indexer.run_pipeline(indexing_pipeline, first_component_name='cleaner', batch_size=batch_size)
     logger.info(f'Finished indexing pipeline')
\ No newline at end of file
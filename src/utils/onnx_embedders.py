@@ -0,0 +1,256 @@
+import os
+import sys
+import json
+import time
+from typing import List
+import numpy as np
+from haystack import component, Document
+from Custom_Logger import *
+from embedders import prepare_texts_to_embed, make_benchmark_documents, default_embedding_model
+
+default_onnx_path = '../data/models/all-mpnet-base-v2-onnx/'
+onnx_filename = 'model.onnx'
+quantized_onnx_filename = 'model_int8.onnx'
+embedding_backends = ('torch', 'onnx', 'onnx-int8')
+
+def export_onnx_model(model=default_embedding_model, output_path=default_onnx_path, quantize=True, logger=None):
+    """
+    Export the transformer of a SentenceTransformer model to ONNX, and optionally an int8 dynamically
+    quantized copy, together with its tokenizer and pooling settings. Requires torch,
+    sentence-transformers and onnxruntime; only onnxruntime and tokenizers are needed to embed
+    with the exported model.
+
+    Parameters:
+    - model (str, optional): SentenceTransformer model name or path.
+    - output_path (str, optional): Folder to write `model.onnx`, `model_int8.onnx`,
+        `tokenizer.json` and `embedding_config.json` to.
+    - quantize (bool, optional): Also write the int8 dynamically quantized model.
+
+    Returns:
+    output_path
+    """
+    import torch
+    from sentence_transformers import SentenceTransformer
+    from sentence_transformers.models import Normalize
+    logger = create_function_logger('export_onnx_model', logger)
+    os.makedirs(output_path, exist_ok=True)
+    sentence_transformer = SentenceTransformer(model, device='cpu')
+    transformer = sentence_transformer[0]
+    pooling = sentence_transformer[1]
+    embedding_config = {
+        'model': model,
+        'pooling': 'cls' if pooling.pooling_mode_cls_token else 'mean',
+        'normalize': any(isinstance(module, Normalize) for module in sentence_transformer),
+        'max_seq_length': sentence_transformer.max_seq_length,
+        'pad_token': transformer.tokenizer.pad_token,
+        'pad_token_id': transformer.tokenizer.pad_token_id,
+    }
+    transformer.tokenizer.save_pretrained(output_path)
+    with open(os.path.join(output_path, 'embedding_config.json'), 'w') as file:
+        json.dump(embedding_config, file)
+
+    auto_model = transformer.auto_model.eval()
+    encoded = transformer.tokenizer(['An example sentence.'], return_tensors='pt')
+    input_names = [name for name in ('input_ids', 'attention_mask', 'token_type_ids') if name in encoded]
+    dynamic_axes = {name: {0: 'batch', 1: 'sequence'} for name in input_names}
+    dynamic_axes['last_hidden_state'] = {0: 'batch', 1: 'sequence'}
+    with torch.no_grad():
+        torch.onnx.export(
+            auto_model, tuple(encoded[name] for name in input_names),
+            os.path.join(output_path, onnx_filename), input_names=input_names,
+            output_names=['last_hidden_state'], dynamic_axes=dynamic_axes, opset_version=14
+            )
+    logger.info(f'Exported {model} to {output_path}{onnx_filename}: {embedding_config}')
+    if quantize:
+        from onnxruntime.quantization import quantize_dynamic, QuantType
+        quantize_dynamic(
+            os.path.join(output_path, onnx_filename), os.path.join(output_path, quantized_onnx_filename),
+            weight_type=QuantType.QInt8
+            )
+        logger.info(f'Wrote int8 quantized model to {output_path}{quantized_onnx_filename}')
+    return output_path
+
+class Onnx_Encoder:
+    def __init__(self, model_path=default_onnx_path, quantized=True, n_threads=None):
+        """
+        Embed texts with a model exported by `export_onnx_model`, applying the same pooling and
+        normalization as the SentenceTransformer model.
+
+        Parameters:
+        - model_path (str, optional): Folder written by `export_onnx_model`.
+        - quantized (bool, optional): Use the int8 quantized model.
+        - n_threads (int, optional): onnxruntime intra-op threads. Defaults to onnxruntime's choice.
+        """
+        import onnxruntime
+        from tokenizers import Tokenizer
+        with open(os.path.join(model_path, 'embedding_config.json')) as file:
+            self.embedding_config = json.load(file)
+        session_options = onnxruntime.SessionOptions()
+        if n_threads:
+            session_options.intra_op_num_threads = n_threads
+        self.model_file = os.path.join(model_path, quantized_onnx_filename if quantized else onnx_filename)
+        self.session = onnxruntime.InferenceSession(
+            self.model_file, sess_options=session_options, providers=['CPUExecutionProvider']
+            )
+        self.input_names = [model_input.name for model_input in self.session.get_inputs()]
+        self.tokenizer = Tokenizer.from_file(os.path.join(model_path, 'tokenizer.json'))
+        self.tokenizer.enable_truncation(max_length=self.embedding_config['max_seq_length'])
+        self.tokenizer.enable_padding(
+            pad_id=self.embedding_config['pad_token_id'], pad_token=self.embedding_config['pad_token']
+            )
+
+    def encode(self, texts, batch_size=32):
+        """
+        Returns:
+        Float32 array of shape (len(texts), embedding dimension).
+        """
+        embeddings = []
+        for index in range(0, len(texts), batch_size):
+            encodings = self.tokenizer.encode_batch(texts[index:index+batch_size])
+            attention_mask = np.array([encoding.attention_mask for encoding in encodings], dtype=np.int64)
+            inputs = {
+                'input_ids': np.array([encoding.ids for encoding in encodings], dtype=np.int64),
+                'attention_mask': attention_mask,
+                'token_type_ids': np.array([encoding.type_ids for encoding in encodings], dtype=np.int64),
+                }
+            hidden_states = self.session.run(None, {name: inputs[name] for name in self.input_names})[0]
+            if self.embedding_config['pooling'] == 'cls':
+                pooled = hidden_states[:, 0]
+            else:
+                mask = attention_mask[:, :, None].astype(np.float32)
+                pooled = (hidden_states * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+            if self.embedding_config['normalize']:
+                pooled = pooled / np.clip(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12, None)
+            embeddings.append(pooled.astype(np.float32))
+        return np.concatenate(embeddings) if embeddings else np.zeros((0, 0), dtype=np.float32)
+
+@component
+class Onnx_Text_Embedder:
+    def __init__(self, model_path=default_onnx_path, quantized=True, n_threads=None, prefix='', suffix=''):
+        """
+        Drop-in replacement for `SentenceTransformersTextEmbedder` using a model exported by
+        `export_onnx_model`. Index and query with the same backend so that the vectors match.
+        """
+        self.model_path = model_path
+        self.quantized = quantized
+        self.n_threads = n_threads
+        self.model = os.path.join(model_path, quantized_onnx_filename if quantized else onnx_filename)
+        self.normalize_embeddings = False
+        self.prefix = prefix
+        self.suffix = suffix
+        self.encoder = None
+
+    def warm_up(self):
+        if self.encoder is None:
+            self.encoder = Onnx_Encoder(self.model_path, quantized=self.quantized, n_threads=self.n_threads)
+
+    def embed_batch(self, texts, batch_size=32):
+        self.warm_up()
+        return self.encoder.encode(
+            [self.prefix + text + self.suffix for text in texts], batch_size=batch_size
+            ).tolist()
+
+    @component.output_types(embedding=List[float])
+    def run(self, text: str):
+        self.warm_up()
+        return {'embedding': self.encoder.encode([self.prefix + text + self.suffix])[0].tolist()}
+
+@component
+class Onnx_Document_Embedder:
+    def __init__(
+            self, model_path=default_onnx_path, quantized=True, n_threads=None, batch_size=32,
+            meta_fields_to_embed=None, embedding_separator='\n', prefix='', suffix=''
+            ):
+        """
+        Drop-in replacement for `SentenceTransformersDocumentEmbedder` using a model exported by
+        `export_onnx_model`. It has the attributes `Cached_Document_Embedder` relies on; `model`
+        names the ONNX file so that cached fp32, int8 and PyTorch embeddings are kept apart.
+        """
+        self.model_path = model_path
+        self.quantized = quantized
+        self.n_threads = n_threads
+        self.batch_size = batch_size
+        self.model = os.path.join(model_path, quantized_onnx_filename if quantized else onnx_filename)
+        self.normalize_embeddings = False
+        self.meta_fields_to_embed = meta_fields_to_embed or []
+        self.embedding_separator = embedding_separator
+        self.prefix = prefix
+        self.suffix = suffix
+        self.encoder = None
+
+    def warm_up(self):
+        if self.encoder is None:
+            self.encoder = Onnx_Encoder(self.model_path, quantized=self.quantized, n_threads=self.n_threads)
+
+    @component.output_types(documents=List[Document])
+    def run(self, documents: List[Document]):
+        self.warm_up()
+        texts = prepare_texts_to_embed(
+            documents, meta_fields_to_embed=self.meta_fields_to_embed,
+            embedding_separator=self.embedding_separator, prefix=self.prefix, suffix=self.suffix
+            )
+        for document, embedding in zip(documents, self.encoder.encode(texts, batch_size=self.batch_size)):
+            document.embedding = embedding.tolist()
+        return {'documents': documents}
+
+def check_embedding_backend(embedding_backend):
+    if embedding_backend not in embedding_backends:
+        raise ValueError(f'`embedding_backend` must be one of {embedding_backends}, not {embedding_backend!r}.')
+
+def benchmark_onnx_backend(
+        model_path=default_onnx_path, model=default_embedding_model, n_documents=500, n_queries=50,
+        n_threads=None, logger=None
+        ):
+    """
+    Compare the PyTorch, ONNX and int8 ONNX backends on CPU: single-query latency, document
+    throughput, and cosine similarity of the ONNX embeddings to the PyTorch embeddings.
+
+    Returns:
+    List of dictionaries, one per backend.
+    """
+    from sentence_transformers import SentenceTransformer
+    logger = create_function_logger('benchmark_onnx_backend', logger)
+    texts = [document.content for document in make_benchmark_documents(n_documents)]
+    queries = [' '.join(text.split()[:8]) for text in texts[:n_queries]]
+    sentence_transformer = SentenceTransformer(model, device='cpu')
+    encoders = {
+        'torch': lambda batch: sentence_transformer.encode(batch, convert_to_numpy=True, show_progress_bar=False),
+        'onnx': Onnx_Encoder(model_path, quantized=False, n_threads=n_threads).encode,
+        'onnx-int8': Onnx_Encoder(model_path, quantized=True, n_threads=n_threads).encode,
+    }
+    reference = None
+    results = []
+    for backend, encode in encoders.items():
+        encode(texts[:8])
+        latencies = []
+        for query in queries:
+            start = time.perf_counter()
+            encode([query])
+            latencies.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        embeddings = encode(texts)
+        throughput = n_documents / (time.perf_counter() - start)
+        embeddings = embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+        if reference is None:
+            reference = embeddings
+        cosines = (embeddings * reference).sum(axis=1)
+        results.append({
+            'backend': backend,
+            'query_latency_p50_ms': round(float(np.percentile(latencies, 50)) * 1000, 2),
+            'query_latency_p99_ms': round(float(np.percentile(latencies, 99)) * 1000, 2),
+            'docs_per_sec': round(throughput, 1),
+            'mean_cosine_to_torch': round(float(cosines.mean()), 5),
+            'min_cosine_to_torch': round(float(cosines.min()), 5),
+            })
+        logger.info(f'Embedding backend benchmark: {results[-1]}')
+    return results
+
+if __name__ == "__main__":
+    logger = create_function_logger(__name__, parent_logger=None, level=logging.INFO)
+    logger.info(f'System arguments: {sys.argv[1:]}')
+    command = sys.argv[1] if len(sys.argv) > 1 else 'benchmark'
+    model_path = sys.argv[2] if len(sys.argv) > 2 else default_onnx_path
+    if command == 'export':
+        export_onnx_model(output_path=model_path, logger=logger)
+    else:
+        benchmark_onnx_backend(model_path=model_path, logger=logger)
@@ -0,0 +1,350 @@
+import os
+import re
+import json
+import time
+import zlib
+import sqlite3
+import hashlib
+import threading
+from Custom_Logger import *
+
+default_cache_path = '../data/cache/'
+
+def connect_cache_db(db_path):
+    """
+    Open a SQLite cache database that can be shared by several threads and processes.
+
+    Parameters:
+    - db_path (str): Path to the database file. Parent folders are created if needed.
+
+    Returns:
+    sqlite3.Connection
+    """
+    folder = os.path.dirname(db_path)
+    if folder:
+        os.makedirs(folder, exist_ok=True)
+    connection = sqlite3.connect(db_path, timeout=30, check_same_thread=False, isolation_level=None)
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.execute('PRAGMA synchronous=NORMAL')
+    return connection
+
+class Record_Cache:
+    def __init__(
+            self, db_path=f'{default_cache_path}pubmed_records.sqlite3', ttl_days=30,
+            max_bytes=2 * 1024**3, logger=None, logging_level=logging.INFO
+            ):
+        """
+        Persistent, compressed cache of efetch record strings keyed by PMID.
+
+        Records are stored once per content hash (content-addressed), so a PMID that is re-fetched
+        with unchanged content only refreshes its timestamp. Records older than `ttl_days` are
+        treated as missing so that they are fetched again (revalidated), and the least recently
+        used records are evicted when the compressed size exceeds `max_bytes`.
+
+        Parameters:
+        - db_path (str, optional): Path to the SQLite database.
+        - ttl_days (float, optional): Number of days after which a record is re-fetched. If None, records never expire.
+        - max_bytes (int, optional): Maximum total size of the compressed records. If None, the cache is unbounded.
+
+        # Example usage
+
+        api = Pubmed_API(record_cache=Record_Cache())
+        """
+        self.logger = create_function_logger('Record_Cache', logger, level=logging_level)
+        self.db_path = db_path
+        self.ttl_seconds = ttl_days * 86400 if ttl_days else None
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.connection = connect_cache_db(db_path)
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS records (
+                pmid TEXT PRIMARY KEY,
+                content_hash TEXT NOT NULL,
+                fetched_at REAL NOT NULL,
+                accessed_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS blobs (
+                content_hash TEXT PRIMARY KEY,
+                data BLOB NOT NULL,
+                size INTEGER NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS records_accessed_at ON records (accessed_at);
+            CREATE INDEX IF NOT EXISTS records_content_hash ON records (content_hash);
+        """)
+
+    def get_many(self, pmids):
+        """
+        Look up the record strings of the given PMIDs.
+
+        Returns:
+        Dictionary mapping each cached, unexpired PMID to its record string.
+        """
+        pmids = [str(pmid) for pmid in pmids]
+        results = {}
+        now = time.time()
+        with self.lock:
+            for index in range(0, len(pmids), 500):
+                chunk = pmids[index:index+500]
+                rows = self.connection.execute(
+                    f"""SELECT records.pmid, records.fetched_at, blobs.data FROM records
+                    JOIN blobs ON records.content_hash = blobs.content_hash
+                    WHERE records.pmid IN ({','.join('?' * len(chunk))})""", chunk
+                    ).fetchall()
+                fresh = [
+                    (pmid, data) for pmid, fetched_at, data in rows
+                    if (self.ttl_seconds is None) or (now - fetched_at < self.ttl_seconds)
+                    ]
+                for pmid, data in fresh:
+                    results[pmid] = zlib.decompress(data).decode('utf-8')
+                self.connection.executemany(
+                    'UPDATE records SET accessed_at = ? WHERE pmid = ?', [(now, pmid) for pmid, data in fresh]
+                    )
+        self.logger.debug(f'Record cache: {len(results)} of {len(pmids)} PMIDs found.')
+        return results
+
+    def put_many(self, records):
+        """
+        Store record strings in the cache.
+
+        Parameters:
+        - records (dict): Dictionary mapping PMIDs to record strings.
+        """
+        now = time.time()
+        with self.lock:
+            self.connection.execute('BEGIN')
+            try:
+                replaced_hashes = set()
+                for pmid, record_string in records.items():
+                    content = record_string.encode('utf-8')
+                    content_hash = hashlib.sha256(content).hexdigest()
+                    previous = self.connection.execute(
+                        'SELECT content_hash FROM records WHERE pmid = ?', (str(pmid),)
+                        ).fetchone()
+                    if previous and previous[0] != content_hash:
+                        replaced_hashes.add(previous[0])
+                    self.connection.execute(
+                        'INSERT OR IGNORE INTO blobs (content_hash, data, size) VALUES (?, ?, ?)',
+                        (content_hash, zlib.compress(content, 6), 0)
+                        )
+                    self.connection.execute(
+                        'UPDATE blobs SET size = length(data) WHERE content_hash = ? AND size = 0', (content_hash,)
+                        )
+                    self.connection.execute(
+                        'INSERT OR REPLACE INTO records (pmid, content_hash, fetched_at, accessed_at) VALUES (?, ?, ?, ?)',
+                        (str(pmid), content_hash, now, now)
+                        )
+                self.delete_orphan_blobs(replaced_hashes)
+                self.connection.execute('COMMIT')
+            except Exception:
+                self.connection.execute('ROLLBACK')
+                raise
+        if self.max_bytes:
+            self.evict()
+
+    def delete_orphan_blobs(self, content_hashes):
+        """
+        Delete the blobs among `content_hashes` that are no longer referenced by any PMID.
+        """
+        self.connection.executemany(
+            'DELETE FROM blobs WHERE content_hash = ? AND NOT EXISTS (SELECT 1 FROM records WHERE records.content_hash = blobs.content_hash)',
+            [(content_hash,) for content_hash in content_hashes]
+            )
+
+    def size(self):
+        """
+        Return the total size in bytes of the compressed records.
+        """
+        return self.connection.execute('SELECT COALESCE(SUM(size), 0) FROM blobs').fetchone()[0]
+
+    def evict(self):
+        """
+        Delete the least recently used records until the cache is within `max_bytes`.
+        """
+        with self.lock:
+            excess = self.size() - self.max_bytes
+            if excess <= 0:
+                return
+            rows = self.connection.execute(
+                """SELECT records.pmid, records.content_hash, blobs.size FROM records
+                JOIN blobs ON records.content_hash = blobs.content_hash
+                ORDER BY records.accessed_at"""
+                ).fetchall()
+            # A blob is only freed once every PMID referencing it is evicted
+            references = {}
+            for pmid, content_hash, size in rows:
+                references[content_hash] = references.get(content_hash, 0) + 1
+            evicted = []
+            evicted_hashes = set()
+            for pmid, content_hash, size in rows:
+                if excess <= 0:
+                    break
+                evicted.append((pmid,))
+                evicted_hashes.add(content_hash)
+                references[content_hash] -= 1
+                if references[content_hash] == 0:
+                    excess -= size
+            self.connection.execute('BEGIN')
+            self.connection.executemany('DELETE FROM records WHERE pmid = ?', evicted)
+            self.delete_orphan_blobs(evicted_hashes)
+            self.connection.execute('COMMIT')
+        self.logger.info(f'Record cache: evicted {len(evicted)} records.')
+
+    def clear(self):
+        with self.lock:
+            self.connection.executescript('DELETE FROM records; DELETE FROM blobs;')
+
+class Search_Cache:
+    def __init__(
+            self, db_path=f'{default_cache_path}pubmed_searches.sqlite3', ttl_hours=24,
+            logger=None, logging_level=logging.INFO
+            ):
+        """
+        Persistent cache of esearch responses keyed by the normalized search parameters.
+
+        Parameters:
+        - db_path (str, optional): Path to the SQLite database.
+        - ttl_hours (float, optional): Number of hours after which a search is sent to esearch again.
+            If None, cached searches never expire.
+
+        # Example usage
+
+        api = Pubmed_API(search_cache=Search_Cache(ttl_hours=6))
+        ids_list = api.search_article(query, ids_only=True)  # Served from the cache on later calls
+        ids_list = api.search_article(query, ids_only=True, bypass_cache=True)  # Always calls esearch
+        """
+        self.logger = create_function_logger('Search_Cache', logger, level=logging_level)
+        self.db_path = db_path
+        self.ttl_seconds = ttl_hours * 3600 if ttl_hours else None
+        self.lock = threading.Lock()
+        self.connection = connect_cache_db(db_path)
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS searches (
+                cache_key TEXT PRIMARY KEY,
+                search_params TEXT NOT NULL,
+                response TEXT NOT NULL,
+                fetched_at REAL NOT NULL
+            )
+        """)
+
+    def get(self, params):
+        """
+        Return the cached esearch response for the given parameters, or None if it is missing or expired.
+        """
+        cache_key, search_params = create_search_cache_key(params)
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT response, fetched_at FROM searches WHERE cache_key = ?', (cache_key,)
+                ).fetchone()
+        if row is None:
+            return None
+        response, fetched_at = row
+        if (self.ttl_seconds is not None) and (time.time() - fetched_at >= self.ttl_seconds):
+            return None
+        self.logger.info(f'Search cache hit: {search_params}')
+        return json.loads(response)
+
+    def put(self, params, response_dict):
+        cache_key, search_params = create_search_cache_key(params)
+        with self.lock:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO searches (cache_key, search_params, response, fetched_at) VALUES (?, ?, ?, ?)',
+                (cache_key, search_params, json.dumps(response_dict), time.time())
+                )
+
+    def clear(self):
+        with self.lock:
+            self.connection.execute('DELETE FROM searches')
+
+def is_successful_search(status_code, response_dict):
+    """
+    Return True if an esearch response can be cached: HTTP 200 and no error in the JSON body. 
+    E-utilities report some errors, e.g. rate limiting or a malformed term, in the body rather 
+    than the status code, and these must not be replayed from the cache.
+    """
+    if status_code != 200 or not isinstance(response_dict, dict):
+        return False
+    if 'error' in response_dict or 'ERROR' in response_dict:
+        return False
+    esearch_result = response_dict.get('esearchresult')
+    return isinstance(esearch_result, dict) and 'ERROR' not in esearch_result and 'idlist' in esearch_result
+
+def create_search_cache_key(params):
+    """
+    Create the cache key for a set of esearch parameters. The search term is normalized with 
+    `normalize_search_term` and the API key is ignored.
+
+    Returns:
+    Tuple of the cache key and the normalized parameters as a JSON string.
+    """
+    search_params = {
+        key: str(value) for key, value in params.items() if key not in ('api_key', 'term')
+        }
+    search_params['term'] = normalize_search_term(params.get('term', ''))
+    search_params = json.dumps(search_params, sort_keys=True)
+    return hashlib.sha256(search_params.encode('utf-8')).hexdigest(), search_params
+
+def normalize_search_term(search_term):
+    """
+    Normalize a PubMed search term so that equivalent queries share a cache entry:
+    - Whitespace is collapsed, including inside parentheses.
+    - Everything except the boolean operators AND, OR and NOT is lowercased, since PubMed 
+        searches are not case sensitive but only recognize upper case operators.
+    - Operands joined only by AND, or only by OR, are sorted. Groups that mix operators or use NOT 
+        keep their order because PubMed evaluates them left to right.
+    """
+    search_term = re.sub(r'\s+', ' ', search_term).strip()
+    search_term = re.sub(r'\(\s+', '(', search_term)
+    search_term = re.sub(r'\s+\)', ')', search_term)
+    search_term = re.sub(
+        r'\b(?!(?:AND|OR|NOT)\b)\w+', lambda match: match.group(0).lower(), search_term
+        )
+    return normalize_boolean_group(search_term)
+
+def normalize_boolean_group(search_term):
+    """
+    Helper function called by `normalize_search_term` to sort the operands of a boolean group.
+    """
+    operands, operators = split_boolean_group(search_term)
+    normalized_operands = []
+    for operand in operands:
+        if operand.startswith('(') and operand.endswith(')'):
+            operand = f'({normalize_boolean_group(operand[1:-1])})'
+        normalized_operands.append(operand)
+    if len(set(operators)) == 1 and operators[0] in ('AND', 'OR'):
+        normalized_operands = sorted(normalized_operands)
+    normalized_term = normalized_operands[0]
+    for operator, operand in zip(operators, normalized_operands[1:]):
+        normalized_term += f' {operator} {operand}'
+    return normalized_term
+
+def split_boolean_group(search_term):
+    """
+    Split a search term on the boolean operators that are outside parentheses and quotes.
+
+    Returns:
+    Tuple of the list of operands and the list of operators. If the parentheses are unbalanced,
+    the whole term is returned as a single operand.
+    """
+    operands, operators = [], []
+    depth, quoted, start = 0, False, 0
+    tokens = re.finditer(r'"|\(|\)| (AND|OR|NOT) ', search_term)
+    for token in tokens:
+        text = token.group(0)
+        if text == '"':
+            quoted = not quoted
+        elif quoted:
+            continue
+        elif text == '(':
+            depth += 1
+        elif text == ')':
+            depth -= 1
+            if depth < 0:
+                break
+        elif depth == 0:
+            operands.append(search_term[start:token.start()].strip())
+            operators.append(token.group(1))
+            start = token.end()
+    if depth != 0 or quoted:
+        return [search_term], []
+    operands.append(search_term[start:].strip())
+    return operands, operators
@@ -0,0 +1,307 @@
+import io
+import re
+import sys
+import time
+import html
+import json
+import random
+import xml.etree.ElementTree as ET
+import pandas as pd
+from Custom_Logger import *
+
+pubmed_columns = [
+    'article_title',
+    'abstract',
+    'mesh_headings',
+    'keywords',
+    'major_topics',
+    'pmid',
+    'doi',
+    'journal',
+    'volume',
+    'issue',
+    'year',
+    'month',
+    'start_page',
+    'end_page',
+    'authors',
+    'publication_type'
+]
+article_tags = ('PubmedArticle', 'PubmedBookArticle')
+first_value_tags = {
+    'PMID': 'pmid',
+    'Title': 'journal',
+    'Volume': 'volume',
+    'Issue': 'issue',
+    'StartPage': 'start_page',
+    'EndPage': 'end_page',
+}
+list_columns = ['mesh_headings', 'keywords', 'major_topics', 'authors', 'publication_type']
+
+def iter_pubmed_articles(source, deleted_pmids=None, logger=None):
+    """
+    Stream-parse PubMed XML and yield one dictionary of article details per `PubmedArticle`.
+
+    Each article is walked once with `xml.etree.ElementTree.iterparse` and cleared as soon as its
+    details are extracted, so memory stays flat for files of any size. The output has the same
+    columns and formatting as `Pubmed_API.extract_pubmed_details_df`, except that:
+    - XML entities are resolved (e.g. 'Boström' instead of 'Bostr&#xf6;m') and inline markup
+        such as <i> is dropped from titles and abstracts.
+    - `month` is the publication month whatever its value (the regex path only matches 'Aug').
+
+    Parameters:
+    - source (str or file-like): Path or binary file object containing a `PubmedArticleSet`
+        (e.g. an efetch response or a baseline file) or a single `PubmedArticle`.
+    - deleted_pmids (list, optional): If provided, the PMIDs listed in the `DeleteCitation` 
+        element of update files are appended to it.
+
+    Yields:
+    Dictionary of article details with the keys in `pubmed_columns`.
+    """
+    path = []
+    root = None
+    row = None
+    for event, elem in ET.iterparse(source, events=('start', 'end')):
+        tag = elem.tag
+        if event == 'start':
+            if root is None:
+                root = elem
+            if tag in article_tags:
+                row = {column: None for column in pubmed_columns}
+                state = {
+                    'abstract': [], 'abstract_done': False, 'mesh_done': False,
+                    'keywords_done': False, 'publication_types_done': False,
+                    'descriptor': None, 'qualifiers': [],
+                    }
+                for column in list_columns:
+                    row[column] = []
+            path.append(tag)
+            continue
+        path.pop()
+        if row is None:
+            if tag == 'PMID' and deleted_pmids is not None and 'DeleteCitation' in path:
+                deleted_pmids.append(elem.text)
+            elif tag == 'DeleteCitation':
+                elem.clear()
+            continue
+        parent = path[-1] if path else None
+        if tag in article_tags:
+            if state['abstract']:
+                row['abstract'] = ' '.join(state['abstract'])
+            for column in list_columns:
+                row[column] = row[column] if row[column] else None
+            yield row
+            row = None
+            elem.clear()
+            if root is not elem:
+                root.clear()
+            continue
+        if elem.get('MajorTopicYN') == 'Y' and elem.text and len(elem) == 0:
+            row['major_topics'].append(elem.text)
+        if tag in first_value_tags:
+            column = first_value_tags[tag]
+            if row[column] is None:
+                row[column] = elem.text
+        elif tag == 'ArticleTitle':
+            if row['article_title'] is None:
+                row['article_title'] = ''.join(elem.itertext())
+        elif tag == 'ELocationID':
+            if row['doi'] is None and elem.get('EIdType') == 'doi':
+                row['doi'] = elem.text
+        elif tag == 'Year' and parent == 'PubDate':
+            if row['year'] is None:
+                row['year'] = elem.text
+        elif tag == 'Month' and parent == 'PubDate':
+            if row['month'] is None:
+                row['month'] = elem.text
+        elif tag == 'AbstractText' and parent == 'Abstract':
+            if not state['abstract_done']:
+                state['abstract'].append(f'{elem.get("Label", "")}: {"".join(elem.itertext())}')
+        elif tag == 'Abstract':
+            state['abstract_done'] = True
+        elif tag == 'DescriptorName' and parent == 'MeshHeading':
+            state['descriptor'] = elem.text
+            state['qualifiers'] = []
+        elif tag == 'QualifierName' and parent == 'MeshHeading':
+            state['qualifiers'].append(elem.text)
+        elif tag == 'MeshHeading' and not state['mesh_done']:
+            if state['qualifiers']:
+                row['mesh_headings'].extend([
+                    f'{state["descriptor"]} / {qualifier}' for qualifier in state['qualifiers']
+                    ])
+            elif state['descriptor']:
+                row['mesh_headings'].append(state['descriptor'])
+        elif tag == 'MeshHeadingList':
+            state['mesh_done'] = True
+        elif tag == 'Author' and elem.get('ValidYN') == 'Y':
+            last_name, fore_name = elem.findtext('LastName'), elem.findtext('ForeName')
+            if last_name is not None and fore_name is not None:
+                row['authors'].append(f'{last_name} {fore_name}')
+        elif tag == 'Keyword' and parent == 'KeywordList' and not state['keywords_done']:
+            row['keywords'].append(''.join(elem.itertext()))
+        elif tag == 'KeywordList':
+            state['keywords_done'] = True
+        elif tag == 'PublicationType' and not state['publication_types_done']:
+            row['publication_type'].append(elem.text)
+        elif tag == 'PublicationTypeList':
+            state['publication_types_done'] = True
+
+def extract_pubmed_details_xml(record_strings, logger=None):
+    """
+    Streaming XML alternative to `Pubmed_API.extract_pubmed_details_df`.
+
+    Parameters:
+    - record_strings (list): Record strings as stored in `Pubmed_API.record_strings_dict`.
+
+    Returns:
+    DataFrame of the Pubmed article details with the columns in `pubmed_columns`.
+    """
+    logger = create_function_logger('extract_pubmed_details_xml', logger)
+    rows = []
+    for index, record_string in enumerate(record_strings):
+        try:
+            rows.extend(iter_pubmed_articles(io.BytesIO(record_string.encode('utf-8'))))
+        except ET.ParseError as error:
+            logger.error(f'Record {index} could not be parsed: {error}')
+    return pd.DataFrame(rows, columns=pubmed_columns)
+
+#################
+def make_synthetic_record(pmid, random_state=None):
+    """
+    Create a synthetic `PubmedArticle` record string with the elements that the extractors parse.
+    Used to benchmark the extractors and the bulk ingest without calling the API.
+    """
+    random_state = random_state if random_state else random.Random(pmid)
+    words = [
+        'exercise', 'training', 'older', 'adults', 'muscle', 'strength', 'randomized', 'trial',
+        'cohort', 'risk', 'outcome', 'intervention', 'patients', 'clinical', 'effect', 'review'
+        ]
+    def sentence(n_words):
+        return ' '.join(random_state.choice(words) for index in range(n_words)).capitalize() + '.'
+    labels = ['BACKGROUND', 'METHODS', 'RESULTS', 'CONCLUSIONS']
+    abstract = ''.join([
+        f'<AbstractText Label="{label}" NlmCategory="{label}">{" ".join(sentence(15) for index in range(3))}</AbstractText>'
+        for label in labels
+        ])
+    authors = ''.join([
+        f'<Author ValidYN="Y"><LastName>Last{index}</LastName><ForeName>Fore{index}</ForeName>'
+        f'<Initials>F</Initials></Author>' for index in range(random_state.randint(1, 8))
+        ])
+    mesh = ''.join([
+        f'<MeshHeading><DescriptorName UI="D{index:06d}" MajorTopicYN="N">{word.capitalize()}</DescriptorName>'
+        + (f'<QualifierName UI="Q{index:06d}" MajorTopicYN="Y">methods</QualifierName>' if index % 2 else '')
+        + '</MeshHeading>'
+        for index, word in enumerate(random_state.sample(words, 4))
+        ])
+    keywords = ''.join([
+        f'<Keyword MajorTopicYN="N">{word}</Keyword>' for word in random_state.sample(words, 3)
+        ])
+    return (
+        f'<PubmedArticle><MedlineCitation Status="MEDLINE" Owner="NLM"><PMID Version="1">{pmid}</PMID>'
+        f'<Article PubModel="Print-Electronic"><Journal><ISSN IssnType="Electronic">1234-5678</ISSN>'
+        f'<JournalIssue CitedMedium="Internet"><Volume>{pmid % 50}</Volume><Issue>{pmid % 12 + 1}</Issue>'
+        f'<PubDate><Year>{2000 + pmid % 24}</Year><Month>Aug</Month></PubDate></JournalIssue>'
+        f'<Title>Journal of {random_state.choice(words)}</Title></Journal>'
+        f'<ArticleTitle>{sentence(10)}</ArticleTitle>'
+        f'<Pagination><StartPage>{pmid % 100}</StartPage><EndPage>{pmid % 100 + 9}</EndPage></Pagination>'
+        f'<ELocationID EIdType="doi" ValidYN="Y">10.1000/{pmid}</ELocationID>'
+        f'<Abstract>{abstract}</Abstract><AuthorList CompleteYN="Y">{authors}</AuthorList>'
+        f'<PublicationTypeList><PublicationType UI="D016428">Journal Article</PublicationType>'
+        f'</PublicationTypeList></Article><MeshHeadingList>{mesh}</MeshHeadingList>'
+        f'<KeywordList Owner="NOTNLM">{keywords}</KeywordList></MedlineCitation>'
+        f'<PubmedData><ArticleIdList><ArticleId IdType="pubmed">{pmid}</ArticleId></ArticleIdList>'
+        f'</PubmedData></PubmedArticle>'
+        )
+
+def normalize_extracted_value(value):
+    """
+    Helper function called by `compare_extractors` so that values from both extractors can be
+    compared: entities are resolved and inline markup is removed.
+    """
+    if isinstance(value, list):
+        return [normalize_extracted_value(item) for item in value]
+    if isinstance(value, str):
+        return html.unescape(re.sub(r'<[^>]+>', '', value)).strip()
+    return value
+
+def compare_extractors(df_regex, df_xml, columns=None):
+    """
+    Compare the output of the regex and streaming XML extractors row by row.
+
+    Parameters:
+    - df_regex (DataFrame): Output of `Pubmed_API.extract_pubmed_details_df`.
+    - df_xml (DataFrame): Output of `extract_pubmed_details_xml` for the same record strings.
+    - columns (list, optional): Columns to compare. Defaults to all columns except `month`.
+
+    Returns:
+    Dictionary mapping each column to the list of PMIDs whose values differ.
+    """
+    columns = columns if columns else [column for column in pubmed_columns if column != 'month']
+    mismatches = {column: [] for column in columns}
+    for regex_row, xml_row in zip(df_regex.to_dict(orient='records'), df_xml.to_dict(orient='records')):
+        for column in columns:
+            if normalize_extracted_value(regex_row[column]) != normalize_extracted_value(xml_row[column]):
+                mismatches[column].append(xml_row['pmid'])
+    return mismatches
+
+def check_extractors_on_json(json_path, api=None, logger=None):
+    """
+    Re-fetch the articles saved in a `data/pubmed_results_*.json` file and check that both
+    extractors reproduce the saved article details.
+
+    Returns:
+    Dictionary with the mismatches of each extractor against the saved details.
+    """
+    from Pubmed_API import Pubmed_API
+    logger = create_function_logger('check_extractors_on_json', logger)
+    with open(json_path) as file:
+        saved_df = pd.DataFrame(json.load(file))
+    api = api if api else Pubmed_API(logger=logger)
+    api.iteration += 1
+    api.PMIDs_dict[api.iteration] = saved_df['pmid'].tolist()
+    record_strings = api.batch_retrieve_citation(api.iteration)
+    df_regex = api.extract_pubmed_details_df(record_strings=record_strings)
+    df_xml = extract_pubmed_details_xml(record_strings, logger=logger)
+    results = {
+        'regex': compare_extractors(saved_df, df_regex),
+        'xml': compare_extractors(saved_df, df_xml),
+    }
+    logger.info(f'Mismatches against {json_path}: {results}')
+    return results
+
+def benchmark_extractors(n_records=10000, logger=None):
+    """
+    Time the regex and streaming XML extractors on `n_records` synthetic records and check that
+    their outputs match.
+
+    Returns:
+    Dictionary of benchmark results.
+    """
+    from Pubmed_API import Pubmed_API
+    logger = create_function_logger('benchmark_extractors', logger)
+    record_strings = [make_synthetic_record(pmid) for pmid in range(1, n_records + 1)]
+    api = Pubmed_API(logger=logger, logging_level=logging.WARNING)
+    start = time.perf_counter()
+    df_regex = api.extract_pubmed_details_df(record_strings=record_strings)
+    regex_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    df_xml = extract_pubmed_details_xml(record_strings, logger=logger)
+    xml_seconds = time.perf_counter() - start
+    mismatches = compare_extractors(df_regex, df_xml)
+    results = {
+        'records': n_records,
+        'regex_seconds': round(regex_seconds, 3),
+        'xml_seconds': round(xml_seconds, 3),
+        'speedup': round(regex_seconds / xml_seconds, 2) if xml_seconds else None,
+        'mismatched_values': {column: len(pmids) for column, pmids in mismatches.items() if pmids},
+    }
+    logger.info(f'Extractor benchmark: {results}')
+    return results
+
+if __name__ == "__main__":
+    logger = create_function_logger(__name__, parent_logger=None, level=logging.INFO)
+    logger.info(f'System arguments: {sys.argv[1:]}')
+    n_records = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    benchmark_extractors(n_records=n_records, logger=logger)
+    if len(sys.argv) > 2:
+        check_extractors_on_json(sys.argv[2], logger=logger)
@@ -0,0 +1,183 @@
+import sys
+import time
+import queue
+import threading
+from typing import List
+from concurrent.futures import Future, ThreadPoolExecutor
+import numpy as np
+from haystack import component
+from Custom_Logger import *
+from embedders import embed_texts
+
+@component
+class Query_Batcher:
+    def __init__(self, embedder, window_ms=5, max_batch_size=32, admit=None, logger=None):
+        """
+        Micro-batch the query embeddings of concurrent requests: the first query starts a window of
+        `window_ms` milliseconds during which other queries are collected, up to `max_batch_size`,
+        and the batch is embedded in one forward pass on a background thread. Each caller gets its
+        own vector back.
+
+        Parameters:
+        - embedder (SentenceTransformersTextEmbedder or Onnx_Text_Embedder): Embedder of the batches.
+        - window_ms (float, optional): Maximum time a query waits for others to join its batch.
+        - max_batch_size (int, optional): Maximum number of queries per forward pass.
+        - admit (callable, optional): Context manager factory entered around the forward pass of 
+            each batch, e.g. `Admission_Controller.admit`, so that a whole batch takes one slot and 
+            the queries arriving while it waits for the slot join the next batch. Its exceptions 
+            are raised to every caller of the batch.
+        """
+        self.logger = create_function_logger('Query_Batcher', logger)
+        self.embedder = embedder
+        self.window_ms = window_ms
+        self.max_batch_size = max_batch_size
+        self.admit = admit
+        self.requests = queue.Queue()
+        self.lock = threading.Lock()
+        self.n_batches = 0
+        self.n_queries = 0
+        self.thread = None
+
+    # Attributes read by `Cached_Text_Embedder` and `embed_texts`
+    @property
+    def model(self):
+        return self.embedder.model
+
+    @property
+    def normalize_embeddings(self):
+        return getattr(self.embedder, 'normalize_embeddings', False)
+
+    @property
+    def prefix(self):
+        return getattr(self.embedder, 'prefix', '')
+
+    @property
+    def suffix(self):
+        return getattr(self.embedder, 'suffix', '')
+
+    def warm_up(self):
+        self.embedder.warm_up()
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.serve, name='query_batcher', daemon=True)
+                self.thread.start()
+
+    def stats(self):
+        with self.lock:
+            return {
+                'batches': self.n_batches, 'queries': self.n_queries,
+                'mean_batch_size': round(self.n_queries / self.n_batches, 2) if self.n_batches else None,
+            }
+
+    def collect_batch(self):
+        """
+        Block until a query arrives, then collect queries until the window closes or the batch is full.
+        """
+        batch = [self.requests.get()]
+        deadline = time.perf_counter() + self.window_ms / 1000
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.requests.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def serve(self):
+        while True:
+            batch = self.collect_batch()
+            try:
+                if self.admit is None:
+                    embeddings = embed_texts(self.embedder, [text for text, future in batch], batch_size=len(batch))
+                else:
+                    with self.admit():
+                        embeddings = embed_texts(self.embedder, [text for text, future in batch], batch_size=len(batch))
+                for (text, future), embedding in zip(batch, embeddings):
+                    future.set_result(embedding)
+            except Exception as error:
+                self.logger.error(f'Failed to embed a batch of {len(batch)} queries: {error}')
+                for text, future in batch:
+                    future.set_exception(error)
+            with self.lock:
+                self.n_batches += 1
+                self.n_queries += len(batch)
+
+    def embed(self, text, timeout=None):
+        """
+        Queue a query for the next batch and wait for its embedding.
+        """
+        self.warm_up()
+        future = Future()
+        self.requests.put((text, future))
+        return future.result(timeout=timeout)
+
+    def embed_batch(self, texts, batch_size=32):
+        # Callers that already have a batch skip the window
+        return embed_texts(self.embedder, texts, batch_size=batch_size)
+
+    @component.output_types(embedding=List[float])
+    def run(self, text: str):
+        return {'embedding': self.embed(text)}
+
+def measure_latencies(embed, queries, n_clients):
+    """
+    Send `queries` from `n_clients` concurrent clients, each waiting for its answer before sending
+    the next query, and return the latency of every query and the total time.
+    """
+    def client(client_queries):
+        latencies = []
+        for query in client_queries:
+            start = time.perf_counter()
+            embed(query)
+            latencies.append(time.perf_counter() - start)
+        return latencies
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=n_clients) as executor:
+        client_latencies = executor.map(client, [queries[index::n_clients] for index in range(n_clients)])
+        latencies = [latency for latencies in client_latencies for latency in latencies]
+    return latencies, time.perf_counter() - start
+
+def benchmark_query_batcher(
+        embedder=None, n_queries=2000, n_clients=16, windows_ms=(2, 5, 10), max_batch_size=32, logger=None
+        ):
+    """
+    Compare p50/p99 query embedding latency and throughput with concurrent clients, unbatched and
+    with a `Query_Batcher` for each window in `windows_ms`.
+
+    Parameters:
+    - embedder (optional): Text embedder. Defaults to `SentenceTransformersTextEmbedder()`.
+
+    Returns:
+    List of dictionaries, one per configuration.
+    """
+    logger = create_function_logger('benchmark_query_batcher', logger)
+    if embedder is None:
+        from haystack.components.embedders import SentenceTransformersTextEmbedder
+        embedder = SentenceTransformersTextEmbedder()
+    embedder.warm_up()
+    queries = [f'effect of resistance training on muscle protein synthesis {index}' for index in range(n_queries)]
+    configurations = [('unbatched', lambda text: embedder.run(text=text)['embedding'])]
+    for window_ms in windows_ms:
+        batcher = Query_Batcher(embedder, window_ms=window_ms, max_batch_size=max_batch_size, logger=logger)
+        configurations.append((f'window {window_ms} ms', batcher.embed))
+    results = []
+    for name, embed in configurations:
+        embed(queries[0])
+        latencies, elapsed = measure_latencies(embed, queries, n_clients)
+        results.append({
+            'configuration': name,
+            'p50_ms': round(float(np.percentile(latencies, 50)) * 1000, 2),
+            'p99_ms': round(float(np.percentile(latencies, 99)) * 1000, 2),
+            'queries_per_sec': round(n_queries / elapsed, 1),
+            })
+        logger.info(f'Query batcher benchmark ({n_clients} clients): {results[-1]}')
+    return results
+
+if __name__ == "__main__":
+    logger = create_function_logger(__name__, parent_logger=None, level=logging.INFO)
+    logger.info(f'System arguments: {sys.argv[1:]}')
+    n_queries = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    n_clients = int(sys.argv[2]) if len(sys.argv) > 2 else 16
+    benchmark_query_batcher(n_queries=n_queries, n_clients=n_clients, logger=logger)
@@ -0,0 +1,70 @@
+import sys
+from haystack_integrations.document_stores.chroma import ChromaDocumentStore
+from Custom_Logger import *
+from Pubmed_API import *
+from indexing_pipeline import *
+
+def iter_article_batches(api, query, page_size=500, max_records=None, **search_kwargs):
+    """
+    Yield the article dictionaries of a search one esearch/efetch page at a time.
+    See `Pubmed_API.harvest_articles` for the parameters.
+    """
+    for df in api.harvest_articles(query, page_size=page_size, max_records=max_records, **search_kwargs):
+        yield df.to_dict(orient='records')
+
+def run_streaming_pipeline(
+        query, collection_name, persist_path='../data/processed/', page_size=500, batch_size=100,
+        max_records=None, content_key='abstract', metadata_fields_to_embed=['article_title', 'journal'],
+        other_metadata_fields=['abstract', 'pmid', 'doi', 'year', 'authors'], list_keys=['authors'],
+        api=None, logger=None, **search_kwargs
+        ):
+    """
+    Search PubMed and index the results into a Chroma collection in one streaming pass:
+    PMIDs -> record strings -> parsed rows -> Documents -> chunks + embeddings -> Chroma.
+    Memory depends on `page_size` and `batch_size`, not on the number of search results.
+
+    Parameters:
+    - query (str): Pubmed search query.
+    - collection_name (str): Chroma collection to write to.
+    - persist_path (str, optional): Chroma persist path.
+    - page_size (int, optional): Number of records fetched per efetch call.
+    - batch_size (int, optional): Number of Documents sent through the indexing pipeline at a time.
+    - max_records (int, optional): Maximum number of records to harvest.
+    - api (Pubmed_API, optional): Pubmed_API instance, e.g. with caches configured.
+    - **search_kwargs: Additional keyword arguments accepted by `Pubmed_API.search_article()`.
+
+    Returns:
+    Number of Documents indexed.
+    """
+    logger = create_function_logger('run_streaming_pipeline', logger)
+    api = api if api else Pubmed_API(logger=logger)
+    document_store = ChromaDocumentStore(collection_name=collection_name, persist_path=persist_path)
+    indexing_pipeline = create_indexing_pipeline(
+        document_store, metadata_fields_to_embed=metadata_fields_to_embed,
+        collection_versions=Collection_Versions(get_versions_path(persist_path)),
+        collection_name=collection_name
+        )
+    article_batches = iter_article_batches(
+        api, query, page_size=page_size, max_records=max_records, **search_kwargs
+        )
+    document_batches = iter_document_batches(
+        article_batches, content_key=content_key,
+        meta_keys=metadata_fields_to_embed + other_metadata_fields, list_keys=list_keys,
+        batch_size=batch_size
+        )
+    n_documents = index_document_batches(document_batches, indexing_pipeline, logger=logger)
+    logger.info(f'Indexed {n_documents} documents into collection `{collection_name}`.')
+    return n_documents
+
+if __name__ == "__main__":
+    logger = create_function_logger(__name__, parent_logger=None, level=logging.INFO)
+    logger.info(f'System arguments: {sys.argv[1:]}')
+    query = sys.argv[1]
+    collection_name = sys.argv[2] if len(sys.argv) > 2 else 'test_set_5'
+    max_records = int(sys.argv[3]) if len(sys.argv) > 3 else None
+    page_size = int(sys.argv[4]) if len(sys.argv) > 4 else 500
+    batch_size = int(sys.argv[5]) if len(sys.argv) > 5 else 100
+    run_streaming_pipeline(
+        query, collection_name, page_size=page_size, batch_size=batch_size,
+        max_records=max_records, logger=logger
+        )
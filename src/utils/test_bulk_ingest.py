@@ -0,0 +1,62 @@
+"""
+Offline checks of the article store written by `bulk_ingest`. Run from the `src/utils` folder with
+`python -m pytest test_bulk_ingest.py`.
+"""
+import os
+import gzip
+import json
+import logging
+import tempfile
+import unittest
+from pubmed_parser import make_synthetic_record
+from article_store import iter_articles, list_article_shards, read_deleted_pmids
+from bulk_ingest import ingest_file
+
+def write_update_file(path, pmids, deleted_pmids):
+    """
+    Write a gzip'd update file with the articles of `pmids` and a `DeleteCitation` element.
+    """
+    with gzip.open(path, 'wt', encoding='utf-8') as file:
+        file.write('<?xml version="1.0" ?>\n<PubmedArticleSet>\n')
+        for pmid in pmids:
+            file.write(make_synthetic_record(pmid))
+        file.write('<DeleteCitation>')
+        file.write(''.join(f'<PMID Version="1">{pmid}</PMID>' for pmid in deleted_pmids))
+        file.write('</DeleteCitation>\n</PubmedArticleSet>\n')
+    return path
+
+class Article_Store_Test(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.addCleanup(self.folder.cleanup)
+        self.store_path = os.path.join(self.folder.name, 'store')
+        self.update_path = write_update_file(
+            os.path.join(self.folder.name, 'pubmed24n1300.xml.gz'), range(1, 8), ['900', '901']
+            )
+        self.logger = logging.getLogger('test_bulk_ingest')
+        self.logger.setLevel(logging.CRITICAL)
+
+    def check_store(self, output_format):
+        result = ingest_file(self.update_path, self.store_path, shard_size=3, output_format=output_format, logger=self.logger)
+        self.assertEqual((result['articles'], result['deleted']), (7, 2))
+        self.assertEqual(list_article_shards(self.store_path), sorted(result['shards']))
+        articles = [row for rows in iter_articles(self.store_path, batch_size=2) for row in rows]
+        self.assertEqual([row['pmid'] for row in articles], [str(pmid) for pmid in range(1, 8)])
+        self.assertEqual(read_deleted_pmids(self.store_path), ['900', '901'])
+
+    def test_tombstones_are_not_read_as_articles(self):
+        self.check_store('json')
+
+    def test_tombstones_are_not_read_as_articles_parquet(self):
+        self.check_store('parquet')
+
+    def test_top_level_tombstones_are_skipped(self):
+        # Stores written before tombstones had their own folder
+        self.check_store('json')
+        with open(os.path.join(self.store_path, 'pubmed24n1299_deleted.json'), 'w') as file:
+            json.dump(['902'], file)
+        articles = [row for rows in iter_articles(self.store_path) for row in rows]
+        self.assertEqual(len(articles), 7)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,52 @@
+"""
+Offline checks of the esearch cache. Run from the `src/utils` folder with
+`python -m pytest test_pubmed_cache.py`.
+"""
+import os
+import logging
+import tempfile
+import unittest
+from unittest import mock
+from pubmed_cache import Search_Cache, is_successful_search
+from Pubmed_API import Pubmed_API
+
+class Fake_Response:
+    def __init__(self, status_code, response_dict):
+        self.status_code = status_code
+        self.response_dict = response_dict
+
+    def json(self):
+        return self.response_dict
+
+class Search_Cache_Test(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.addCleanup(self.folder.cleanup)
+        self.search_cache = Search_Cache(db_path=os.path.join(self.folder.name, 'searches.sqlite3'))
+        self.api = Pubmed_API(api_key=None, search_cache=self.search_cache, logging_level=logging.CRITICAL)
+
+    def search(self, response):
+        with mock.patch.object(self.api, 'send_request', return_value=response) as send_request:
+            results = self.api.search_article('muscle protein synthesis', ids_only=True, verbose=False)
+        return results, send_request.call_count
+
+    def test_successful_search_is_cached(self):
+        response = Fake_Response(200, {'esearchresult': {'count': '2', 'idlist': ['1', '2']}})
+        self.assertEqual(self.search(response), (['1', '2'], 1))
+        self.assertEqual(self.search(response), (['1', '2'], 0))
+
+    def test_error_responses_are_not_cached(self):
+        error_responses = [
+            Fake_Response(200, {'error': 'API rate limit exceeded', 'api-key': '1.2.3.4', 'count': '4'}),
+            Fake_Response(200, {'esearchresult': {'ERROR': 'Invalid query', 'idlist': []}}),
+            Fake_Response(429, {'esearchresult': {'count': '0', 'idlist': []}}),
+            ]
+        for response in error_responses:
+            self.assertFalse(is_successful_search(response.status_code, response.json()))
+            self.search(response)
+            self.assertEqual(self.search(response)[1], 1)
+        response = Fake_Response(200, {'esearchresult': {'count': '1', 'idlist': ['3']}})
+        self.assertEqual(self.search(response), (['3'], 1))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,95 @@
+"""
+Offline checks that the streaming XML extractor reproduces the regex extractor of `Pubmed_API`.
+Run from the `src/utils` folder with `python -m pytest test_pubmed_parser.py`.
+"""
+import io
+import re
+import logging
+import unittest
+from pubmed_parser import (
+    make_synthetic_record, iter_pubmed_articles, extract_pubmed_details_xml, compare_extractors
+    )
+from Pubmed_API import Pubmed_API
+
+def make_markup_record(pmid):
+    """
+    Synthetic record with inline markup in the title and in a labelled structured abstract.
+    """
+    return make_synthetic_record(pmid).replace(
+        '<ArticleTitle>', '<ArticleTitle>Effect of <i>vitamin D</i> on ', 1
+        ).replace(
+        '<Abstract>',
+        '<Abstract><AbstractText Label="OBJECTIVE" NlmCategory="OBJECTIVE">Use of CO<sub>2</sub> '
+        'and <i>E. coli</i> at 10<sup>-3</sup> M.</AbstractText>', 1
+        )
+
+def make_unlabelled_record(pmid):
+    """
+    Synthetic record with an unstructured abstract containing inline markup.
+    """
+    return re.sub(
+        r'<Abstract>.*?</Abstract>',
+        '<Abstract><AbstractText>Plain <i>in vivo</i> effect of Ca<sup>2+</sup> intake.</AbstractText></Abstract>',
+        make_synthetic_record(pmid)
+        )
+
+def make_collective_author_record(pmid, first=True):
+    """
+    Synthetic record with a `CollectiveName` author before or after the named authors.
+    """
+    collective_author = '<Author ValidYN="Y"><CollectiveName>Study Group</CollectiveName></Author>'
+    record = make_synthetic_record(pmid)
+    if first:
+        return record.replace('<AuthorList CompleteYN="Y">', f'<AuthorList CompleteYN="Y">{collective_author}', 1)
+    return record.replace('</AuthorList>', f'{collective_author}</AuthorList>', 1)
+
+class Extractor_Equivalence_Test(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.api = Pubmed_API(logger=None, logging_level=logging.WARNING)
+        cls.record_strings = [
+            make_synthetic_record(1),
+            make_markup_record(2),
+            make_unlabelled_record(3),
+            make_collective_author_record(4, first=True),
+            make_collective_author_record(5, first=False),
+            ]
+
+    def extract_regex(self, record_strings):
+        return self.api.extract_pubmed_details_df(record_strings=record_strings, parser='regex', n_jobs=1)
+
+    def test_extractors_match(self):
+        df_regex = self.extract_regex(self.record_strings)
+        df_xml = extract_pubmed_details_xml(self.record_strings)
+        mismatches = compare_extractors(df_regex, df_xml)
+        self.assertEqual({column: pmids for column, pmids in mismatches.items() if pmids}, {})
+        self.assertEqual(df_xml['pmid'].tolist(), ['1', '2', '3', '4', '5'])
+
+    def test_markup_is_dropped(self):
+        df_xml = extract_pubmed_details_xml(self.record_strings)
+        self.assertTrue(df_xml['article_title'][1].startswith('Effect of vitamin D on '))
+        self.assertTrue(df_xml['abstract'][1].startswith('OBJECTIVE: Use of CO2 and E. coli at 10-3 M. BACKGROUND: '))
+        self.assertEqual(df_xml['abstract'][2], ': Plain in vivo effect of Ca2+ intake.')
+
+    def test_collective_authors_are_skipped(self):
+        df_xml = extract_pubmed_details_xml(self.record_strings)
+        for authors in df_xml['authors'][3:]:
+            self.assertNotIn('Study Group', ' '.join(authors))
+            self.assertTrue(all(author.startswith('Last') for author in authors))
+
+    def test_delete_citation(self):
+        article_set = (
+            '<PubmedArticleSet>' + ''.join(self.record_strings)
+            + '<DeleteCitation><PMID Version="1">900</PMID><PMID Version="1">901</PMID></DeleteCitation>'
+            + '</PubmedArticleSet>'
+            )
+        deleted_pmids = []
+        rows = list(iter_pubmed_articles(io.BytesIO(article_set.encode('utf-8')), deleted_pmids=deleted_pmids))
+        self.assertEqual(deleted_pmids, ['900', '901'])
+        self.assertEqual([row['pmid'] for row in rows], ['1', '2', '3', '4', '5'])
+        df_xml = extract_pubmed_details_xml([article_set])
+        mismatches = compare_extractors(self.extract_regex(self.record_strings), df_xml)
+        self.assertEqual({column: pmids for column, pmids in mismatches.items() if pmids}, {})
+
+if __name__ == "__main__":
+    unittest.main()